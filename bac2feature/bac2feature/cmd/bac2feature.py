@@ -1,16 +1,49 @@
 ### Library ###
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import os
+import shutil
+import sys
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
 ### Bac2Feature ###
+# pandas, tables and method backends (picrust2, scikit-learn, ...) are imported where they
+# are used, so that -h and single-method runs do not pay for them (see bac2feature_benchmark --startup)
 import bac2feature.core.default as default
-from bac2feature.core.utils import get_intermediate_dir, reorder_by_fasta
-from bac2feature.core.homology_based_prediction import predict_by_homology
-from bac2feature.core.taxonomy_based_prediction import predict_by_taxonomy
-from bac2feature.core.phylogeny_based_prediction import predict_by_phylogeny
+from bac2feature.core.cache import PredictionCache
+from bac2feature.core.checkpoint import CHECKPOINT_STAGES
+from bac2feature.core.predict import (HSP_BACKEND, PREDICTION_METHOD, TAXONOMY_BACKEND,
+                                      cache_context, predict_by_method)
+from bac2feature.core import profiling
+from bac2feature.core.profiling import stage
+from bac2feature.core.utils import (dereplicate, get_intermediate_dir, is_plain_fasta,
+                                    iter_fasta_chunks, read_fasta, write_fasta)
 
-PREDICTION_METHOD = ['homology', 'taxonomy', 'phylogeny']
+if TYPE_CHECKING:
+    import pandas as pd
+
+PROFILE_FORMAT = ['json', 'chrome']
+# Relative share of the thread budget when methods run concurrently
+METHOD_THREAD_WEIGHT = {'homology': 2, 'taxonomy': 1, 'phylogeny': 3}
 
 def main():
+    # Server mode: bac2feature serve [options]
+    if sys.argv[1:2] == ['serve']:
+        from bac2feature.cmd.serve import main as serve_main
+        serve_main(sys.argv[2:])
+        return
+    # Worker of sharded placement: bac2feature placement_worker [options]
+    if sys.argv[1:2] == ['placement_worker']:
+        from bac2feature.cmd.placement_worker import main as placement_worker_main
+        placement_worker_main(sys.argv[2:])
+        return
+    # Compile the reference index: bac2feature build-index [options]
+    if sys.argv[1:2] in (['build-index'], ['build_index']):
+        from bac2feature.cmd.build_index import main as build_index_main
+        build_index_main(sys.argv[2:])
+        return
+
     ### Parser ###
     parser = argparse.ArgumentParser(
 
@@ -20,6 +53,19 @@ def main():
         epilog='''
 Usage example:
 bac2feature -s rep_seqs.fasta -o predicted_traits.tsv
+zstdcat rep_seqs.fasta.zst | bac2feature -s - -o predicted_traits.tsv
+bac2feature -s rep_seqs.fasta -o predicted_traits.tsv -m homology taxonomy phylogeny --threads 8
+bac2feature -s rep_seqs.fasta -o predicted_traits.tsv --feature_table feature-table.biom
+
+Server mode (see bac2feature serve -h):
+bac2feature serve --port 8080
+
+Placement on several nodes (see bac2feature placement_worker -h):
+bac2feature -s rep_seqs.fasta -o predicted_traits.tsv --placement_shards 16 --placement_queue /shared/queue
+bac2feature placement_worker --queue /shared/queue --threads 8   # on each node
+
+Memory-mapped reference index, built once per reference (see bac2feature build-index -h):
+bac2feature build-index
 ''',
         formatter_class=argparse.RawTextHelpFormatter
     )
@@ -28,18 +74,21 @@ bac2feature -s rep_seqs.fasta -o predicted_traits.tsv
     required = parser.add_argument_group('required arguments')
     # Input 16S rRNA gene sequences.
     required.add_argument('-s', '--seq', metavar='FASTA FILE', required=True,
-                        help='Input 16S rRNA sequences in fasta format.')
+                        help='Input 16S rRNA sequences in fasta format, optionally compressed by\n'
+                            'gzip, bzip2 or zstd (zstd requires zstandard), or - for standard input.')
     # Output predicted trait tables.
     required.add_argument('-o', '--output', metavar='TSV FILE', required=True,
-                        help='Output predicted trait table in tsv format.')
+                        help='Output predicted trait table in tsv format (see --format).')
 
     # Optional arguments (no need to create a group - use default)
     # Method to predict traits using 16S rRNA gene phylogeny.
-    parser.add_argument('-m', '--method', default='phylogeny', choices=PREDICTION_METHOD,
+    parser.add_argument('-m', '--method', default=['phylogeny'], choices=PREDICTION_METHOD, nargs='+',
                         help='Method to predict prokaryotic traits (default: phylogeny).\n'
                             '  "homology": predict prokaryotic traits using homology search.\n'
                             '  "taxonomy": predict prokaryotic traits using taxonomic classification.\n'
-                            '  "phylogeny": predict prokaryotic traits using phylogenetic placement.'
+                            '  "phylogeny": predict prokaryotic traits using phylogenetic placement.\n'
+                            'With more than one method, they run concurrently sharing --threads and\n'
+                            'the output has the columns of each method prefixed by its name.'
                         )
     # Calculate phylogenetic distance to reference 16S rRNA gene sequence data (for the phylogeny-based prediction)
     parser.add_argument('--check_NSTI', action='store_true', required=False, default=False,
@@ -48,13 +97,90 @@ bac2feature -s rep_seqs.fasta -o predicted_traits.tsv
     # Filter predictions by NSTI threshold (for the phylogeny-based prediction)
     parser.add_argument('--without_filter', action='store_false', dest='filter_by_nsti', required=False, default=True,
                         help='Disable filtering by NSTI threshold for the phylogeny-based prediction.')
+    # Backend of hidden state prediction (for the phylogeny-based prediction)
+    parser.add_argument('--hsp_backend', default='python', choices=HSP_BACKEND,
+                        help='Backend of hidden state prediction for the phylogeny-based prediction (default: python).\n'
+                            '  "python": predict all traits in one pass with the built-in engine.\n'
+                            '  "R": call castor_hsp.R (reference implementation using R package castor).'
+                        )
+    # Backend of taxonomic classification (for the taxonomy-based prediction)
+    parser.add_argument('--taxonomy_backend', default='sklearn', choices=TAXONOMY_BACKEND,
+                        help='Backend of taxonomic classification for the taxonomy-based prediction (default: sklearn).\n'
+                            '  "sklearn": load the naive Bayes classifier from the .qza file and classify directly.\n'
+                            '  "qiime": call qiime feature-classifier classify-sklearn through QIIME2 artifacts.'
+                        )
+    # Output format
+    parser.add_argument('--format', default='tsv', choices=default.output_formats, dest='out_format',
+                        help='Format of the output table (default: tsv).\n'
+                            '  "tsv", "tsv.gz": tab-separated text (gzip-compressed).\n'
+                            '  "parquet", "arrow": columnar formats with float32 continuous and\n'
+                            '  int8 categorical traits (requires pyarrow).'
+                        )
+    # Community-weighted traits
+    parser.add_argument('--feature_table', metavar='PATH', required=False, default=None,
+                        help='Feature table (BIOM or tsv, features in rows) whose feature IDs are the\n'
+                            'input sequence IDs. Abundance-weighted mean traits and category fractions\n'
+                            'of each sample are written to --community_output.')
+    parser.add_argument('--community_output', metavar='PATH', required=False, default=None,
+                        help='Output of community-weighted traits in the format of --format\n'
+                            '(default: community_traits.<format> in the directory of --output).')
     # Intermediate directory
     parser.add_argument('--intermediate_dir', metavar='PATH', required=False, default=None,
-                        help='Store intermediate file in this directory.')
+                        help='Store intermediate file in this directory.\n'
+                            'A rerun with the same directory reuses the outputs of stages (BLASTn,\n'
+                            'classification, placement, HSP) whose inputs, reference files and\n'
+                            'parameters are unchanged, e.g. after a failure or preemption.')
+    parser.add_argument('--force_from', default=None, choices=CHECKPOINT_STAGES,
+                        help='Recompute this stage and the later stages of its method even if\n'
+                            'they can be reused from --intermediate_dir (default: reuse).')
     # CPU
     parser.add_argument('--threads', metavar='INT', required=False, default=1,
                         help='Specify the number of CPU in parallel (default: 1).')
 
+    # Chunked processing for large input
+    parser.add_argument('--chunk_size', metavar='INT', type=int, required=False, default=None,
+                        help='Process the input in chunks of this many sequences to bound memory usage\n'
+                            '(default: all sequences at once).\n'
+                            'For the homology-based prediction, the alignment length cutoff is computed per chunk.')
+    parser.add_argument('--chunk_workers', metavar='INT', type=int, required=False, default=1,
+                        help='Number of chunks processed in parallel with --chunk_size;\n'
+                            '--threads is divided among them (default: 1).')
+
+    # Sharded placement
+    parser.add_argument('--placement_shards', metavar='INT', type=int, required=False, default=1,
+                        help='Split the sequences into this many shards placed by separate processes\n'
+                            'for the phylogeny-based prediction; --threads is divided among them (default: 1).')
+    parser.add_argument('--placement_queue', metavar='PATH', required=False, default=None,
+                        help='Submit placement shards as jobs to this directory on a shared filesystem.\n'
+                            'Workers on any node (bac2feature placement_worker --queue PATH) and this\n'
+                            'process place them, and the placements are merged before HSP.')
+
+    # Prediction cache across runs
+    parser.add_argument('--cache', metavar='PATH', required=False, default=None,
+                        help='Cache predictions in this SQLite file and reuse them in later runs\n'
+                            'with the same method, reference data and options (default: no cache).')
+    parser.add_argument('--cache_max_size', metavar='MB', type=float, required=False, default=1024,
+                        help='Maximum size of the prediction cache; least recently used\n'
+                            'predictions are evicted (default: 1024).')
+
+    # Profiling
+    parser.add_argument('--profile', metavar='PATH', required=False, default=None,
+                        help='Record wall time, CPU time and peak memory of each stage and\n'
+                            'external command (blastn, epa-ng, Rscript, ...) to this trace file.')
+    parser.add_argument('--profile_format', default='json', choices=PROFILE_FORMAT,
+                        help='Format of the trace file (default: json).\n'
+                            '  "json": list of stage and subprocess records.\n'
+                            '  "chrome": Chrome trace event format (chrome://tracing, Perfetto).'
+                        )
+
+    # In-process prefilter of the homology search
+    parser.add_argument('--kmer_prefilter', metavar='FLOAT', type=float, required=False, default=None,
+                        help='Predict queries with full-length hits of at least this percent identity in the\n'
+                            'k-mer index of the BLAST database (bac2feature build-index) from those hits,\n'
+                            'and search only the other queries and those with ambiguous bases by BLASTn\n'
+                            '(default: off). Traits unknown for all of these hits are left missing instead\n'
+                            'of being taken from less similar BLAST hits.')
+
     # Reference for phylogenetic placement
     parser.add_argument('--ref_dir_placement', metavar='PATH', required=False, default=default.ref_dir_placement,
                         help='Reference for phylogenetic placement (for developer use).')
@@ -70,75 +196,373 @@ bac2feature -s rep_seqs.fasta -o predicted_traits.tsv
     ## I/O
     input_fasta = args.seq
     out_trait = args.output
-    estimation_method = args.method
+    out_format = args.out_format
+    estimation_methods = list(dict.fromkeys(args.method))
     ## Option
     intermediate_dir = args.intermediate_dir
     threads = args.threads
-    check_nsti = args.check_NSTI
-    filter_by_nsti = args.filter_by_nsti
-    ## Ref
-    ref_trait = args.ref_trait
-    ref_blastdb = args.ref_blastdb
-    ref_dir_placement = args.ref_dir_placement
-
-
-    predict_trait_by_three_methods(
-        input_fasta=input_fasta, out_trait=out_trait, estimation_method=estimation_method,
-        intermediate_dir=intermediate_dir, threads=threads, check_nsti=check_nsti,
-        filter_by_nsti=filter_by_nsti,
-        ref_trait=ref_trait, ref_blastdb=ref_blastdb, ref_dir_placement=ref_dir_placement)
+    chunk_size = args.chunk_size
+    chunk_workers = args.chunk_workers
+    profile_path = args.profile
+    profile_format = args.profile_format
+    feature_table = args.feature_table
+    community_output = args.community_output
+    if feature_table is not None and community_output is None:
+        community_output = os.path.join(os.path.dirname(out_trait), f'community_traits.{out_format}')
+    ## Options and references of the methods
+    options = method_options(args)
+    run_options = dict(intermediate_dir=intermediate_dir, threads=threads, options=options,
+                       out_format=out_format, chunk_size=chunk_size, chunk_workers=chunk_workers)
+    if profile_path is not None:
+        profiling.start_recording()
+    try:
+        with stage('bac2feature'):
+            if len(estimation_methods) == 1:
+                predict_trait_by_three_methods(input_fasta=input_fasta, out_trait=out_trait,
+                                               estimation_method=estimation_methods[0], **run_options)
+            else:
+                predict_trait_by_multiple_methods(input_fasta=input_fasta, out_trait=out_trait,
+                                                  estimation_methods=estimation_methods, **run_options)
+            if feature_table is not None:
+                with stage('community'):
+                    predict_community_traits(out_trait=out_trait, out_format=out_format,
+                                             feature_table=feature_table,
+                                             community_output=community_output)
+    finally:
+        if profile_path is not None:
+            profiling.write_trace(profiling.stop_recording(), profile_path, trace_format=profile_format)
+            print(f'Profile is written to {profile_path}.')
 
     return
 
 ### Main func ###
 def predict_trait_by_three_methods(
     input_fasta: str, out_trait: str, estimation_method: str,
-    intermediate_dir: str, threads: int, check_nsti: bool,
-    filter_by_nsti: bool = True,
-    ref_trait=default.ref_trait, ref_blastdb=default.ref_blastdb,
-    ref_nb_classifier=default.ref_nb_classifier, ref_trait_taxonomy=default.ref_trait_taxonomy,
-    qiime_env=default.qiime_env, ref_dir_placement=default.ref_dir_phylogeny) -> None:
+    intermediate_dir: str, threads: int, options: dict, out_format: str = 'tsv',
+    chunk_size: Optional[int] = None, chunk_workers: int = 1) -> None:
     """
     Predict prokaryotic traits using three methods.
+    With chunk_size, the input FASTA is processed in chunks of sequences by chunk_workers processes.
+    With cache_path, predictions are cached across runs and only new sequences are predicted.
+    With intermediate_dir, stages of a previous run in it are reused if their checkpoints
+    match (stages from force_from on are recomputed).
+    The output is written once in out_format.
+    options are the options of predict_by_method (see method_options).
     """
     with get_intermediate_dir(intermediate_dir) as work_dir:
-        if estimation_method == 'homology':
-            predict_by_homology(
-                input_fasta=input_fasta,
-                out_trait=out_trait,
-                intermediate_dir=work_dir,
-                ref_blastdb=ref_blastdb,
-                ref_trait=ref_trait,
-                perc_identity=None,
-                check_nsti=check_nsti,
-                threads=threads
-            )
-        elif estimation_method == 'taxonomy':
-            predict_by_taxonomy(
-                input_fasta=input_fasta,
-                out_trait=out_trait,
-                intermediate_dir=work_dir,
-                ref_nb_classifier=ref_nb_classifier,
-                ref_trait_taxonomy=ref_trait_taxonomy,
-                qiime_env=qiime_env,
-                threads=threads
-            )
-        elif estimation_method == 'phylogeny':
-            predict_by_phylogeny(
-                input_fasta=input_fasta,
-                out_trait=out_trait,
-                intermediate_dir=work_dir,
-                ref_dir_placement=ref_dir_placement,
-                ref_trait=ref_trait,
-                check_nsti=check_nsti,
-                filter_by_nsti=filter_by_nsti,
-                threads=threads
-            )
-
-        # Reorder output to match input FASTA order
-        reorder_by_fasta(output_path=out_trait, input_fasta=input_fasta)
+        if chunk_size is None:
+            predict_batch(input_fasta=input_fasta, out_trait=out_trait, work_dir=work_dir,
+                          estimation_method=estimation_method, threads=threads,
+                          out_format=out_format, **options)
+        else:
+            predict_in_chunks(input_fasta=input_fasta, out_trait=out_trait, work_dir=work_dir,
+                              estimation_method=estimation_method, threads=threads,
+                              chunk_size=chunk_size, chunk_workers=chunk_workers,
+                              keep_chunks=intermediate_dir is not None, out_format=out_format,
+                              **options)
+
+    return
+
+def predict_trait_by_multiple_methods(
+    input_fasta: str, out_trait: str, estimation_methods: List[str],
+    intermediate_dir: str, threads: int, options: dict, out_format: str = 'tsv',
+    chunk_size: Optional[int] = None, chunk_workers: int = 1) -> None:
+    """
+    Predict prokaryotic traits by several methods at the same time.
+    The methods share the thread budget and one intermediate directory, and their predictions
+    are written to one table with columns prefixed by the method name.
+    options are the options of predict_by_method (see method_options).
+    """
+    method_threads = split_threads(estimation_methods, int(threads))
+
+    with get_intermediate_dir(intermediate_dir) as work_dir:
+        # Read the input once for the output order, and write its distinct sequences
+        # to one uncompressed file shared by the methods
+        with stage('read_input'):
+            query_fasta = os.path.join(work_dir, 'query.fasta')
+            sequence_ids, representatives = [], []
+            write_fasta(dereplicate(read_fasta(input_fasta), sequence_ids, representatives), query_fasta)
+            input_fasta = query_fasta
+        print_dereplication(sequence_ids, representatives)
+
+        method_outs = {}
+        # Methods mostly wait on external tools (blastn, hmmalign/epa-ng, the classifier),
+        # so threads are enough to run them concurrently
+        with ThreadPoolExecutor(max_workers=len(estimation_methods)) as pool:
+            futures = []
+            for method in estimation_methods:
+                method_dir = os.path.join(work_dir, method)
+                os.makedirs(method_dir, exist_ok=True)
+                method_outs[method] = os.path.join(method_dir, 'predicted_traits.pkl')
+                print(f'Predict traits by the {method}-based method with {method_threads[method]} threads.')
+                if chunk_size is None:
+                    futures.append(pool.submit(
+                        predict_batch, input_fasta=input_fasta, out_trait=method_outs[method],
+                        work_dir=method_dir, estimation_method=method,
+                        threads=method_threads[method], out_format='pickle', **options))
+                else:
+                    futures.append(pool.submit(
+                        predict_in_chunks, input_fasta=input_fasta, out_trait=method_outs[method],
+                        work_dir=method_dir, estimation_method=method,
+                        threads=method_threads[method], chunk_size=chunk_size,
+                        chunk_workers=max(1, chunk_workers * method_threads[method] // int(threads)),
+                        keep_chunks=intermediate_dir is not None, out_format='pickle', **options))
+            for future in futures:
+                future.result()
+
+        with stage('merge_methods'):
+            merge_method_predictions(method_outs, out_trait=out_trait, sequence_ids=sequence_ids,
+                                     representatives=representatives, out_format=out_format)
+
+    return
+
+def predict_community_traits(
+    out_trait: str, out_format: str, feature_table: str, community_output: str) -> None:
+    """
+    Weight the predicted traits by the abundances of a feature table for each sample.
+    """
+    from bac2feature.core.community import write_community_traits
+    from bac2feature.core.table import read_predictions
+
+    if not os.path.exists(out_trait):
+        print('No predictions to weight by the feature table.')
+        return
+    predictions = read_predictions(out_trait, in_format=out_format)
+    write_community_traits(predictions, feature_table=feature_table, out_path=community_output,
+                           out_format=out_format)
+    return
+
+def method_options(args: argparse.Namespace) -> dict:
+    """
+    Options and references of the methods from the command-line arguments,
+    passed as they are to predict_by_method (and to the prediction cache).
+    """
+    return dict(
+        check_nsti=args.check_NSTI, filter_by_nsti=args.filter_by_nsti, hsp_backend=args.hsp_backend,
+        taxonomy_backend=args.taxonomy_backend, ref_trait=args.ref_trait, ref_blastdb=args.ref_blastdb,
+        ref_nb_classifier=default.ref_nb_classifier, ref_trait_taxonomy=default.ref_trait_taxonomy,
+        qiime_env=default.qiime_env, ref_dir_placement=args.ref_dir_placement,
+        placement_shards=args.placement_shards, placement_queue=args.placement_queue,
+        kmer_prefilter=args.kmer_prefilter, resume=args.intermediate_dir is not None,
+        force_from=args.force_from, cache_path=args.cache, cache_max_size=args.cache_max_size)
+
+def split_threads(estimation_methods: List[str], threads: int) -> Dict[str, int]:
+    """
+    Divide the thread budget among methods in proportion to METHOD_THREAD_WEIGHT
+    (largest remainder, at least one thread per method).
+    """
+    weights = [METHOD_THREAD_WEIGHT[method] for method in estimation_methods]
+    spare = max(0, threads - len(estimation_methods))
+    shares = [spare * w / sum(weights) for w in weights]
+    counts = [1 + int(share) for share in shares]
+    remainders = sorted(range(len(shares)), key=lambda i: (int(shares[i]) - shares[i], -weights[i]))
+    for i in remainders[:len(estimation_methods) + spare - sum(counts)]:
+        counts[i] += 1
+    return dict(zip(estimation_methods, counts))
+
+def merge_method_predictions(
+    method_outs: Dict[str, str], out_trait: str, sequence_ids: List[str], representatives: List[str],
+    out_format: str = 'tsv') -> None:
+    """
+    Join the predictions of each method into one table in the order of sequence_ids,
+    copying the predictions of representative sequences to their duplicates.
+    Columns are prefixed by the method name, and missing predictions are left empty.
+    """
+    from bac2feature.core.table import fan_out_predictions, read_predictions, write_predictions
+
+    merged = None
+    for method, method_out in method_outs.items():
+        if not os.path.exists(method_out):
+            continue
+        predictions = read_predictions(method_out)
+        predictions = predictions.set_index('sequence').add_prefix(f'{method}_')
+        merged = predictions if merged is None else merged.join(predictions, how='outer')
+    if merged is None:
+        return
+    merged = fan_out_predictions(merged.rename_axis('sequence').reset_index(), sequence_ids, representatives)
+    write_predictions(merged, out_trait, out_format)
+    return
+
+def predict_in_chunks(
+    input_fasta: str, out_trait: str, work_dir: str, estimation_method: str,
+    threads: int, chunk_size: int, chunk_workers: int, keep_chunks: bool,
+    out_format: str = 'tsv', **options) -> None:
+    """
+    Predict traits chunk by chunk in a process pool.
+    Results are appended to the output in input order as soon as preceding chunks are done,
+    and at most two chunks per worker are held at a time.
+    """
+    from bac2feature.core.table import PredictionWriter, read_predictions
+
+    # Split the thread budget among the workers
+    chunk_threads = max(1, int(threads) // chunk_workers)
+
+    def write_chunk(future, chunk_dir: str, chunk_out: str) -> None:
+        result = future.result()
+        if profiling.is_recording():
+            _, records, origin = result
+            profiling.merge_records(records, origin)
+        # Chunks without any prediction do not produce an output
+        if os.path.exists(chunk_out):
+            writer.write(read_predictions(chunk_out))
+        if not keep_chunks:
+            shutil.rmtree(chunk_dir)
+
+    running = deque()
+    with ProcessPoolExecutor(max_workers=chunk_workers) as pool, \
+            PredictionWriter(out_trait, out_format) as writer:
+        for i, lines in enumerate(iter_fasta_chunks(input_fasta, chunk_size)):
+            chunk_dir = os.path.join(work_dir, f'chunk_{i:06d}')
+            os.makedirs(chunk_dir, exist_ok=True)
+            chunk_fasta = os.path.join(chunk_dir, 'input.fasta')
+            chunk_out = os.path.join(chunk_dir, 'predicted_traits.pkl')
+            with open(chunk_fasta, 'w') as f:
+                f.writelines(lines)
+            chunk_options = dict(input_fasta=chunk_fasta, out_trait=chunk_out, work_dir=chunk_dir,
+                                 estimation_method=estimation_method, threads=chunk_threads,
+                                 out_format='pickle', **options)
+            if profiling.is_recording():
+                # Workers record their own stages and return them with the result
+                future = pool.submit(profiling.record_call, predict_batch, **chunk_options)
+            else:
+                future = pool.submit(predict_batch, **chunk_options)
+            running.append((future, chunk_dir, chunk_out))
+            # Bound memory and disk usage by waiting for the oldest chunk
+            while len(running) >= 2 * chunk_workers:
+                write_chunk(*running.popleft())
+        while running:
+            write_chunk(*running.popleft())
 
     return
 
+def predict_batch(
+    input_fasta: str, out_trait: str, work_dir: str, estimation_method: str, threads: int,
+    cache_path: Optional[str] = None, cache_max_size: float = 1024, out_format: str = 'tsv',
+    **options) -> None:
+    """
+    Predict traits of all sequences in a FASTA file by the selected method,
+    reusing cached predictions if cache_path is given.
+    The input is read once and identical sequences are predicted once; their predictions
+    are copied to every ID in input order and written once in out_format.
+    """
+    from bac2feature.core.table import fan_out_predictions, write_predictions
+
+    with stage(f'{estimation_method}.read_input'):
+        sequence_ids, representatives = [], []
+        records = list(dereplicate(read_fasta(input_fasta), sequence_ids, representatives))
+    print_dereplication(sequence_ids, representatives)
+    # External tools read the input file directly unless it has to be rewritten
+    if is_plain_fasta(input_fasta) and len(records) == len(sequence_ids):
+        query_records = None
+    else:
+        query_records = records
+
+    if cache_path is not None:
+        predictions = predict_with_cache(records=records, work_dir=work_dir,
+                                         estimation_method=estimation_method, threads=threads,
+                                         cache_path=cache_path, cache_max_size=cache_max_size,
+                                         **options)
+    else:
+        predictions = predict_by_method(input_fasta=input_fasta, work_dir=work_dir,
+                                        estimation_method=estimation_method, threads=threads,
+                                        records=query_records, **options)
+
+    # Copy predictions to duplicate sequences in input FASTA order
+    with stage(f'{estimation_method}.reorder'):
+        predictions = fan_out_predictions(predictions, sequence_ids, representatives)
+    with stage(f'{estimation_method}.write'):
+        write_predictions(predictions, out_trait, out_format)
+    return
+
+def print_dereplication(sequence_ids: List[str], representatives: List[str]) -> None:
+    n_unique = len(set(representatives))
+    if n_unique < len(sequence_ids):
+        print(f'Dereplication: {len(sequence_ids) - n_unique} duplicate sequences collapsed '
+              f'({n_unique} unique of {len(sequence_ids)}).')
+    return
+
+def predict_with_cache(
+    records: List[Tuple[str, str]], work_dir: str, estimation_method: str, threads: int,
+    cache_path: str, cache_max_size: float, **options) -> 'pd.DataFrame':
+    """
+    Predict only sequences missing from the prediction cache and merge them with cached rows.
+    """
+    cache = PredictionCache(cache_path, max_size_mb=cache_max_size)
+    context = cache.context(**cache_context(estimation_method, **options))
+    if estimation_method == 'homology':
+        predictions = homology_predictions_with_cache(cache, context, records=records, work_dir=work_dir,
+                                                      threads=threads, **options)
+    else:
+        predictions = rows_with_cache(cache, context, records=records, work_dir=work_dir,
+                                      estimation_method=estimation_method, threads=threads, **options)
+    print(f'Prediction cache: {cache.hits} hits, {cache.misses} misses.')
+    cache.record_stats()
+    cache.close()
+    return predictions
+
+def rows_with_cache(
+    cache: PredictionCache, context: str, records: List[Tuple[str, str]], work_dir: str,
+    estimation_method: str, threads: int, **options) -> 'pd.DataFrame':
+    """Predicted rows of sequences missing from the cache merged with cached rows."""
+    import pandas as pd
+    from bac2feature.core.table import categorical_traits, format_predictions, typed_predictions
+
+    cached = cache.get_many(context, [seq for _, seq in records])
+
+    # Predict uncached sequences
+    uncached = [(seq_id, seq) for seq_id, seq in records if seq not in cached]
+    if uncached:
+        predictions = format_predictions(predict_by_method(
+            input_fasta=None, work_dir=work_dir, estimation_method=estimation_method,
+            threads=threads, records=uncached, **options))
+        columns = list(predictions.columns[1:])
+        rows = {seq_id: list(row) for seq_id, *row in predictions.itertuples(index=False)}
+        new_rows = {seq: rows.get(seq_id) for seq_id, seq in uncached}
+        cache.put_many(context, columns, new_rows)
+        cached.update({seq: (columns, row) for seq, row in new_rows.items()})
+
+    # Merge cached and new rows in input order
+    columns = next((columns for columns, row in cached.values() if row is not None), [])
+    merged = pd.DataFrame([[seq_id] + cached[seq][1] for seq_id, seq in records if cached[seq][1] is not None],
+                          columns=['sequence'] + columns)
+    return typed_predictions(merged, categorical_traits(options['ref_trait']))
+
+def homology_predictions_with_cache(
+    cache: PredictionCache, context: str, records: List[Tuple[str, str]], work_dir: str, threads: int,
+    ref_blastdb: str, ref_trait: str, check_nsti: bool, kmer_prefilter: Optional[float] = None,
+    resume: bool = False, force_from: Optional[str] = None, **options) -> 'pd.DataFrame':
+    """
+    Homology-based predictions from the hits of sequences missing from the cache
+    merged with cached hits. The alignment length cutoff depends on the hits of all
+    sequences, so it is applied after merging (as in a run without cache).
+    """
+    import pandas as pd
+    from bac2feature.core.homology_based_prediction import homology_hits, hits_to_predictions, length_cutoff
+
+    # Cached per sequence: length_sum and n_hits of its hits and its kept hits
+    # as (species_tax_id, pident, length), see BlastHitReducer.reduced
+    cached = cache.get_many(context, [seq for _, seq in records])
+    uncached = [(seq_id, seq) for seq_id, seq in records if seq not in cached]
+    if uncached:
+        hits, query_stats = homology_hits(input_fasta=None, intermediate_dir=work_dir, ref_blastdb=ref_blastdb,
+                                          ref_trait=ref_trait, threads=threads, query_records=uncached,
+                                          kmer_prefilter=kmer_prefilter, resume=resume, force_from=force_from)
+        seq_hits = {seq_id: group[['species_tax_id', 'pident', 'length']].values.tolist()
+                    for seq_id, group in hits.groupby('sequence', sort=False)}
+        seq_stats = {seq_id: (length_sum, int(n_hits))
+                     for seq_id, length_sum, n_hits in query_stats.itertuples(index=False)}
+        new_hits = {seq: list(seq_stats.get(seq_id, (0.0, 0))) + [seq_hits.get(seq_id, [])]
+                    for seq_id, seq in uncached}
+        columns = ['length_sum', 'n_hits', 'hits']
+        cache.put_many(context, columns, new_hits)
+        cached.update({seq: (columns, row) for seq, row in new_hits.items()})
+
+    # Merge cached and new hits in input order
+    hits = pd.DataFrame([[seq_id] + hit for seq_id, seq in records for hit in cached[seq][1][2]],
+                        columns=['sequence', 'species_tax_id', 'pident', 'length'])
+    query_stats = pd.DataFrame([[seq_id] + cached[seq][1][:2] for seq_id, seq in records],
+                               columns=['sequence', 'length_sum', 'n_hits'])
+    return hits_to_predictions(length_cutoff(hits, query_stats), ref_trait, check_nsti)
+
 if __name__ == '__main__':
     main()
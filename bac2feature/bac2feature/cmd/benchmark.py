@@ -0,0 +1,297 @@
+### Library ###
+import argparse
+import datetime
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import resource
+import subprocess
+import sys
+import time
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+
+### Bac2Feature ###
+import bac2feature.core.default as default
+from bac2feature.core.predict import PREDICTION_METHOD
+from bac2feature.core.utils import get_intermediate_dir, read_fasta, write_fasta
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000, 1000000]
+# Start-up commands measured by -X importtime in fresh interpreters
+STARTUP_COMMANDS = {
+    'import': 'import bac2feature.cmd.bac2feature',
+    'help': 'import sys; sys.argv = ["bac2feature", "-h"]; from bac2feature.cmd.bac2feature import main; main()',
+}
+# Modules that only the prediction backends need, i.e. not loaded at start-up
+LAZY_MODULES = ['numpy', 'pandas', 'scipy', 'h5py', 'pyarrow', 'picrust2', 'sklearn', 'q2_feature_classifier']
+# Seconds between checks that an isolated run is still alive
+RESULT_POLL_INTERVAL = 5
+
+def main():
+    ### Parser ###
+    parser = argparse.ArgumentParser(
+        description="This script benchmarks the prediction methods of Bac2Feature on synthetic datasets.\n"
+                    "Query sequences are sampled from reference 16S rRNA sequences and mutated.\n"
+                    "Each method and dataset size runs in a fresh process, and the wall time of each\n"
+                    "stage and the peak RSS are saved in JSON format.",
+        epilog='''
+Usage example:
+bac2feature_benchmark -o benchmark.json --sizes 100 1000 10000 --threads 8
+bac2feature_benchmark -o benchmark_new.json --baseline benchmark.json
+bac2feature_benchmark -o startup.json --startup --max_startup_ms 200
+''',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('-o', '--output', metavar='JSON FILE', required=True,
+                          help='Output benchmark results in JSON format.')
+    parser.add_argument('-m', '--method', default=PREDICTION_METHOD, choices=PREDICTION_METHOD, nargs='+',
+                        help='Methods to benchmark (default: homology taxonomy phylogeny).')
+    parser.add_argument('--sizes', metavar='INT', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Numbers of query sequences (default: 100 1000 10000 100000 1000000).')
+    parser.add_argument('--mutation_rate', metavar='FLOAT', type=float, default=0.02,
+                        help='Substitution rate per base; indels occur at a tenth of this rate (default: 0.02).')
+    parser.add_argument('--read_length', metavar='INT', type=int, default=None,
+                        help='Cut a random window of this length from each sequence,\n'
+                             'as for amplicon reads (default: full length).')
+    parser.add_argument('--seed', metavar='INT', type=int, default=0,
+                        help='Random seed of the synthetic datasets (default: 0).')
+    parser.add_argument('--threads', metavar='INT', type=int, default=1,
+                        help='Specify the number of CPU in parallel (default: 1).')
+    parser.add_argument('--reference_fasta', metavar='PATH', default=None,
+                        help='Sequences to sample queries from (default: sequences of the BLAST database).')
+    parser.add_argument('--baseline', metavar='JSON FILE', default=None,
+                        help='Compare the results with a previous benchmark.')
+    parser.add_argument('--intermediate_dir', metavar='PATH', required=False, default=None,
+                        help='Store synthetic datasets and intermediate files in this directory.')
+    parser.add_argument('--startup', action='store_true',
+                        help='Only measure the start-up time of the command line (import time).')
+    parser.add_argument('--max_startup_ms', metavar='FLOAT', type=float, default=None,
+                        help='Exit with an error if importing the command line takes longer\n'
+                             'or loads a prediction backend (default: no limit).')
+    args = parser.parse_args()
+
+    startup = measure_startup()
+    for name, result in startup.items():
+        print(f'Start-up ({name}): {result["import_ms"]:.1f} ms imports, {result["wall_ms"]:.1f} ms wall'
+              + (f', loads {" ".join(result["lazy_modules"])}' if result['lazy_modules'] else ''))
+    runs = [] if args.startup else run_benchmark(args)
+
+    results = dict(environment(), threads=args.threads, mutation_rate=args.mutation_rate,
+                   read_length=args.read_length, seed=args.seed, startup=startup, runs=runs)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            print_comparison(json.load(f), results)
+    if args.max_startup_ms is not None:
+        check_startup(startup, args.max_startup_ms)
+    return
+
+### func ###
+def run_benchmark(args: argparse.Namespace) -> List[Dict]:
+    """Run each method on synthetic datasets of each size."""
+    with get_intermediate_dir(args.intermediate_dir) as work_dir:
+        reference_fasta = args.reference_fasta
+        if reference_fasta is None:
+            reference_fasta = os.path.join(work_dir, 'reference.fasta')
+            export_blastdb(default.ref_blastdb, reference_fasta)
+        references = [seq for _, seq in read_fasta(reference_fasta)]
+
+        runs = []
+        for n_seqs in sorted(args.sizes):
+            query_fasta = os.path.join(work_dir, f'synthetic_{n_seqs}.fasta')
+            write_fasta(synthetic_sequences(references, n_seqs, mutation_rate=args.mutation_rate,
+                                            read_length=args.read_length, seed=args.seed),
+                        query_fasta)
+            for method in args.method:
+                run_dir = os.path.join(work_dir, f'{method}_{n_seqs}')
+                os.makedirs(run_dir, exist_ok=True)
+                print(f'Benchmark {method}-based prediction of {n_seqs} sequences.')
+                run = run_isolated(query_fasta, run_dir, method, args.threads)
+                run.update(method=method, n_seqs=n_seqs)
+                runs.append(run)
+                print(f'  {run["status"]}: {run["wall"]:.2f} s, peak RSS {run["peak_rss_mb"]:.0f} MB')
+    return runs
+
+def measure_startup(repeats: int = 5) -> Dict:
+    """
+    Import time (sum of -X importtime self times) and wall time of each start-up command,
+    the fastest of repeats fresh interpreters, and the LAZY_MODULES it loads.
+    """
+    results = {}
+    for name, code in STARTUP_COMMANDS.items():
+        best = None
+        for _ in range(repeats):
+            start = time.perf_counter()
+            process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                                     capture_output=True, text=True)
+            wall = time.perf_counter() - start
+            import_us, modules = 0, set()
+            for line in process.stderr.splitlines():
+                if not line.startswith('import time:') or 'self [us]' in line:
+                    continue
+                self_us, _, module = line[len('import time:'):].split('|')
+                import_us += int(self_us)
+                modules.add(module.strip().split('.')[0])
+            if best is None or wall * 1000 < best['wall_ms']:
+                best = dict(wall_ms=wall * 1000, import_ms=import_us / 1000,
+                            lazy_modules=[module for module in LAZY_MODULES if module in modules])
+        results[name] = best
+    return results
+
+def check_startup(startup: Dict, max_startup_ms: float) -> None:
+    """Exit with an error if a start-up command is slower than max_startup_ms or loads a backend."""
+    errors = []
+    for name, result in startup.items():
+        if result['import_ms'] > max_startup_ms:
+            errors.append(f'{name} imports take {result["import_ms"]:.1f} ms (limit {max_startup_ms:.1f} ms)')
+        if result['lazy_modules']:
+            errors.append(f'{name} loads {" ".join(result["lazy_modules"])}')
+    if errors:
+        sys.exit('Start-up regression: ' + '; '.join(errors) + '.')
+    return
+
+def export_blastdb(ref_blastdb: str, out_fasta: str) -> None:
+    """Write the sequences of a BLAST database to a FASTA file."""
+    cmd = ['blastdbcmd', '-db', ref_blastdb, '-entry', 'all', '-out', out_fasta]
+    subprocess.run(cmd, check=True)
+    return
+
+def synthetic_sequences(
+    references: List[str], n_seqs: int, mutation_rate: float,
+    read_length: Optional[int] = None, seed: int = 0) -> Iterator[Tuple[str, str]]:
+    """
+    Sample reference sequences with replacement and mutate them with substitutions
+    (at mutation_rate per base) and single-base insertions and deletions
+    (each at a tenth of mutation_rate). Yields (ID, sequence) pairs.
+    """
+    rng = np.random.default_rng([seed, n_seqs])
+    bases = np.frombuffer(b'ACGTN', dtype=np.uint8)
+    base_codes = np.full(256, 4, dtype=np.int64)
+    base_codes[bases[:4]] = np.arange(4)
+    indel_rate = mutation_rate / 10
+    for i, ref in enumerate(rng.integers(len(references), size=n_seqs)):
+        codes = base_codes[np.frombuffer(references[ref].upper().encode(), dtype=np.uint8)]
+        if read_length is not None and len(codes) > read_length:
+            start = rng.integers(len(codes) - read_length + 1)
+            codes = codes[start:start + read_length]
+        r = rng.random(len(codes))
+        # Substitution by one of the three other bases
+        substituted = (r < mutation_rate) & (codes < 4)
+        codes[substituted] = (codes[substituted] + rng.integers(1, 4, substituted.sum())) % 4
+        # Deleted bases are repeated zero times, and a base is inserted after repeated ones
+        deleted = (r >= mutation_rate) & (r < mutation_rate + indel_rate)
+        inserted = (r >= mutation_rate + indel_rate) & (r < mutation_rate + 2 * indel_rate)
+        repeats = 1 - deleted + inserted
+        mutated = np.repeat(codes, repeats)
+        mutated[np.cumsum(repeats)[inserted] - 1] = rng.integers(4, size=inserted.sum())
+        yield f'synthetic_{i + 1}', bases[mutated].tobytes().decode()
+
+def run_isolated(query_fasta: str, run_dir: str, method: str, threads: int) -> Dict:
+    """
+    Run one prediction in a fresh process so that its peak RSS is measured alone.
+    Raises RuntimeError if the process dies without reporting a result.
+    """
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    process = context.Process(target=run_prediction, args=(query_fasta, run_dir, method, threads, result_queue))
+    process.start()
+    while True:
+        try:
+            result = result_queue.get(timeout=RESULT_POLL_INTERVAL)
+            break
+        except queue.Empty:
+            if process.is_alive():
+                continue
+        # The result may arrive just before the process exits
+        process.join()
+        try:
+            result = result_queue.get_nowait()
+            break
+        except queue.Empty:
+            raise RuntimeError(f'Benchmark of {method} ({query_fasta}) exited with code '
+                               f'{process.exitcode} without a result.')
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f'Benchmark of {method} ({query_fasta}) exited with code {process.exitcode}.')
+    return result
+
+def run_prediction(query_fasta: str, run_dir: str, method: str, threads: int, queue) -> None:
+    """Predict traits of query_fasta and report stage timings and resource usage."""
+    from bac2feature.cmd.bac2feature import predict_batch
+    from bac2feature.core.profiling import start_recording, stop_recording
+
+    out_trait = os.path.join(run_dir, 'predicted_traits.tsv')
+    status = 'ok'
+    start_recording()
+    start = time.perf_counter()
+    try:
+        predict_batch(input_fasta=query_fasta, out_trait=out_trait, work_dir=run_dir,
+                      estimation_method=method, threads=threads,
+                      check_nsti=False, filter_by_nsti=True, hsp_backend='python',
+                      taxonomy_backend='sklearn', ref_trait=default.ref_trait,
+                      ref_blastdb=default.ref_blastdb, ref_nb_classifier=default.ref_nb_classifier,
+                      ref_trait_taxonomy=default.ref_trait_taxonomy, qiime_env=default.qiime_env,
+                      ref_dir_placement=default.ref_dir_placement)
+    except Exception as e:
+        status = f'error: {e}'
+    wall = time.perf_counter() - start
+    stages = stop_recording()
+
+    n_predicted = 0
+    if os.path.exists(out_trait):
+        with open(out_trait) as f:
+            n_predicted = max(0, sum(1 for _ in f) - 1)
+    # ru_maxrss is in kilobytes on Linux; children are external tools (blastn, epa-ng, ...)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    queue.put(dict(status=status, wall=wall, stages=stages, n_predicted=n_predicted,
+                   cpu=self_usage.ru_utime + self_usage.ru_stime
+                       + child_usage.ru_utime + child_usage.ru_stime,
+                   peak_rss_mb=self_usage.ru_maxrss / 1024,
+                   peak_child_rss_mb=child_usage.ru_maxrss / 1024))
+    return
+
+def environment() -> Dict:
+    """Commit and machine of the benchmark, to compare results across commits."""
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=default.project_dir,
+                                capture_output=True, text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return dict(commit=commit, date=datetime.datetime.now().isoformat(timespec='seconds'),
+                python=sys.version.split()[0], platform=platform.platform(),
+                cpu_count=os.cpu_count())
+
+def print_comparison(baseline: Dict, results: Dict) -> None:
+    """Print the wall time and peak RSS of each run relative to the baseline."""
+    previous = {(run['method'], run['n_seqs']): run for run in baseline['runs']}
+    print(f'Comparison with {baseline.get("commit")} (ratio of new to baseline):')
+    for name, result in results.get('startup', {}).items():
+        base = baseline.get('startup', {}).get(name)
+        if base is not None and base['import_ms'] > 0:
+            print(f'  start-up ({name})  imports {result["import_ms"] / base["import_ms"]:.2f}x')
+    for run in results['runs']:
+        base = previous.get((run['method'], run['n_seqs']))
+        if base is None or base['wall'] == 0:
+            continue
+        print(f'  {run["method"]:<10} {run["n_seqs"]:>8}  wall {run["wall"] / base["wall"]:.2f}x'
+              f'  peak RSS {run["peak_rss_mb"] / max(base["peak_rss_mb"], 1e-9):.2f}x')
+        base_stages = {}
+        for record in base['stages']:
+            base_stages[record['name']] = base_stages.get(record['name'], 0) + record['wall']
+        stages = {}
+        for record in run['stages']:
+            stages[record['name']] = stages.get(record['name'], 0) + record['wall']
+        for name, wall in stages.items():
+            if base_stages.get(name):
+                print(f'    {name:<28} {wall / base_stages[name]:.2f}x')
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,16 @@
+### Library ###
+import sys
+
+### Bac2Feature ###
+from bac2feature.cmd.build_index import main as build_index_main
+
+def main():
+    """
+    Precompute hidden state prediction of the reference tree for the phylogeny-based prediction.
+    Kept as an alias of: bac2feature build-index --sections hsp [options]
+    """
+    build_index_main(['--sections', 'hsp'] + sys.argv[1:])
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,89 @@
+### Library ###
+import argparse
+from os.path import exists
+import subprocess
+
+### Bac2Feature ###
+import bac2feature.core.default as default
+from bac2feature.core.homology_based_prediction import trait_index_arrays
+from bac2feature.core.hsp import hsp_reference_arrays
+from bac2feature.core.kmer_index import build_kmer_index, kmer_index_dir
+from bac2feature.core.phylogeny_based_prediction import threshold_index_arrays
+from bac2feature.core.ref_index import write_ref_index
+from bac2feature.core.taxonomy_based_prediction import emp_table_arrays
+
+# Parts of the reference index (kmer is stored alongside the BLAST database)
+INDEX_SECTIONS = ['trait', 'threshold', 'taxonomy', 'hsp', 'kmer']
+
+def main(argv=None):
+    ### Parser ###
+    parser = argparse.ArgumentParser(
+        prog='bac2feature build-index',
+        description="This command compiles the reference data into an index of binary arrays\n"
+                    "that bac2feature memory-maps instead of parsing the text files on every run.\n"
+                    "The index records the content of the files it was built from and is ignored\n"
+                    "once they change, so rerun it whenever the reference data changes.",
+        epilog='''
+Usage example:
+bac2feature build-index
+bac2feature build-index -o /shared/ref_index   # use with BAC2FEATURE_REF_INDEX=/shared/ref_index
+bac2feature build-index --ref_fasta ref_seqs.fasta   # k-mer index without blastdbcmd
+bac2feature build-index --sections hsp   # after a change of the reference tree only
+''',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    parser.add_argument('-o', '--output', metavar='DIR', required=False, default=default.ref_index,
+                        help='Output directory of the reference index (default: %(default)s).')
+    parser.add_argument('--ref_trait', metavar='PATH', required=False, default=default.ref_trait,
+                        help='Reference trait table (default: bundled reference).')
+    parser.add_argument('--threshold', metavar='PATH', required=False, default=default.threshold_phylodistance,
+                        help='NSTI threshold table (default: bundled reference).')
+    parser.add_argument('--ref_trait_taxonomy', metavar='PATH', required=False, default=default.ref_trait_taxonomy,
+                        help='Empirical trait distributions for taxonomy-based prediction (default: bundled reference).')
+    parser.add_argument('--tree', metavar='PATH', required=False, default=default.tree,
+                        help='Reference tree in newick format (default: bundled reference).')
+    parser.add_argument('--ref_blastdb', metavar='PATH', required=False, default=default.ref_blastdb,
+                        help='BLAST database; its k-mer index for --kmer_prefilter is written alongside\n'
+                             '(default: bundled reference).')
+    parser.add_argument('--ref_fasta', metavar='PATH', required=False, default=None,
+                        help='Sequences of the BLAST database with the same IDs\n'
+                             '(default: exported from the database by blastdbcmd).')
+    parser.add_argument('--sections', metavar='NAME', nargs='+', choices=INDEX_SECTIONS, required=False,
+                        default=INDEX_SECTIONS,
+                        help='Sections to (re)build; other sections of an existing index are kept\n'
+                             '(default: all of %(choices)s).')
+    args = parser.parse_args(argv)
+
+    # Sections are compiled by the modules that read them; missing references are skipped
+    sections = {}
+    if 'trait' in args.sections and exists(args.ref_trait):
+        sections['trait'] = (trait_index_arrays(args.ref_trait), dict(ref_trait=args.ref_trait))
+    if 'threshold' in args.sections and exists(args.threshold):
+        sections['threshold'] = (threshold_index_arrays(args.threshold), dict(threshold=args.threshold))
+    if 'taxonomy' in args.sections and exists(args.ref_trait_taxonomy):
+        sections['taxonomy'] = (emp_table_arrays(args.ref_trait_taxonomy),
+                                dict(ref_trait_taxonomy=args.ref_trait_taxonomy))
+    if 'hsp' in args.sections and exists(args.tree) and exists(args.ref_trait):
+        sections['hsp'] = (hsp_reference_arrays(args.tree, args.ref_trait),
+                           dict(tree=args.tree, ref_trait=args.ref_trait))
+    if sections:
+        write_ref_index(args.output, sections)
+        print(f'Reference index of {", ".join(sections)} is written to {args.output}.')
+
+    if 'kmer' not in args.sections:
+        if not sections:
+            raise FileNotFoundError('No reference data found to index.')
+        return
+
+    # The k-mer index is stored alongside the BLAST database it is built from
+    try:
+        build_kmer_index(args.ref_blastdb, ref_fasta=args.ref_fasta)
+        print(f'K-mer index of {args.ref_blastdb} is written to {kmer_index_dir(args.ref_blastdb)}.')
+    except (FileNotFoundError, subprocess.CalledProcessError) as e:
+        print(f'K-mer index is not built: {e}')
+        if not sections:
+            raise FileNotFoundError('No reference data found to index.')
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+### Library ###
+import argparse
+import socket
+
+### Bac2Feature ###
+from bac2feature.core.placement import work_queue
+
+def main(argv=None):
+    ### Parser ###
+    parser = argparse.ArgumentParser(
+        prog='bac2feature placement_worker',
+        description="This command places shards of sequences submitted to a job queue directory\n"
+                    "by bac2feature --placement_queue. Run it on any node that shares the directory\n"
+                    "and the reference for phylogenetic placement at the same paths.",
+        epilog='''
+Usage example:
+bac2feature placement_worker --queue /shared/queue --threads 8
+bac2feature placement_worker --queue /shared/queue --threads 8 --wait 600
+''',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    required = parser.add_argument_group('required arguments')
+    required.add_argument('--queue', metavar='PATH', required=True,
+                          help='Job queue directory given to bac2feature --placement_queue.')
+    parser.add_argument('--threads', metavar='INT', type=int, required=False, default=1,
+                        help='Number of CPU used to place each shard (default: 1).')
+    parser.add_argument('--wait', metavar='SECONDS', type=float, required=False, default=0,
+                        help='Keep polling for new jobs for this long after the queue is empty (default: 0).')
+    args = parser.parse_args(argv)
+
+    n_jobs = work_queue(args.queue, threads=args.threads, wait=args.wait)
+    print(f'{n_jobs} placement jobs are done on {socket.gethostname()}.')
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+### Library ###
+import argparse
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import io
+import os
+import queue
+from socketserver import ThreadingMixIn, UnixStreamServer
+import tempfile
+import threading
+import time
+from typing import Dict, List, Tuple
+from urllib.parse import parse_qs, urlparse
+
+import pandas as pd
+
+### Bac2Feature ###
+import bac2feature.core.default as default
+from bac2feature.cmd.bac2feature import predict_batch
+from bac2feature.core.predict import HSP_BACKEND, PREDICTION_METHOD, TAXONOMY_BACKEND
+from bac2feature.core.predictor import load_references
+from bac2feature.core.utils import parse_fasta, write_fasta
+
+def main(argv=None):
+    ### Parser ###
+    parser = argparse.ArgumentParser(
+        prog='bac2feature serve',
+        description="This command runs Bac2Feature as a local prediction server.\n"
+                    "References are loaded once, and sequences of concurrent requests are\n"
+                    "predicted together in batches.\n"
+                    "POST FASTA text to /predict (query parameters: method, check_nsti, filter_by_nsti)\n"
+                    "to receive predicted traits in tsv format.",
+        epilog='''
+Usage example:
+bac2feature serve --port 8080
+curl --data-binary @rep_seqs.fasta 'http://127.0.0.1:8080/predict?method=homology'
+''',
+        formatter_class=argparse.RawTextHelpFormatter
+    )
+    # Address
+    parser.add_argument('--host', metavar='HOST', required=False, default='127.0.0.1',
+                        help='Host to listen on (default: 127.0.0.1).')
+    parser.add_argument('--port', metavar='INT', type=int, required=False, default=8080,
+                        help='Port to listen on (default: 8080).')
+    parser.add_argument('--socket', metavar='PATH', required=False, default=None,
+                        help='Listen on this Unix socket instead of host and port.')
+    # Default method of requests
+    parser.add_argument('-m', '--method', default='phylogeny', choices=PREDICTION_METHOD,
+                        help='Prediction method of requests without the method parameter (default: phylogeny).')
+    parser.add_argument('--hsp_backend', default='python', choices=HSP_BACKEND,
+                        help='Backend of hidden state prediction (default: python).')
+    parser.add_argument('--taxonomy_backend', default='sklearn', choices=TAXONOMY_BACKEND,
+                        help='Backend of taxonomic classification (default: sklearn).')
+    # Batching
+    parser.add_argument('--workers', metavar='INT', type=int, required=False, default=2,
+                        help='Number of batches predicted in parallel (default: 2).')
+    parser.add_argument('--threads', metavar='INT', type=int, required=False, default=1,
+                        help='Number of CPU used by each batch (default: 1).')
+    parser.add_argument('--max_batch_size', metavar='INT', type=int, required=False, default=5000,
+                        help='Maximum number of sequences in a batch (default: 5000).')
+    parser.add_argument('--batch_wait', metavar='SECONDS', type=float, required=False, default=0.2,
+                        help='Time to wait for more requests before predicting a batch (default: 0.2).')
+    # Prediction cache
+    parser.add_argument('--cache', metavar='PATH', required=False, default=None,
+                        help='Cache predictions in this SQLite file (default: no cache).')
+    # In-process prefilter of the homology search
+    parser.add_argument('--kmer_prefilter', metavar='FLOAT', type=float, required=False, default=None,
+                        help='Predict queries with full-length hits of at least this percent identity\n'
+                             'from the k-mer index of the BLAST database (default: off; see bac2feature -h).')
+    # References
+    parser.add_argument('--ref_dir_placement', metavar='PATH', required=False, default=default.ref_dir_placement,
+                        help='Reference for phylogenetic placement (for developer use).')
+    parser.add_argument('--ref_blastdb', metavar='PATH', required=False, default=default.ref_blastdb,
+                        help='Reference for homology search (for developer use).')
+    parser.add_argument('--ref_trait', metavar='PATH', required=False, default=default.ref_trait,
+                        help='Reference for trait prediction (for developer use).')
+
+    args = parser.parse_args(argv)
+
+    options = dict(
+        hsp_backend=args.hsp_backend, taxonomy_backend=args.taxonomy_backend,
+        ref_trait=args.ref_trait, ref_blastdb=args.ref_blastdb,
+        ref_nb_classifier=default.ref_nb_classifier, ref_trait_taxonomy=default.ref_trait_taxonomy,
+        qiime_env=default.qiime_env, ref_dir_placement=args.ref_dir_placement,
+        kmer_prefilter=args.kmer_prefilter, cache_path=args.cache)
+    server = PredictionServer(options=options, default_method=args.method, threads=args.threads,
+                              workers=args.workers, max_batch_size=args.max_batch_size,
+                              batch_wait=args.batch_wait)
+    serve(server, host=args.host, port=args.port, socket_path=args.socket)
+    return
+
+### class ###
+class PredictionServer:
+    """
+    Batches prediction requests and runs them on a pool of workers.
+
+    Requests with the same method and options are merged into one batch
+    (up to max_batch_size sequences or batch_wait seconds after the first
+    request) so that BLAST, placement or classification runs once per batch.
+    """
+    def __init__(self, options: dict, default_method: str, threads: int,
+                 workers: int, max_batch_size: int, batch_wait: float):
+        self.options = options
+        self.default_method = default_method
+        self.threads = threads
+        self.max_batch_size = max_batch_size
+        self.batch_wait = batch_wait
+        self.requests = queue.Queue()
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.warm_up()
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+
+    def warm_up(self) -> None:
+        """Load references of all methods in memory before the first request."""
+        for method in PREDICTION_METHOD:
+            load_references(method, **self.options)
+        return
+
+    def submit(self, fasta_text: str, method: str, check_nsti: bool, filter_by_nsti: bool) -> Future:
+        """Queue sequences for prediction. The future returns predicted traits in tsv format."""
+        if method not in PREDICTION_METHOD:
+            raise ValueError(f'Unknown method: {method}')
+        records = list(parse_fasta(io.StringIO(fasta_text)))
+        if not records:
+            raise ValueError('No sequence in the request.')
+        future = Future()
+        self.requests.put(((method, check_nsti, filter_by_nsti), records, future))
+        return future
+
+    def _batch_loop(self) -> None:
+        pending: Dict[tuple, List[Tuple[list, Future]]] = {}
+        deadlines: Dict[tuple, float] = {}
+        while True:
+            # Wait for a request until the nearest batch deadline
+            timeout = max(0.0, min(deadlines.values()) - time.monotonic()) if deadlines else None
+            try:
+                key, records, future = self.requests.get(timeout=timeout)
+                pending.setdefault(key, []).append((records, future))
+                deadlines.setdefault(key, time.monotonic() + self.batch_wait)
+            except queue.Empty:
+                pass
+            # Dispatch batches that are full or waited long enough
+            now = time.monotonic()
+            for key in list(pending):
+                n_seqs = sum(len(records) for records, _ in pending[key])
+                if n_seqs >= self.max_batch_size or deadlines[key] <= now:
+                    self.pool.submit(self._run_batch, key, pending.pop(key))
+                    deadlines.pop(key)
+
+    def _run_batch(self, key: tuple, batch: List[Tuple[list, Future]]) -> None:
+        method, check_nsti, filter_by_nsti = key
+        try:
+            with tempfile.TemporaryDirectory() as work_dir:
+                # Rename sequences so that IDs of different requests do not collide
+                batch_fasta = os.path.join(work_dir, 'batch.fasta')
+                batch_trait = os.path.join(work_dir, 'batch_traits.tsv')
+                write_fasta(((f'r{i}_s{j}', seq) for i, (records, _) in enumerate(batch)
+                             for j, (_, seq) in enumerate(records)), batch_fasta)
+                predict_batch(input_fasta=batch_fasta, out_trait=batch_trait, work_dir=work_dir,
+                              estimation_method=method, threads=self.threads,
+                              check_nsti=check_nsti, filter_by_nsti=filter_by_nsti, **self.options)
+                if os.path.exists(batch_trait):
+                    predictions = pd.read_csv(batch_trait, sep='\t', dtype=str, keep_default_na=False)
+                else:
+                    predictions = pd.DataFrame({'sequence': pd.Series(dtype=object)})
+
+            # Split results by request and restore the original IDs
+            request_index = predictions['sequence'].str.extract(r'^r(\d+)_s(\d+)$').astype(int)
+            results = []
+            for i, (records, _) in enumerate(batch):
+                rows = predictions[(request_index[0] == i).to_numpy()].copy()
+                rows['sequence'] = [records[j][0] for j in request_index.loc[rows.index, 1]]
+                results.append(rows.to_csv(sep='\t', index=False))
+        except Exception as e:
+            # Every request is answered, also when splitting the results fails
+            for _, future in batch:
+                future.set_exception(e)
+            return
+
+        for (_, future), result in zip(batch, results):
+            future.set_result(result)
+        return
+
+class RequestHandler(BaseHTTPRequestHandler):
+    """HTTP interface of PredictionServer."""
+    prediction_server: PredictionServer = None
+
+    def do_GET(self):
+        if urlparse(self.path).path == '/health':
+            self._respond(200, 'ok\n')
+        else:
+            self._respond(404, 'Not found\n')
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != '/predict':
+            self._respond(404, 'Not found\n')
+            return
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0))).decode()
+        try:
+            future = self.prediction_server.submit(
+                fasta_text=body,
+                method=params.get('method', self.prediction_server.default_method),
+                check_nsti=params.get('check_nsti', '0') in ('1', 'true'),
+                filter_by_nsti=params.get('filter_by_nsti', '1') in ('1', 'true'))
+        except ValueError as e:
+            self._respond(400, f'{e}\n')
+            return
+        try:
+            self._respond(200, future.result(), content_type='text/tab-separated-values')
+        except Exception as e:
+            self._respond(500, f'Prediction failed: {e}\n')
+
+    def address_string(self):
+        # Unix socket clients have no host address
+        return self.client_address[0] if isinstance(self.client_address, tuple) and self.client_address else 'unix'
+
+    def _respond(self, status: int, text: str, content_type='text/plain') -> None:
+        data = text.encode()
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+class ThreadingUnixHTTPServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+### func ###
+def serve(server: PredictionServer, host: str, port: int, socket_path=None) -> None:
+    """Serve prediction requests until interrupted."""
+    RequestHandler.prediction_server = server
+    if socket_path is not None:
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        httpd = ThreadingUnixHTTPServer(socket_path, RequestHandler)
+        print(f'Bac2Feature server listening on {socket_path}')
+    else:
+        httpd = ThreadingHTTPServer((host, port), RequestHandler)
+        print(f'Bac2Feature server listening on http://{host}:{port}')
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
+        if socket_path is not None and os.path.exists(socket_path):
+            os.remove(socket_path)
+    return
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+### library ###
+import hashlib
+import json
+import os
+import sqlite3
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bac2feature.core.checkpoint import reference_files
+from bac2feature.core.utils import file_sha1
+
+### class ###
+class PredictionCache:
+    """
+    Persistent cache of predicted trait rows in a SQLite file.
+
+    Rows are keyed by a hash of the sequence and a context (method, hashes of the
+    reference data and prediction options), so a cached row is reused only when
+    the same sequence is predicted again under the same conditions. Sequences
+    without any prediction are cached as such. Homology-based prediction caches
+    the BLAST hits of each sequence instead, as its predictions depend on the hits
+    of the whole batch. When the cache grows beyond
+    max_size_mb, least recently used rows are evicted.
+    """
+    def __init__(self, cache_path: str, max_size_mb: float = 1024):
+        self.cache_path = cache_path
+        self.max_size = int(max_size_mb * 1024 * 1024)
+        self.hits = 0
+        self.misses = 0
+        self.conn = sqlite3.connect(cache_path, timeout=600)
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS predictions ('
+                              'key TEXT PRIMARY KEY, columns TEXT, row TEXT, '
+                              'size INTEGER, last_used REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS predictions_last_used ON predictions (last_used)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS file_digests ('
+                              'path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, digest TEXT)')
+            self.conn.execute('CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)')
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def context(self, method: str, references: List[str], options: Dict) -> str:
+        """
+        Hash of the method, the contents of the reference files and the options.
+        references may be files, directories or BLAST database prefixes.
+        """
+        digests = {ref: self.reference_digest(ref) for ref in references}
+        payload = json.dumps({'method': method, 'references': digests, 'options': options}, sort_keys=True)
+        return hashlib.sha1(payload.encode()).hexdigest()
+
+    def reference_digest(self, reference: str) -> str:
+        """Hash of the reference file(s). File hashes are memoized by size and mtime."""
+        sha1 = hashlib.sha1()
+        for file_path in reference_files(reference):
+            sha1.update(os.path.basename(file_path).encode())
+            sha1.update(self.file_digest(file_path).encode())
+        return sha1.hexdigest()
+
+    def file_digest(self, file_path: str) -> str:
+        file_path = os.path.abspath(file_path)
+        stat = os.stat(file_path)
+        found = self.conn.execute('SELECT digest FROM file_digests WHERE path = ? AND size = ? AND mtime_ns = ?',
+                                  (file_path, stat.st_size, stat.st_mtime_ns)).fetchone()
+        if found is not None:
+            return found[0]
+        digest = file_sha1(file_path)
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO file_digests VALUES (?, ?, ?, ?)',
+                              (file_path, stat.st_size, stat.st_mtime_ns, digest))
+        return digest
+
+    @staticmethod
+    def key(context: str, sequence: str) -> str:
+        return hashlib.sha1(f'{context}\n{sequence.upper()}'.encode()).hexdigest()
+
+    def get_many(self, context: str, sequences: Iterable[str]) -> Dict[str, Tuple[List[str], Optional[List[str]]]]:
+        """
+        Look up cached rows. Returns {sequence: (columns, row)} for cached
+        sequences, where row is None if the sequence had no prediction.
+        """
+        found = {}
+        keys = {self.key(context, seq): seq for seq in set(sequences)}
+        key_list = list(keys)
+        # Stay below the SQLite limit of variables per statement
+        for i in range(0, len(key_list), 500):
+            batch = key_list[i:i + 500]
+            placeholders = ','.join('?' * len(batch))
+            for key, columns, row in self.conn.execute(
+                    f'SELECT key, columns, row FROM predictions WHERE key IN ({placeholders})', batch):
+                found[keys[key]] = (json.loads(columns), None if row is None else json.loads(row))
+        with self.conn:
+            now = time.time()
+            self.conn.executemany('UPDATE predictions SET last_used = ? WHERE key = ?',
+                                  [(now, self.key(context, seq)) for seq in found])
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+        return found
+
+    def put_many(self, context: str, columns: List[str], rows: Dict[str, Optional[List[str]]]) -> None:
+        """Store {sequence: row} (row is None if the sequence had no prediction)."""
+        now = time.time()
+        columns_json = json.dumps(columns)
+        records = []
+        for seq, row in rows.items():
+            row_json = None if row is None else json.dumps(row)
+            size = len(columns_json) + (0 if row_json is None else len(row_json)) + 40
+            records.append((self.key(context, seq), columns_json, row_json, size, now))
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO predictions VALUES (?, ?, ?, ?, ?)', records)
+        self.evict()
+        return
+
+    def evict(self) -> None:
+        """Remove least recently used rows until the cache fits in max_size."""
+        total = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM predictions').fetchone()[0]
+        if total <= self.max_size:
+            return
+        # Evict down to 90% of the limit to avoid evicting at every insertion
+        excess = total - int(self.max_size * 0.9)
+        with self.conn:
+            self.conn.execute(
+                'DELETE FROM predictions WHERE key IN ('
+                'SELECT key FROM (SELECT key, size, SUM(size) OVER (ORDER BY last_used, key) AS cum '
+                'FROM predictions) WHERE cum - size < ?)',
+                (excess,))
+        return
+
+    def record_stats(self) -> None:
+        """Add the hits and misses of this session to the cumulative statistics."""
+        with self.conn:
+            for name, value in (('hits', self.hits), ('misses', self.misses)):
+                self.conn.execute('INSERT OR IGNORE INTO stats VALUES (?, 0)', (name,))
+                self.conn.execute('UPDATE stats SET value = value + ? WHERE name = ?', (value, name))
+        return
+
+    def stats(self) -> Dict[str, int]:
+        """Cumulative hits and misses, number of cached rows and their size in bytes."""
+        stats = dict(self.conn.execute('SELECT name, value FROM stats').fetchall())
+        n_rows, size = self.conn.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM predictions').fetchone()
+        return {'hits': stats.get('hits', 0), 'misses': stats.get('misses', 0),
+                'rows': n_rows, 'size': size}
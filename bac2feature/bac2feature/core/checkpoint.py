@@ -0,0 +1,131 @@
+### library ###
+import glob
+import hashlib
+import json
+import os
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from bac2feature.core.utils import file_sha1
+
+CHECKPOINT_VERSION = 1
+# Checkpointed stages of each method in pipeline order (see --force_from)
+METHOD_STAGES = {'homology': ['blastn'], 'taxonomy': ['classify'], 'phylogeny': ['placement', 'hsp']}
+CHECKPOINT_STAGES = [name for names in METHOD_STAGES.values() for name in names]
+
+### class ###
+class Checkpoint:
+    """
+    Manifest of a stage whose outputs are kept in the intermediate directory.
+
+    The manifest records content hashes of the inputs of the stage (files or records),
+    of its reference files and its parameters. When a run with the same intermediate
+    directory finds a matching manifest and intact outputs, the stage is skipped.
+    File hashes of the manifest are reused while the size and mtime of a file are unchanged.
+    Stages from force_from on (in the order of METHOD_STAGES) are always recomputed.
+    A disabled checkpoint never skips its stage and writes nothing.
+    """
+    def __init__(self, intermediate_dir: str, name: str, outputs: List[str],
+                 inputs: Optional[Dict[str, str]] = None, references: Optional[Dict[str, str]] = None,
+                 records: Optional[Iterable[Tuple[str, str]]] = None, params: Optional[dict] = None,
+                 force_from: Optional[str] = None, enabled: bool = True):
+        self.name = name
+        self.manifest_path = os.path.join(intermediate_dir, f'{name}.checkpoint.json')
+        self.outputs = outputs
+        self.inputs = inputs or {}
+        self.references = references or {}
+        self.records = records
+        self.params = params or {}
+        self.forced = is_forced(name, force_from)
+        self.enabled = enabled
+        self.key = None
+        self.files = {}
+
+    def done(self) -> bool:
+        """Whether the outputs of a previous run are reused. A stale manifest is removed."""
+        if not self.enabled:
+            return False
+        previous = read_manifest(self.manifest_path)
+        self.key = self._key(previous.get('files', {}) if previous else {})
+        if not self.forced and previous is not None and previous.get('key') == self.key \
+                and all(os.path.exists(path) and os.path.getsize(path) == previous['outputs'].get(os.path.basename(path))
+                        for path in self.outputs):
+            print(f'Checkpoint: {self.name} is reused ({self.manifest_path}).')
+            return True
+        # Removed before the outputs are rewritten, so that an interrupted stage is never reused
+        if os.path.exists(self.manifest_path):
+            os.remove(self.manifest_path)
+        return False
+
+    def save(self) -> None:
+        """Record the stage as complete once its outputs are written."""
+        if not self.enabled:
+            return
+        if self.key is None:
+            self.key = self._key({})
+        manifest = {'stage': self.name, 'key': self.key, 'files': self.files,
+                    'outputs': {os.path.basename(path): os.path.getsize(path) for path in self.outputs}}
+        with open(f'{self.manifest_path}.tmp', 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(f'{self.manifest_path}.tmp', self.manifest_path)
+        return
+
+    def _key(self, known_files: dict) -> dict:
+        digests = {}
+        for label, path in self.inputs.items():
+            digests[label] = self._file_digest(path, known_files)
+        for label, reference in self.references.items():
+            sha1 = hashlib.sha1()
+            for path in reference_files(reference):
+                sha1.update(os.path.basename(path).encode())
+                sha1.update(self._file_digest(path, known_files).encode())
+            digests[label] = sha1.hexdigest()
+        if self.records is not None:
+            digests['records'] = records_sha1(self.records)
+        key = {'version': CHECKPOINT_VERSION, 'inputs': digests, 'params': self.params}
+        # As read back from the manifest
+        return json.loads(json.dumps(key, sort_keys=True))
+
+    def _file_digest(self, path: str, known_files: dict) -> str:
+        path = os.path.abspath(path)
+        stat = os.stat(path)
+        known = known_files.get(path)
+        if known is not None and known[:2] == [stat.st_size, stat.st_mtime_ns]:
+            digest = known[2]
+        else:
+            digest = file_sha1(path)
+        self.files[path] = [stat.st_size, stat.st_mtime_ns, digest]
+        return digest
+
+### func ###
+def is_forced(name: str, force_from: Optional[str]) -> bool:
+    """Whether stage name is recomputed with --force_from force_from."""
+    for stages in METHOD_STAGES.values():
+        if name in stages and force_from in stages:
+            return stages.index(name) >= stages.index(force_from)
+    return False
+
+def read_manifest(manifest_path: str) -> Optional[dict]:
+    if not os.path.exists(manifest_path):
+        return None
+    try:
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+    except ValueError:
+        return None
+    return manifest if isinstance(manifest, dict) and 'outputs' in manifest else None
+
+def reference_files(reference: str) -> List[str]:
+    """Files of a reference given as a file, a directory or a BLAST database prefix."""
+    if os.path.isdir(reference):
+        files = sorted(glob.glob(os.path.join(reference, '*')))
+    elif os.path.isfile(reference):
+        files = [reference]
+    else:
+        files = sorted(glob.glob(reference + '.*'))
+    return [file_path for file_path in files if os.path.isfile(file_path)]
+
+def records_sha1(records: Iterable[Tuple[str, str]]) -> str:
+    sha1 = hashlib.sha1()
+    for seq_id, seq in records:
+        sha1.update(f'>{seq_id}\n{seq}\n'.encode())
+    return sha1.hexdigest()
@@ -0,0 +1,143 @@
+### library ###
+import json
+from typing import Iterator, List, Tuple
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+
+from bac2feature.core.table import PredictionWriter
+
+HDF5_MAGIC = b'\x89HDF\r\n\x1a\n'
+# Metadata columns of tsv feature tables exported from BIOM files
+METADATA_COLUMNS = ['taxonomy']
+
+### main func ###
+def write_community_traits(
+    predictions: pd.DataFrame, feature_table: str, out_path: str, out_format: str = 'tsv',
+    block_size: int = 1000) -> None:
+    """
+    Write community-weighted mean traits of each sample of a feature table.
+    Samples are processed and written in blocks of block_size.
+    """
+    n_samples = 0
+    with PredictionWriter(out_path, out_format) as writer:
+        for traits in community_traits(predictions, feature_table, block_size=block_size):
+            writer.write(traits)
+            n_samples += len(traits)
+    print(f'Community-weighted traits of {n_samples} samples are written to {out_path}.')
+    return
+
+### func ###
+def community_traits(
+    predictions: pd.DataFrame, feature_table: str, block_size: int = 1000) -> Iterator[pd.DataFrame]:
+    """
+    Community-weighted mean traits per sample, in blocks of samples.
+
+    For each trait, the abundances of features with a predicted value are the weights,
+    so features without a prediction (e.g. filtered by NSTI) do not dilute the mean.
+    Categorical traits are 0/1 indicators, so their mean is the abundance fraction
+    of the category. NSTI and percent identity columns give weighted means of those.
+    """
+    trait_cols = list(predictions.columns[1:])
+    values = known = None
+    for feature_ids, sample_ids, counts in iter_feature_table(feature_table, block_size):
+        if values is None:
+            values, known = align_traits(predictions, feature_ids)
+            n_found = int(known.any(axis=1).sum())
+            print(f'{n_found} of {len(feature_ids)} features in the feature table have predictions.')
+        # Sparse (samples x features) by dense (features x traits) products
+        weighted = np.asarray(counts.T @ values)
+        total = np.asarray(counts.T @ known)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.where(total > 0, weighted / total, np.nan)
+        traits = pd.DataFrame(means, columns=trait_cols)
+        traits.insert(0, 'sample', np.asarray(sample_ids, dtype=object))
+        yield traits
+
+def align_traits(predictions: pd.DataFrame, feature_ids: List[str]) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Trait values (0 where unknown) and known-value indicators in the order of feature_ids.
+    """
+    rows = pd.Index(predictions['sequence']).get_indexer(feature_ids)
+    values = np.column_stack([predictions[col].to_numpy(dtype=np.float64, na_value=np.nan)
+                              for col in predictions.columns[1:]])
+    values = np.vstack([values, np.full((1, values.shape[1]), np.nan)])[rows]
+    known = ~np.isnan(values)
+    return np.where(known, values, 0.0), known.astype(np.float64)
+
+def iter_feature_table(
+    feature_table: str, block_size: int = 1000) -> Iterator[Tuple[List[str], List[str], sparse.csc_matrix]]:
+    """
+    Read a feature table (BIOM 2 HDF5, BIOM 1 JSON or tsv with features in rows)
+    as (feature IDs, sample IDs of the block, sparse features x samples counts)
+    for blocks of block_size samples. BIOM 2 files are read one block at a time.
+    """
+    with open(feature_table, 'rb') as f:
+        head = f.read(len(HDF5_MAGIC))
+    if head == HDF5_MAGIC:
+        yield from iter_biom_hdf5(feature_table, block_size)
+        return
+    if head.lstrip().startswith(b'{'):
+        feature_ids, sample_ids, counts = read_biom_json(feature_table)
+    else:
+        feature_ids, sample_ids, counts = read_feature_tsv(feature_table)
+    for start in range(0, len(sample_ids), block_size):
+        yield feature_ids, sample_ids[start:start + block_size], counts[:, start:start + block_size]
+
+def iter_biom_hdf5(
+    feature_table: str, block_size: int) -> Iterator[Tuple[List[str], List[str], sparse.csc_matrix]]:
+    """Read blocks of samples from the compressed sparse column matrix of a BIOM 2 file."""
+    import h5py
+
+    with h5py.File(feature_table, 'r') as biom:
+        feature_ids = [i.decode() if isinstance(i, bytes) else str(i) for i in biom['observation/ids'][:]]
+        sample_ids = [i.decode() if isinstance(i, bytes) else str(i) for i in biom['sample/ids'][:]]
+        indptr = biom['sample/matrix/indptr'][:]
+        for start in range(0, len(sample_ids), block_size):
+            end = min(start + block_size, len(sample_ids))
+            lo, hi = indptr[start], indptr[end]
+            counts = sparse.csc_matrix((biom['sample/matrix/data'][lo:hi],
+                                        biom['sample/matrix/indices'][lo:hi],
+                                        indptr[start:end + 1] - lo),
+                                       shape=(len(feature_ids), end - start), dtype=np.float64)
+            yield feature_ids, sample_ids[start:end], counts
+
+def read_biom_json(feature_table: str) -> Tuple[List[str], List[str], sparse.csc_matrix]:
+    """Read a BIOM 1 (JSON) feature table."""
+    with open(feature_table) as f:
+        biom = json.load(f)
+    feature_ids = [str(row['id']) for row in biom['rows']]
+    sample_ids = [str(column['id']) for column in biom['columns']]
+    shape = (len(feature_ids), len(sample_ids))
+    if biom.get('matrix_type') == 'dense':
+        counts = sparse.csc_matrix(np.asarray(biom['data'], dtype=np.float64).reshape(shape))
+    else:
+        data = np.asarray(biom['data'], dtype=np.float64).reshape(-1, 3)
+        counts = sparse.csc_matrix((data[:, 2], (data[:, 0].astype(np.int64), data[:, 1].astype(np.int64))),
+                                   shape=shape)
+    return feature_ids, sample_ids, counts
+
+def read_feature_tsv(feature_table: str, chunk_size: int = 10000) -> Tuple[List[str], List[str], sparse.csc_matrix]:
+    """
+    Read a tsv feature table (e.g. from biom convert --to-tsv) in chunks of features
+    into a sparse matrix. Comment lines before the header are skipped.
+    """
+    with open(feature_table) as f:
+        header = f.readline()
+        while True:
+            position = f.tell()
+            line = f.readline()
+            if not (header.startswith('#') and line.startswith('#')):
+                break
+            header = line
+        f.seek(position)
+        columns = header.rstrip('\n').split('\t')
+        sample_ids = [c for c in columns[1:] if c.lower() not in METADATA_COLUMNS]
+        feature_ids, blocks = [], []
+        for chunk in pd.read_csv(f, sep='\t', header=None, names=columns, index_col=0,
+                                 dtype={columns[0]: str}, chunksize=chunk_size):
+            feature_ids.extend(chunk.index.astype(str))
+            blocks.append(sparse.csr_matrix(chunk[sample_ids].fillna(0).to_numpy(dtype=np.float64)))
+    counts = sparse.vstack(blocks, format='csc') if blocks else sparse.csc_matrix((0, len(sample_ids)))
+    return feature_ids, sample_ids, counts
@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
 # Default setting of Bac2Feature
-from os import path
+from os import environ, path
 
 project_dir = path.dirname(path.dirname(path.abspath(__file__)))
 
@@ -11,6 +11,9 @@ b2f_core_dir = path.join(project_dir, "core")
 # Data directory
 b2f_data_dir = path.join(project_dir, "data")
 
+# Output formats of prediction tables (parquet and arrow require pyarrow)
+output_formats = ["tsv", "tsv.gz", "parquet", "arrow"]
+
 # Reference trait data
 ref_trait = path.join(b2f_data_dir, "trait_data_madin.tsv")
 
@@ -40,3 +43,6 @@ tree = path.join(ref_dir_phylogeny, "ref_phylogeny.tre")
 hmm = path.join(ref_dir_phylogeny, "ref_phylogeny.hmm")
 
 model = path.join(ref_dir_phylogeny, "ref_phylogeny.model")
+
+# Compiled reference index (created by bac2feature build-index)
+ref_index = environ.get("BAC2FEATURE_REF_INDEX", path.join(b2f_data_dir, "ref_index"))
@@ -1,10 +1,22 @@
 ### library ###
+from contextlib import contextmanager
+from functools import lru_cache
+import os
 from os.path import join
 import subprocess
+import threading
 
+import numpy as np
 import pandas as pd
 
 import bac2feature.core.default as default
+from bac2feature.core import profiling
+from bac2feature.core.checkpoint import Checkpoint
+from bac2feature.core.hsp import read_ref_trait, split_trait_types
+from bac2feature.core.profiling import stage
+from bac2feature.core.ref_index import load_section
+from bac2feature.core.table import categorical_traits, typed_predictions, write_predictions
+from bac2feature.core.utils import pipe_fasta, read_fasta
 
 ### main func ###
 def predict_by_homology(
@@ -12,85 +24,397 @@ def predict_by_homology(
     ref_blastdb=default.ref_blastdb,
     ref_trait=default.ref_trait, perc_identity=None, check_nsti=False, threads=1) -> None:
     """Predict microbial traits from fasta file by homology search."""
-    blast_result_path = join(intermediate_dir, 'bla_result.outfmt6')
-    # Homology search by BLAST
-    call_blast(ref_blastdb=ref_blastdb,
-               input_fasta=input_fasta,
-               blast_result_path=blast_result_path,
-               threads=threads
-               )
-    # Predict trait values from best hits of blast results
-    blast_result_to_trait(blast_result_path=blast_result_path,
-                          out_trait=out_trait,
-                          ref_trait=ref_trait,
-                          perc_identity=perc_identity,
-                          check_nsti=check_nsti
-                          )
+    predictions = homology_predictions(input_fasta=input_fasta,
+                                       intermediate_dir=intermediate_dir,
+                                       ref_blastdb=ref_blastdb,
+                                       ref_trait=ref_trait,
+                                       perc_identity=perc_identity,
+                                       check_nsti=check_nsti,
+                                       threads=threads)
+    write_predictions(predictions, out_trait)
     return
 
+def homology_predictions(
+    input_fasta:str, intermediate_dir:str,
+    ref_blastdb=default.ref_blastdb,
+    ref_trait=default.ref_trait, perc_identity=None, check_nsti=False, threads=1,
+    query_records=None, kmer_prefilter=None, resume=False, force_from=None) -> pd.DataFrame:
+    """
+    Predict microbial traits from fasta file by homology search as a typed table.
+    With query_records, (ID, sequence) pairs of a compressed or standard input are
+    streamed to BLASTn instead of reading input_fasta.
+    With kmer_prefilter (percent identity), queries with full-length hits of at least this
+    identity in the k-mer index of ref_blastdb are predicted from those hits without BLASTn.
+    With resume, the best hits of a previous run in intermediate_dir are reused if their
+    checkpoint matches (unless force_from is 'blastn').
+    """
+    hits, query_stats = homology_hits(input_fasta=input_fasta,
+                                      intermediate_dir=intermediate_dir,
+                                      ref_blastdb=ref_blastdb,
+                                      ref_trait=ref_trait,
+                                      perc_identity=perc_identity,
+                                      threads=threads,
+                                      query_records=query_records,
+                                      kmer_prefilter=kmer_prefilter,
+                                      resume=resume,
+                                      force_from=force_from)
+    # Predict trait values from best hits of blast results
+    with stage('homology.summarize_traits'):
+        predictions = hits_to_predictions(hits=length_cutoff(hits, query_stats),
+                                          ref_trait=ref_trait,
+                                          check_nsti=check_nsti
+                                          )
+    return predictions
+
+def homology_hits(
+    input_fasta:str, intermediate_dir:str,
+    ref_blastdb=default.ref_blastdb,
+    ref_trait=default.ref_trait, perc_identity=None, threads=1,
+    query_records=None, kmer_prefilter=None, resume=False, force_from=None):
+    """
+    Hits of each query usable for prediction before the alignment length cutoff,
+    and the alignment length sum and number of hits of each query that decide the cutoff
+    (see BlastHitReducer.reduced). With resume, they are checkpointed in intermediate_dir.
+    """
+    hits_path = join(intermediate_dir, 'blast_hits.pkl')
+    stats_path = join(intermediate_dir, 'blast_hit_stats.pkl')
+    checkpoint = Checkpoint(intermediate_dir, 'blastn', outputs=[hits_path, stats_path],
+                            inputs={'fasta': input_fasta} if query_records is None else None,
+                            records=query_records, references={'blastdb': ref_blastdb, 'trait': ref_trait},
+                            params={'perc_identity': perc_identity, 'kmer_prefilter': kmer_prefilter},
+                            force_from=force_from, enabled=resume)
+    if checkpoint.done():
+        return pd.read_pickle(hits_path), pd.read_pickle(stats_path)
+    hits, query_stats = search_hits(input_fasta=input_fasta, ref_blastdb=ref_blastdb, ref_trait=ref_trait,
+                                    perc_identity=perc_identity, threads=threads,
+                                    query_records=query_records, kmer_prefilter=kmer_prefilter)
+    if resume:
+        hits.to_pickle(hits_path)
+        query_stats.to_pickle(stats_path)
+        checkpoint.save()
+    return hits, query_stats
+
 ### func ###
-def call_blast(
-    ref_blastdb:str, input_fasta:str, blast_result_path:str, threads:int) -> None:
-    """Call BLASTn for homology search."""
+def search_hits(
+    input_fasta:str, ref_blastdb:str, ref_trait:str, perc_identity:float, threads:int,
+    query_records=None, kmer_prefilter=None):
+    """
+    Hits of the k-mer prefilter and of BLASTn reduced as they are read, before the alignment
+    length cutoff, and the statistics of each query (see BlastHitReducer.reduced).
+    """
+    trait_ids, trait_cols, trait_values, trait_known = load_trait_matrix(ref_trait)
+    reducer = BlastHitReducer(trait_ids, trait_known, perc_identity)
+    prefilter_hits = None
+    if kmer_prefilter is not None:
+        with stage('homology.kmer_prefilter'):
+            prefilter_hits, query_records = prefilter_queries(input_fasta, ref_blastdb, kmer_prefilter,
+                                                              query_records)
+    # Homology search by BLAST, reducing the hits while BLASTn writes them
+    if query_records is None or query_records:
+        with stage('homology.blastn'):
+            with stream_blast(ref_blastdb=ref_blastdb,
+                              input_fasta=input_fasta,
+                              threads=threads,
+                              query_records=query_records
+                              ) as blast_output:
+                reduce_blast_output(blast_output, reducer)
+    if prefilter_hits is not None:
+        reducer.add(prefilter_hits)
+    return reducer.reduced()
+
+def prefilter_queries(input_fasta: str, ref_blastdb: str, min_identity: float, query_records=None):
+    """
+    Hits of queries resolved by the k-mer index and the records left for BLASTn
+    (all queries if the index of ref_blastdb has not been built).
+    """
+    # Imported here: only needed with --kmer_prefilter
+    from bac2feature.core.kmer_index import kmer_prefilter, load_kmer_index
+
+    index = load_kmer_index(ref_blastdb)
+    if index is None:
+        print(f'No k-mer index of {ref_blastdb} (see bac2feature build-index); all queries are searched by BLASTn.')
+        return None, query_records
+    records = list(read_fasta(input_fasta)) if query_records is None else list(query_records)
+    hits, unresolved = kmer_prefilter(records, index, min_identity)
+    print(f'K-mer prefilter: {len(records) - len(unresolved)} of {len(records)} queries resolved, '
+          f'{len(unresolved)} searched by BLASTn.')
+    return hits, unresolved
+
+@contextmanager
+def stream_blast(ref_blastdb:str, input_fasta:str, threads:int, query_records=None):
+    """
+    Call BLASTn for homology search and yield its tabular output as a binary stream
+    (a pipe: no result file is written).
+    With query_records, the sequences are written to BLASTn through a pipe (no query file).
+    """
     cmd = ['blastn',
            '-db', ref_blastdb,
-           '-query', input_fasta,
-           '-out', blast_result_path,
+           '-query', input_fasta if query_records is None else '-',
            '-num_threads', str(threads),
            '-outfmt', '6 qseqid sseqid pident length mismatch gapopen bitscore evalue'
            ]
-    subprocess.run(cmd)
+    query_end = None
+    if query_records is not None:
+        query_end, write_end = os.pipe()
+        feeder = threading.Thread(target=pipe_fasta, args=(query_records, write_end), daemon=True)
+        feeder.start()
+    result_end, output_end = os.pipe()
+    outcome = {}
+
+    def run_blast() -> None:
+        try:
+            outcome['returncode'] = profiling.run(cmd, name='blastn', stdin=query_end,
+                                                  stdout=output_end).returncode
+        except Exception as e:
+            outcome['error'] = e
+        finally:
+            # End of the output for the reader; closing the query read end
+            # also stops the feeder if BLASTn exited early
+            os.close(output_end)
+            if query_end is not None:
+                os.close(query_end)
+    blast = threading.Thread(target=run_blast, daemon=True)
+    blast.start()
+    # Closing the output read end (also when the reader fails) stops BLASTn
+    with os.fdopen(result_end, 'rb') as blast_output:
+        yield blast_output
+    blast.join()
+    if query_records is not None:
+        feeder.join()
+    if 'error' in outcome:
+        raise outcome['error']
+    if outcome['returncode'] != 0:
+        raise subprocess.CalledProcessError(outcome['returncode'], cmd)
+    return
+
+def reduce_blast_output(blast_output, reducer: 'BlastHitReducer', chunk_size: int = 100000) -> None:
+    """Read tabular BLAST output in chunks of hits into reducer (only the columns used)."""
+    blast_cols = ['sequence', 'species_tax_id', 'pident', 'length']
+    try:
+        chunks = pd.read_csv(blast_output, sep='\t', header=None, names=blast_cols, usecols=[0, 1, 2, 3],
+                             dtype={'sequence': str, 'species_tax_id': str, 'pident': float, 'length': float},
+                             chunksize=chunk_size)
+        for chunk in chunks:
+            reducer.add(chunk)
+    except pd.errors.EmptyDataError:
+        # No hits
+        pass
     return
 
 def blast_result_to_trait(
     blast_result_path:str, out_trait:str, ref_trait:str, perc_identity:float, check_nsti:bool) -> None:
     """Predict trait values from best hits of blast results."""
-    # Load data
-    blast_cols = ['sequence', 'species_tax_id', 'pident', 'length', 'mismatch', 'gapopen', 'bitscore', 'evalue']
-    blast_result = pd.read_csv(blast_result_path, sep='\t', header=None, names=blast_cols, dtype=str)
-    trait = pd.read_csv(ref_trait, sep='\t', dtype=str)
+    predictions = blast_result_to_predictions(blast_result_path=blast_result_path,
+                                              ref_trait=ref_trait,
+                                              perc_identity=perc_identity,
+                                              check_nsti=check_nsti)
+    write_predictions(predictions, out_trait)
+    return
+
+def blast_result_to_predictions(
+    blast_result_path:str, ref_trait:str, perc_identity:float, check_nsti:bool) -> pd.DataFrame:
+    """Typed trait predictions from best hits of a blast result file."""
+    trait_ids, trait_cols, trait_values, trait_known = load_trait_matrix(ref_trait)
+    reducer = BlastHitReducer(trait_ids, trait_known, perc_identity)
+    with open(blast_result_path, 'rb') as blast_output:
+        reduce_blast_output(blast_output, reducer)
+    return hits_to_predictions(reducer.finish(), ref_trait, check_nsti)
+
+def length_cutoff(hits: pd.DataFrame, query_stats: pd.DataFrame) -> pd.DataFrame:
+    """
+    Hits at least half as long as the mean alignment length of all hits passing perc_identity,
+    given the alignment length sum and number of those hits of each query (query_stats).
+    """
+    n_hits = query_stats['n_hits'].sum()
+    if n_hits == 0:
+        return empty_hits()
+    # Exclude very short sequences based on half the average length
+    min_length = query_stats['length_sum'].sum() / n_hits * 0.5
+    return hits[hits['length'] >= min_length].reset_index(drop=True)
 
-    # Filter the blast result based on the percent identity
-    blast_result = preprocess_blast_result(blast_result, perc_identity)
+def empty_hits() -> pd.DataFrame:
+    return pd.DataFrame({'sequence': [], 'species_tax_id': [], 'pident': [], 'length': []})
 
-    # Merge with trait data
-    res_trait = pd.merge(blast_result, trait, how='left', on='species_tax_id')
+def hits_to_predictions(hits: pd.DataFrame, ref_trait:str, check_nsti:bool) -> pd.DataFrame:
+    """Typed trait predictions from filtered hits in BLAST order."""
+    trait_ids, trait_cols, trait_values, trait_known = load_trait_matrix(ref_trait)
+
+    # Join with trait data on species_tax_id codes (-1 for species without trait data)
+    species_index = trait_ids.get_indexer(to_species_codes(hits['species_tax_id']))
 
     # Summarize the predicted traits for each sequences
-    res_trait.set_index('sequence', drop=False, inplace=True)
-    summarized_trait = summarize_traits(res_trait, trait.columns[1:])
+    summarized_trait = summarize_traits(hits['sequence'].to_numpy(), species_index,
+                                        hits['pident'].to_numpy(dtype=np.float64),
+                                        trait_cols, trait_values, trait_known)
 
     # Remove pident columns if check_nsti=False
     if not check_nsti:
         pident_columns = [col for col in summarized_trait.columns if col.endswith('_pident')]
         summarized_trait = summarized_trait.drop(columns=pident_columns)
 
-    # Save
-    summarized_trait.to_csv(out_trait, sep="\t", index=False)
-    return
+    return typed_predictions(summarized_trait, categorical_traits(ref_trait))
 
-def preprocess_blast_result(blast_result: pd.DataFrame, perc_identity: float):
-    """Preprocess the data according to the alignment length and percent identity."""
-    # Convert columns to numeric
-    blast_result[['pident', 'length']] = blast_result[['pident', 'length']].astype(float)
+def load_trait_matrix(ref_trait: str):
+    """
+    Load the reference trait table once (reloaded only when the file changes),
+    memory-mapped from the reference index when it was built from this table.
+    Returns species_tax_id codes, trait names, trait values (NaN if unknown)
+    and a boolean matrix of known values.
+    """
+    return _load_trait_matrix(ref_trait, os.stat(ref_trait).st_mtime_ns)
 
-    # Filter by percentage identity, if provided
-    if perc_identity is not None:
-        blast_result = blast_result[blast_result['pident'] >= perc_identity]
+@lru_cache(maxsize=4)
+def _load_trait_matrix(ref_trait: str, mtime_ns: int):
+    index = load_section('trait', ref_trait=ref_trait)
+    if index is not None:
+        trait_ids = index['ids'] if index['ids'].dtype.kind == 'i' else index['ids'].astype(object)
+        return pd.Index(trait_ids), [str(col) for col in index['columns']], index['values'], index['known']
+    return read_trait_matrix(ref_trait)
 
-    # Exclude very short sequences based on half the average length
-    min_length = blast_result['length'].mean() * 0.5
-    blast_result = blast_result[blast_result['length'] >= min_length]
-    blast_result.reset_index()
-
-    return blast_result
-
-def summarize_traits(res_trait, trait_cols):
-    """Summarize traits for each sequence based on non-null entries."""
-    bests = [
-        res_trait.loc[res_trait[col].notnull()].drop_duplicates(subset='sequence', keep='first')[[col, 'pident']].rename(columns={'pident': f'{col}_pident'})
-        for col in trait_cols
-    ]
-    out_trait = pd.concat(bests, axis=1)
-    out_trait = pd.concat([res_trait['sequence'].drop_duplicates(keep='first'), out_trait], axis=1)
+def read_trait_matrix(ref_trait: str):
+    trait = pd.read_csv(ref_trait, sep='\t', dtype=str)
+    trait_ids = pd.Index(to_species_codes(trait['species_tax_id']))
+    trait_cols = list(trait.columns[1:])
+    trait_values = trait[trait_cols].apply(pd.to_numeric).to_numpy(dtype=np.float64)
+    trait_known = trait[trait_cols].notnull().to_numpy()
+    return trait_ids, trait_cols, trait_values, trait_known
+
+def trait_index_arrays(ref_trait: str) -> dict:
+    """Arrays of the 'trait' section of the reference index (see build-index)."""
+    trait_ids, trait_cols, trait_values, trait_known = read_trait_matrix(ref_trait)
+    trait_ids = trait_ids.to_numpy()
+    return dict(ids=trait_ids if trait_ids.dtype.kind == 'i' else trait_ids.astype(str),
+                columns=np.array(trait_cols, dtype=str),
+                values=trait_values,
+                known=trait_known,
+                categorical=np.array(split_trait_types(read_ref_trait(ref_trait))[1], dtype=str))
+
+def to_species_codes(species_tax_id: pd.Series) -> np.ndarray:
+    """Integer codes of species_tax_id, or the IDs themselves if not all integers."""
+    codes = pd.to_numeric(species_tax_id, errors='coerce')
+    if codes.isnull().any():
+        return species_tax_id.to_numpy(dtype=object)
+    return codes.to_numpy(dtype=np.int64)
+
+def summarize_traits(
+    sequences: np.ndarray, species_index: np.ndarray, pident: np.ndarray,
+    trait_cols: list, trait_values: np.ndarray, trait_known: np.ndarray, block_size=1000000) -> pd.DataFrame:
+    """
+    Summarize traits for each sequence based on non-null entries:
+    for each trait, take the value of the first hit (in BLAST order) with a known value.
+    """
+    n_hits, n_traits = len(sequences), len(trait_cols)
+    query_codes, query_names = pd.factorize(sequences)
+    n_queries = len(query_names)
+
+    # Known values of each hit (species without trait data are never known)
+    known = np.vstack([trait_known, np.zeros((1, n_traits), dtype=bool)])
+    values = np.vstack([trait_values, np.full((1, n_traits), np.nan)])
+    species_index = np.where(species_index < 0, len(trait_known), species_index)
+
+    # Position of the first hit with a known value per query and trait (n_hits if none).
+    # Hits are grouped by query and processed in blocks to bound memory.
+    first = np.full((n_queries, n_traits), n_hits, dtype=np.int64)
+    if n_hits > 0:
+        order = np.argsort(query_codes, kind='stable')
+        sorted_codes = query_codes[order]
+        starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+        block_ids = starts // block_size
+        block_bounds = np.flatnonzero(np.r_[True, block_ids[1:] != block_ids[:-1], True])
+        for b0, b1 in zip(block_bounds[:-1], block_bounds[1:]):
+            group_starts = starts[b0:b1]
+            lo, hi = group_starts[0], (starts[b1] if b1 < len(starts) else n_hits)
+            rows = order[lo:hi]
+            positions = np.where(known[species_index[rows]], rows[:, None], n_hits)
+            first[sorted_codes[group_starts]] = np.minimum.reduceat(positions, group_starts - lo, axis=0)
+
+    # Gather values and percent identities of the first hits
+    found = first < n_hits
+    hit = np.where(found, first, 0)
+    out_trait = pd.DataFrame({'sequence': query_names})
+    for j, col in enumerate(trait_cols):
+        out_trait[col] = np.where(found[:, j], values[species_index[hit[:, j]], j], np.nan)
+        out_trait[f'{col}_pident'] = np.where(found[:, j], pident[hit[:, j]], np.nan)
     return out_trait
+
+### class ###
+class BlastHitReducer:
+    """
+    Reduce BLAST hits added in chunks (hits of a query in a row, in BLAST order) to the hits
+    that summarize_traits can use once the alignment length cutoff is known.
+
+    The cutoff, half the mean alignment length of the hits passing perc_identity, is an aggregate
+    over all queries, accumulated per query (so that hits of queries searched apart can be
+    merged before the cutoff, see length_cutoff). As any hit at least as long as an earlier one passes whenever the earlier one does,
+    only hits longer than every earlier hit of the query with a known value of some trait can be
+    the first passing hit with a known value. Only those are kept, together with the longest hits
+    so far, which decide whether a query has any passing hit.
+    """
+    def __init__(self, trait_ids: pd.Index, trait_known: np.ndarray, perc_identity: float = None):
+        self.trait_ids = trait_ids
+        self.perc_identity = perc_identity
+        # Known traits per species plus a column known for every hit, and a last row
+        # for species without trait data
+        n_species = len(trait_known)
+        self.known = np.zeros((n_species + 1, trait_known.shape[1] + 1), dtype=bool)
+        self.known[:n_species, :-1] = trait_known
+        self.known[:, -1] = True
+        self.stats = []
+        self.kept = []
+        self.pending = None
+
+    def add(self, hits: pd.DataFrame) -> None:
+        """Add hits; those of the last query are held until the next chunk or finish."""
+        if self.pending is not None:
+            hits = pd.concat([self.pending, hits], ignore_index=True)
+        if len(hits) == 0:
+            return
+        sequences = hits['sequence'].to_numpy()
+        last = len(sequences) - np.argmax(sequences[::-1] != sequences[-1]) if (sequences != sequences[-1]).any() else 0
+        self.pending = hits.iloc[last:]
+        self._reduce(hits.iloc[:last])
+        return
+
+    def finish(self) -> pd.DataFrame:
+        """Kept hits longer than the length cutoff, in BLAST order."""
+        return length_cutoff(*self.reduced())
+
+    def reduced(self):
+        """
+        Kept hits in BLAST order before the length cutoff, and the alignment length sum
+        and number of hits passing perc_identity of each query (sequence, length_sum, n_hits).
+        """
+        if self.pending is not None:
+            self._reduce(self.pending)
+            self.pending = None
+        if not self.kept:
+            return empty_hits(), pd.DataFrame({'sequence': [], 'length_sum': [], 'n_hits': []})
+        query_stats = pd.concat(self.stats, ignore_index=True)
+        query_stats = query_stats.groupby('sequence', sort=False, as_index=False).sum()
+        return pd.concat(self.kept, ignore_index=True), query_stats
+
+    def _reduce(self, hits: pd.DataFrame) -> None:
+        if len(hits) == 0:
+            return
+        # Filter by percentage identity, if provided
+        if self.perc_identity is not None:
+            hits = hits[hits['pident'].astype(float) >= self.perc_identity]
+        lengths = hits['length'].to_numpy(dtype=np.float64)
+        sequences = hits['sequence'].to_numpy()
+        query_codes, query_names = pd.factorize(sequences)
+        self.stats.append(pd.DataFrame({'sequence': query_names,
+                                        'length_sum': np.bincount(query_codes, weights=lengths,
+                                                                  minlength=len(query_names)),
+                                        'n_hits': np.bincount(query_codes, minlength=len(query_names))}))
+
+        # Running maximum of lengths with a known value per trait, restarted for each query
+        # by offsetting queries by more than any length
+        query = np.cumsum(np.r_[True, sequences[1:] != sequences[:-1]]) if len(sequences) else np.zeros(0)
+        species_index = self.trait_ids.get_indexer(to_species_codes(hits['species_tax_id']))
+        known = self.known[species_index]
+        offset = query[:, None] * (lengths.max(initial=0) + 2)
+        running = np.maximum.accumulate(np.where(known, lengths[:, None], -1) + offset, axis=0)
+        previous = np.vstack([np.full((1, known.shape[1]), -np.inf), running[:-1]])
+        keep = (known & (running > previous)).any(axis=1)
+        self.kept.append(hits[keep])
+        return
@@ -0,0 +1,584 @@
+### library ###
+import hashlib
+import re
+from typing import List, Optional
+
+import numpy as np
+import pandas as pd
+
+from bac2feature.core.utils import file_sha1
+
+HSP_REFERENCE_VERSION = 1
+
+### class ###
+class Tree:
+    """
+    Rooted phylogenetic tree stored as NumPy arrays.
+
+    Nodes are numbered as in ape/castor: tips are 0..n_tips-1 in the order
+    they appear in the Newick string, internal nodes follow in preorder and
+    the root is node n_tips. parent[root] is -1 and edge_length[i] is the
+    length of the edge above node i.
+    """
+    def __init__(self, tip_labels: List[str], parent: np.ndarray, edge_length: np.ndarray):
+        self.tip_labels = list(tip_labels)
+        self.parent = np.asarray(parent, dtype=np.int64)
+        self.edge_length = np.asarray(edge_length, dtype=np.float64)
+        self.n_tips = len(self.tip_labels)
+        self.n_nodes = len(self.parent)
+        self.root = self.n_tips
+
+        # Depth (number of edges from the root) of every node.
+        # Internal nodes are numbered in preorder, so parents always come first.
+        depth = np.zeros(self.n_nodes, dtype=np.int64)
+        for node in range(self.n_tips + 1, self.n_nodes):
+            depth[node] = depth[self.parent[node]] + 1
+        tips = np.arange(self.n_tips)
+        depth[tips] = depth[self.parent[tips]] + 1
+        self.depth = depth
+
+        # Nodes grouped by depth: levels[d] holds every node at depth d.
+        # Iterating the levels backwards is a postorder traversal, forwards a preorder one.
+        order = np.argsort(depth, kind='stable')
+        bounds = np.searchsorted(depth[order], np.arange(depth.max() + 2))
+        self.levels = [order[bounds[d]:bounds[d + 1]] for d in range(depth.max() + 1)]
+
+### main func ###
+def run_hsp(
+    tree_path: str, ref_trait_path: str, check_nsti: bool) -> pd.DataFrame:
+    """
+    Hidden state prediction for all traits in one pass over the tree.
+    Python counterpart of castor_hsp.R returning the same table in memory.
+    """
+    tree = read_newick(tree_path)
+    trait = read_ref_trait(ref_trait_path)
+
+    # Tips missing from the reference trait table are the query sequences
+    known_tips = np.array([label in trait.index for label in tree.tip_labels], dtype=bool)
+    unknown_tips_index = np.flatnonzero(~known_tips)
+    unknown_tips = [tree.tip_labels[i] for i in unknown_tips_index]
+
+    num_cols, cat_cols = split_trait_types(trait)
+    num_pred, cat_pred = predict_all_nodes(tree, trait, num_cols, cat_cols)
+    nsti = None
+    if check_nsti:
+        down, up = nearest_neighbor_messages(tree, known_trait_tips(tree, trait))
+        nsti = np.minimum(down, up)[unknown_tips_index]
+
+    return hsp_result_table(unknown_tips, list(trait.columns),
+                            num_cols, num_pred[unknown_tips_index],
+                            cat_cols, cat_pred[unknown_tips_index], nsti)
+
+def hsp_reference_arrays(tree_path: str, ref_trait_path: str) -> dict:
+    """
+    HSP state of the reference tree as arrays, with the tree in array form.
+
+    For every reference node, the stored states are those of its nearest
+    reconstructed ancestor (or itself), i.e. the prediction for a tip placed
+    directly below the node, and the NSTI messages are the distances to the
+    nearest known tip inside (down) and outside (up) the node's subtree.
+    """
+    tree = read_newick(tree_path)
+    trait = read_ref_trait(ref_trait_path)
+    num_cols, cat_cols = split_trait_types(trait)
+    num_pred, cat_pred = predict_all_nodes(tree, trait, num_cols, cat_cols)
+    nsti_down, nsti_up = nearest_neighbor_messages(tree, known_trait_tips(tree, trait))
+    return dict(
+        version=np.array(HSP_REFERENCE_VERSION),
+        trait_sha1=np.array(file_sha1(ref_trait_path)),
+        tip_labels=np.array(tree.tip_labels, dtype=str),
+        known_tips=np.array([label in trait.index for label in tree.tip_labels], dtype=bool),
+        parent=tree.parent,
+        edge_length=tree.edge_length,
+        clade_hash=clade_hashes(tree, np.ones(tree.n_tips, dtype=bool)),
+        columns=np.array(list(trait.columns), dtype=str),
+        num_cols=np.array(num_cols, dtype=str),
+        cat_cols=np.array(cat_cols, dtype=str),
+        num_pred=num_pred,
+        cat_pred=cat_pred.astype(np.int8),
+        nsti_down=nsti_down,
+        nsti_up=nsti_up
+    )
+
+def run_hsp_from_reference(
+    tree_path: str, hsp_reference: dict, ref_trait_path: str,
+    check_nsti: bool) -> Optional[pd.DataFrame]:
+    """
+    Hidden state prediction of placed sequences from precomputed reference state.
+
+    Query tips carry no trait values, so they leave the reconstruction of the
+    reference tree unchanged: each query takes the states of the nearest
+    reconstructed ancestor of its attachment edge, and its NSTI follows from
+    the distal and pendant lengths of the placement. Only the query tips are
+    computed. Returns None when the placed tree does not match the reference,
+    so that the caller can fall back to run_hsp.
+    hsp_reference holds the arrays of hsp_reference_arrays (the 'hsp' section
+    of the reference index).
+    """
+    ref = hsp_reference
+    if int(ref['version']) != HSP_REFERENCE_VERSION or str(ref['trait_sha1']) != file_sha1(ref_trait_path):
+        print('HSP reference does not match the reference trait table.')
+        return None
+    tree = read_newick(tree_path)
+    ref_labels = ref['tip_labels'].tolist()
+    ref_index = {label: i for i, label in enumerate(ref_labels)}
+
+    # Tips absent from the reference tree are the query sequences
+    in_ref = np.array([label in ref_index for label in tree.tip_labels], dtype=bool)
+    if int(in_ref.sum()) != len(ref_labels):
+        print('Placed tree does not contain the reference tree.')
+        return None
+
+    # Identify attachment edges by the reference tips below each node
+    ref_hash = ref['clade_hash']
+    hash_to_node = {h: i for i, h in enumerate(ref_hash.tolist())}
+    tip_hash = np.zeros(tree.n_tips, dtype=np.uint64)
+    tip_hash[in_ref] = ref_hash[[ref_index[label] for label in np.array(tree.tip_labels)[in_ref]]]
+    placed_hash = clade_hashes(tree, in_ref, tip_hash)
+    distal = distance_to_reference_node(tree, placed_hash, in_ref)
+
+    # Unknown tips in tree order (queries and reference tips without traits)
+    unknown = np.flatnonzero(~in_ref | ~ref['known_tips'][[ref_index.get(label, 0) for label in tree.tip_labels]])
+    ref_node = np.empty(len(unknown), dtype=np.int64)
+    for i, tip in enumerate(unknown):
+        node = tip if in_ref[tip] else tree.parent[tip]
+        h = int(placed_hash[node])
+        if h not in hash_to_node:
+            print('Placement could not be mapped onto the reference tree.')
+            return None
+        ref_node[i] = hash_to_node[h]
+
+    # Queries are predicted from the parent node of the attachment edge
+    ref_parent = ref['parent']
+    is_query = ~in_ref[unknown]
+    pred_node = np.where(is_query, ref_parent[ref_node], ref_node)
+    if (pred_node < 0).any():
+        print('Placement on the root of the reference tree is not supported.')
+        return None
+
+    nsti = None
+    if check_nsti:
+        nsti_down, nsti_up = ref['nsti_down'][ref_node], ref['nsti_up'][ref_node]
+        # Query: via the child side (distal) or the parent side of the attachment edge
+        a = distal[tree.parent[unknown]][:, None]
+        b = tree.edge_length[unknown][:, None]
+        query_nsti = b + np.minimum(a + nsti_down, nsti_up - a)
+        nsti = np.where(is_query[:, None], query_nsti, np.minimum(nsti_down, nsti_up))
+
+    return hsp_result_table([tree.tip_labels[i] for i in unknown], ref['columns'].tolist(),
+                            ref['num_cols'].tolist(), ref['num_pred'][pred_node],
+                            ref['cat_cols'].tolist(), ref['cat_pred'][pred_node], nsti)
+
+### func ###
+def read_newick(tree_path: str) -> Tree:
+    """Read a Newick file into a Tree."""
+    with open(tree_path, 'r') as f:
+        return parse_newick(f.read())
+
+def parse_newick(text: str) -> Tree:
+    """Parse a Newick string into a Tree. Internal node labels are ignored."""
+    # Drop comments such as [&&NHX...]
+    text = re.sub(r'\[[^\]]*\]', '', text)
+    tokens = re.findall(r"'(?:[^']|'')*'|[(),:;]|[^(),:;'\s]+", text)
+
+    # Nodes in order of creation: internal nodes in preorder, tips in order of appearance
+    parents, lengths, labels, tip_flags = [], [], [], []
+    current, last = -1, -1
+    expect_length = False
+    for token in tokens:
+        if token == ';':
+            break
+        elif token == '(':
+            parents.append(current)
+            lengths.append(0.0)
+            labels.append(None)
+            tip_flags.append(False)
+            current = len(parents) - 1
+            last = -1
+        elif token == ',':
+            last = -1
+        elif token == ')':
+            last = current
+            current = parents[current]
+        elif token == ':':
+            expect_length = True
+        elif expect_length:
+            lengths[last] = float(token)
+            expect_length = False
+        elif last == -1:
+            # A new tip
+            if token.startswith("'"):
+                token = token[1:-1].replace("''", "'")
+            parents.append(current)
+            lengths.append(0.0)
+            labels.append(token)
+            tip_flags.append(True)
+            last = len(parents) - 1
+        # Otherwise the token is a label of the internal node just closed
+
+    tip_flags = np.array(tip_flags, dtype=bool)
+    n_tips = int(tip_flags.sum())
+    # Renumber nodes: tips first, then internal nodes (root = n_tips)
+    new_index = np.empty(len(parents), dtype=np.int64)
+    new_index[tip_flags] = np.arange(n_tips)
+    new_index[~tip_flags] = np.arange(n_tips, len(parents))
+
+    parent = np.full(len(parents), -1, dtype=np.int64)
+    old_parent = np.array(parents, dtype=np.int64)
+    has_parent = old_parent >= 0
+    parent[new_index[has_parent]] = new_index[old_parent[has_parent]]
+    edge_length = np.zeros(len(parents), dtype=np.float64)
+    edge_length[new_index] = lengths
+    tip_labels = [label for label, is_tip in zip(labels, tip_flags) if is_tip]
+
+    # Check label uniqueness
+    if len(set(tip_labels)) != n_tips:
+        raise ValueError('Tip labels in the tree are not unique.')
+    return Tree(tip_labels, parent, edge_length)
+
+def split_trait_types(trait: pd.DataFrame):
+    """
+    Split trait columns into numerical and categorical ones.
+    As in read.delim, a column with integer values only is categorical.
+    """
+    num_cols, cat_cols = [], []
+    for col in trait.columns:
+        values = trait[col].dropna()
+        if values.str.fullmatch(r'\s*-?\d+\s*').all():
+            cat_cols.append(col)
+        else:
+            num_cols.append(col)
+    return num_cols, cat_cols
+
+def read_ref_trait(ref_trait_path: str) -> pd.DataFrame:
+    """Load the reference trait table as strings indexed by species_tax_id."""
+    trait = pd.read_csv(ref_trait_path, sep='\t', dtype=str, index_col=0)
+    trait.index = trait.index.astype(str)
+    return trait
+
+def known_trait_tips(tree: Tree, trait: pd.DataFrame) -> np.ndarray:
+    """(n_tips, n_traits) boolean array of tips with a known value for each trait."""
+    return trait.reindex(tree.tip_labels).notnull().to_numpy()
+
+def predict_all_nodes(tree: Tree, trait: pd.DataFrame, num_cols: List[str], cat_cols: List[str]):
+    """
+    Predicted numerical states and categorical states (most likely state)
+    of all tips and nodes.
+    """
+    # Trait table ordered by tree tips (unknown tips are NA)
+    full_traits = trait.reindex(tree.tip_labels)
+
+    # HSP of numerical traits (squared-change parsimony)
+    num_states = full_traits[num_cols].apply(pd.to_numeric).to_numpy(dtype=np.float64)
+    num_pred = hsp_squared_change_parsimony(tree, num_states, weighted=True)
+
+    # HSP of categorical traits (maximum parsimony weighted by scenarios)
+    cat_states = full_traits[cat_cols].apply(pd.to_numeric).fillna(-1).to_numpy(dtype=np.int64)
+    if cat_cols:
+        cat_pred = hsp_max_parsimony(tree, cat_states).argmax(axis=2)
+    else:
+        cat_pred = np.zeros((tree.n_nodes, 0), dtype=np.int64)
+    return num_pred, cat_pred
+
+def hsp_result_table(
+    sequences: List[str], columns: List[str],
+    num_cols: List[str], num_pred: np.ndarray, cat_cols: List[str], cat_pred: np.ndarray,
+    nsti: Optional[np.ndarray]) -> pd.DataFrame:
+    """HSP results as strings in the format of castor_hsp.R."""
+    out = pd.DataFrame({'sequence': sequences})
+    for i, col in enumerate(num_cols):
+        out[col] = format_numeric(num_pred[:, i])
+    for i, col in enumerate(cat_cols):
+        out[col] = cat_pred[:, i].astype(str)
+    out = out[['sequence'] + columns]
+    if nsti is not None:
+        for i, col in enumerate(columns):
+            out[f'{col}_nsti'] = ['%.15g' % x for x in nsti[:, i]]
+    return out
+
+def clade_hashes(tree: Tree, tip_mask: np.ndarray, tip_hash: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Hash of the set of masked tips below every node (sum of 64-bit tip hashes).
+    Tip hashes default to hashes of the tip labels.
+    """
+    if tip_hash is None:
+        tip_hash = np.array([int.from_bytes(hashlib.blake2b(label.encode(), digest_size=8).digest(), 'little')
+                             for label in tree.tip_labels], dtype=np.uint64)
+    node_hash = np.zeros(tree.n_nodes, dtype=np.uint64)
+    node_hash[:tree.n_tips] = np.where(tip_mask, tip_hash, 0)
+    for nodes in reversed(tree.levels[1:]):
+        np.add.at(node_hash, tree.parent[nodes], node_hash[nodes])
+    return node_hash
+
+def distance_to_reference_node(tree: Tree, node_hash: np.ndarray, in_ref: np.ndarray) -> np.ndarray:
+    """
+    Distance from every node of a placed tree down to the reference node it was
+    inserted above (0 for nodes also present in the reference tree).
+    """
+    children = np.flatnonzero(tree.parent >= 0)
+    with_ref = children[node_hash[children] != 0]
+    n_ref_children = np.bincount(tree.parent[with_ref], minlength=tree.n_nodes)
+    # Inserted nodes have exactly one child with reference tips below
+    main_child = np.full(tree.n_nodes, -1, dtype=np.int64)
+    main_child[tree.parent[with_ref]] = with_ref
+    inserted = n_ref_children == 1
+    inserted[:tree.n_tips] = False
+
+    distance = np.zeros(tree.n_nodes)
+    for nodes in reversed(tree.levels):
+        nodes = nodes[inserted[nodes]]
+        child = main_child[nodes]
+        distance[nodes] = distance[child] + tree.edge_length[child]
+    return distance
+
+def format_numeric(values: np.ndarray) -> List[str]:
+    """Format numerical predictions like formatC() in castor_hsp.R."""
+    return ['NA' if np.isnan(x) else '%g' % x for x in values]
+
+def hsp_squared_change_parsimony(
+    tree: Tree, tip_states: np.ndarray, weighted=True, min_edge_length=1e-8) -> np.ndarray:
+    """
+    Hidden state prediction by squared-change parsimony for several traits at once,
+    following castor::hsp_squared_change_parsimony.
+
+    Ancestral states are reconstructed from the known tips of each trait with
+    a postorder and a preorder pass (globally optimal state at every node).
+    Tips and nodes without a reconstructed state take the state of their
+    nearest reconstructed ancestor.
+
+    Args:
+        tree: Tree
+        tip_states: (n_tips, n_traits) array, NaN for unknown tips
+        weighted: Weight squared changes by inverse edge lengths
+        min_edge_length: Zero-length edges are replaced by this length
+    Returns:
+        (n_nodes, n_traits) array of predicted states for all tips and nodes
+    """
+    tip_states = np.asarray(tip_states, dtype=np.float64).reshape(tree.n_tips, -1)
+    n_traits = tip_states.shape[1]
+    parent = tree.parent
+    if weighted:
+        edge = np.maximum(tree.edge_length, min_edge_length)[:, None]
+    else:
+        edge = np.ones((tree.n_nodes, 1))
+
+    # Postorder: mean and variance of each subtree estimate
+    known = ~np.isnan(tip_states)
+    mean = np.zeros((tree.n_nodes, n_traits))
+    var = np.full((tree.n_nodes, n_traits), np.inf)
+    mean[:tree.n_tips] = np.where(known, tip_states, 0.0)
+    var[:tree.n_tips][known] = 0.0
+    prec_sum = np.zeros((tree.n_nodes, n_traits))  # sum of children weights
+    wsum = np.zeros((tree.n_nodes, n_traits))  # sum of children weighted means
+    w_down = np.zeros((tree.n_nodes, n_traits))  # weight of each node toward its parent
+    n_informative = np.zeros((tree.n_nodes, n_traits), dtype=np.int64)
+    for nodes in reversed(tree.levels[1:]):
+        internal = nodes[nodes >= tree.n_tips]
+        _set_mean_var(mean, var, internal, prec_sum, wsum)
+        w = 1.0 / (var[nodes] + edge[nodes])
+        w_down[nodes] = w
+        np.add.at(prec_sum, parent[nodes], w)
+        np.add.at(wsum, parent[nodes], w * mean[nodes])
+        np.add.at(n_informative, parent[nodes], (w > 0).astype(np.int64))
+    _set_mean_var(mean, var, np.array([tree.root]), prec_sum, wsum)
+
+    # Preorder: messages from outside each subtree, excluding the node itself
+    w_up = np.zeros((tree.n_nodes, n_traits))
+    s_up = np.zeros((tree.n_nodes, n_traits))
+    for nodes in tree.levels[1:]:
+        p = parent[nodes]
+        prec_total = prec_sum[p] + w_up[p]
+        prec_ex = prec_total - w_down[nodes]
+        prec_ex = np.where(prec_ex > prec_total * 1e-12, prec_ex, 0.0)
+        s_ex = wsum[p] + s_up[p] - w_down[nodes] * mean[nodes]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            var_ex = np.where(prec_ex > 0, 1.0 / prec_ex, np.inf)
+            mean_ex = np.where(prec_ex > 0, s_ex / prec_ex, 0.0)
+        w_up[nodes] = 1.0 / (var_ex + edge[nodes])
+        s_up[nodes] = w_up[nodes] * mean_ex
+
+    # Reconstructed states at nodes kept in the subtree of known tips
+    states = np.full((tree.n_nodes, n_traits), np.nan)
+    states[:tree.n_tips] = tip_states
+    internal = slice(tree.n_tips, tree.n_nodes)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        full = (wsum[internal] + s_up[internal]) / (prec_sum[internal] + w_up[internal])
+    retained = _retained_nodes(tree, n_informative)[internal]
+    states[internal] = np.where(retained, full, np.nan)
+
+    return _fill_from_ancestors(tree, states)
+
+def hsp_max_parsimony(tree: Tree, tip_states: np.ndarray) -> np.ndarray:
+    """
+    Hidden state prediction by maximum parsimony for several categorical traits at once,
+    following castor::hsp_max_parsimony with weight_by_scenarios=TRUE and equal transition costs.
+
+    State likelihoods of each node are the fractions of maximum parsimony
+    scenarios in which the node has each state, with the tree rerooted at the node.
+    Tips and nodes without reconstructed likelihoods take those of their
+    nearest reconstructed ancestor.
+
+    Args:
+        tree: Tree
+        tip_states: (n_tips, n_traits) integer array of states 0..K-1, -1 for unknown tips
+    Returns:
+        (n_nodes, n_traits, K) array of state likelihoods for all tips and nodes
+    """
+    tip_states = np.asarray(tip_states, dtype=np.int64).reshape(tree.n_tips, -1)
+    n_traits = tip_states.shape[1]
+    n_states = max(int(tip_states.max()) + 1, 1)
+    parent = tree.parent
+    known = tip_states >= 0
+
+    # Postorder: minimal cost and number of scenarios of each subtree for each node state
+    cost = np.zeros((tree.n_nodes, n_traits, n_states))
+    count = np.ones((tree.n_nodes, n_traits, n_states))
+    tip_cost = np.where(np.arange(n_states) == tip_states[:, :, None], 0.0, np.inf)
+    cost[:tree.n_tips] = np.where(known[:, :, None], tip_cost, 0.0)
+    msg_cost = np.zeros_like(cost)
+    msg_count = np.ones_like(count)
+    has_known = np.zeros((tree.n_nodes, n_traits), dtype=bool)
+    has_known[:tree.n_tips] = known
+    n_informative = np.zeros((tree.n_nodes, n_traits), dtype=np.int64)
+    for nodes in reversed(tree.levels[1:]):
+        internal = nodes[nodes >= tree.n_tips]
+        count[internal] /= count[internal].max(axis=2, keepdims=True)
+        np.logical_or.at(has_known, parent[nodes], has_known[nodes])
+        np.add.at(n_informative, parent[nodes], has_known[nodes].astype(np.int64))
+
+        # Nodes collapsed in the subtree of known tips pass messages through
+        emit = _retained_nodes(tree, n_informative, nodes) | (nodes < tree.n_tips)[:, None]
+        t_cost, t_count = _transition(cost[nodes], count[nodes])
+        msg_cost[nodes] = np.where(emit[:, :, None], t_cost, cost[nodes])
+        msg_count[nodes] = np.where(emit[:, :, None], t_count, count[nodes])
+        np.add.at(cost, parent[nodes], msg_cost[nodes])
+        np.multiply.at(count, parent[nodes], msg_count[nodes])
+    count[tree.root] /= count[tree.root].max(axis=1, keepdims=True)
+    retained = _retained_nodes(tree, n_informative)
+
+    # Preorder: combine subtree scenarios with those outside the subtree
+    full_cost = cost.copy()
+    full_count = count.copy()
+    for nodes in tree.levels[1:]:
+        p = parent[nodes]
+        h_cost = full_cost[p] - msg_cost[nodes]
+        h_count = full_count[p] / msg_count[nodes]
+        t_cost, t_count = _transition(h_cost, h_count)
+        emit = retained[p][:, :, None]
+        up_cost = np.where(emit, t_cost, h_cost)
+        up_count = np.where(emit, t_count, h_count)
+        full_cost[nodes] = cost[nodes] + up_cost
+        full_count[nodes] = count[nodes] * up_count
+        full_count[nodes] /= full_count[nodes].max(axis=2, keepdims=True)
+
+    # Likelihoods from the number of scenarios with minimal cost
+    optimal = full_cost == full_cost.min(axis=2, keepdims=True)
+    lik = np.where(optimal, full_count, 0.0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        lik /= lik.sum(axis=2, keepdims=True)
+    has_lik = retained.copy()
+    has_lik[:tree.n_tips] = known
+    lik[~has_lik] = np.nan
+
+    return _fill_from_ancestors(tree, lik)
+
+def hsp_nearest_neighbor(tree: Tree, tip_known: np.ndarray) -> np.ndarray:
+    """
+    Phylogenetic distance from every tip and node to the nearest tip with a known state,
+    following castor::hsp_nearest_neighbor.
+
+    Args:
+        tree: Tree
+        tip_known: (n_tips,) boolean array of tips with known state
+    Returns:
+        (n_nodes,) array of distances
+    """
+    down, up = nearest_neighbor_messages(tree, tip_known)
+    return np.minimum(down, up)
+
+def nearest_neighbor_messages(tree: Tree, tip_known: np.ndarray):
+    """
+    Distances from every tip and node to the nearest known tip inside (down)
+    and outside (up) its subtree. The up distance includes the edge above the node.
+
+    tip_known may be (n_tips,) or (n_tips, n_traits). All traits are handled in
+    one pass: the availability masks are packed into bitsets and traits sharing
+    the same mask (e.g. the cell shape traits) are computed only once.
+    """
+    tip_known = np.asarray(tip_known, dtype=bool)
+    if tip_known.ndim == 1:
+        down, up = nearest_neighbor_messages(tree, tip_known[:, None])
+        return down[:, 0], up[:, 0]
+
+    # Unique availability masks (one bitset per trait)
+    bitsets = np.packbits(tip_known, axis=0)
+    _, first, inverse = np.unique(bitsets, axis=1, return_index=True, return_inverse=True)
+    masks = tip_known[:, first]
+    n_masks = masks.shape[1]
+    shape = (tree.n_nodes, n_masks)
+    parent = tree.parent
+    edge = tree.edge_length[:, None]
+
+    # Postorder: nearest known tip within each subtree
+    down = np.full(shape, np.inf)
+    down[:tree.n_tips][masks] = 0.0
+    for nodes in reversed(tree.levels[1:]):
+        np.minimum.at(down, parent[nodes], down[nodes] + edge[nodes])
+
+    # Best and second best child of every node for excluding a node from its siblings
+    children = np.flatnonzero(parent >= 0)
+    via = down[children] + edge[children]
+    best = np.full(shape, np.inf)
+    np.minimum.at(best, parent[children], via)
+    is_best = via == best[parent[children]]
+    rows, cols = np.nonzero(is_best)
+    best_child = np.full(shape, -1, dtype=np.int64)
+    best_child[parent[children][rows], cols] = children[rows]
+    others = best_child[parent[children]] != children[:, None]
+    second = np.full(shape, np.inf)
+    np.minimum.at(second, parent[children], np.where(others, via, np.inf))
+
+    # Preorder: nearest known tip outside each subtree
+    up = np.full(shape, np.inf)
+    for nodes in tree.levels[1:]:
+        p = parent[nodes]
+        sibling = np.where(best_child[p] == nodes[:, None], second[p], best[p])
+        up[nodes] = edge[nodes] + np.minimum(up[p], sibling)
+
+    inverse = inverse.reshape(-1)
+    return down[:, inverse], up[:, inverse]
+
+def _set_mean_var(mean, var, nodes, prec_sum, wsum) -> None:
+    prec = prec_sum[nodes]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        var[nodes] = np.where(prec > 0, 1.0 / prec, np.inf)
+        mean[nodes] = np.where(prec > 0, wsum[nodes] / prec, 0.0)
+
+def _retained_nodes(tree: Tree, n_informative: np.ndarray, nodes: Optional[np.ndarray] = None) -> np.ndarray:
+    """
+    Internal nodes kept in the subtree of known tips (root and nodes with
+    two or more children having known descendants), as in castor::get_subtree_with_tips.
+    """
+    if nodes is None:
+        nodes = np.arange(tree.n_nodes)
+    retained = (n_informative[nodes] >= 2) | (nodes == tree.root)[:, None]
+    retained &= (nodes >= tree.n_tips)[:, None]
+    return retained
+
+def _transition(cost, count):
+    """Move a cost/scenario-count message across one edge with equal transition costs."""
+    n_states = cost.shape[-1]
+    change = 1.0 - np.eye(n_states)
+    # trans[..., s, s'] = cost of state s' below the edge when the state above is s
+    trans = cost[..., None, :] + change
+    new_cost = trans.min(axis=-1)
+    new_count = np.where(trans == new_cost[..., None], count[..., None, :], 0.0).sum(axis=-1)
+    return new_cost, new_count
+
+def _fill_from_ancestors(tree: Tree, states: np.ndarray) -> np.ndarray:
+    """Assign states of the nearest ancestor with a state to tips and nodes without one."""
+    for nodes in tree.levels[1:]:
+        missing = np.isnan(states[nodes])
+        if missing.any():
+            states[nodes] = np.where(missing, states[tree.parent[nodes]], states[nodes])
+    return states
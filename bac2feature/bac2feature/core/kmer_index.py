@@ -0,0 +1,178 @@
+### library ###
+import os
+import subprocess
+import tempfile
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+from bac2feature.core.ref_index import load_section, write_ref_index
+from bac2feature.core.utils import read_fasta
+
+# Reference k-mers are sampled every KMER_STEP bases; an ungapped match of
+# KMER_SIZE + KMER_STEP - 1 bases always contains one of them
+KMER_SIZE = 16
+KMER_STEP = 8
+# Hits per query, as BLASTn's default max_target_seqs
+MAX_HITS = 500
+# Alignment scores of BLASTn (megablast) used to find where BLAST would end a hit
+MATCH_SCORE = 1
+MISMATCH_SCORE = -2
+
+BASE_CODES = np.full(256, 4, dtype=np.uint8)
+for _code, _bases in enumerate(['Aa', 'Cc', 'Gg', 'TtUu']):
+    for _base in _bases:
+        BASE_CODES[ord(_base)] = _code
+
+### main func ###
+def kmer_prefilter(
+    records: List[Tuple[str, str]], index: Dict[str, np.ndarray],
+    min_identity: float) -> Tuple[pd.DataFrame, List[Tuple[str, str]]]:
+    """
+    Resolve queries with full-length ungapped hits of at least min_identity percent
+    identity in the k-mer index. Queries with bases other than A, C, G and T (U) are left
+    to BLASTn, which scores ambiguous bases by its own rules. Returns the hits in the columns used from BLAST results
+    (sequence, species_tax_id, pident, length; best hits first, in reference order on ties)
+    and the unresolved records, to be searched by BLASTn.
+
+    pident and length are those BLAST reports for the same alignment: a hit is only
+    accepted when every prefix and suffix of the alignment scores positive, i.e. BLAST
+    would not trim its ends.
+    """
+    hits, unresolved = [], []
+    for seq_id, seq in records:
+        ref_rows, pident = query_hits(encode(seq), index, min_identity)
+        if len(ref_rows) == 0:
+            unresolved.append((seq_id, seq))
+            continue
+        hits.append(pd.DataFrame({'sequence': seq_id,
+                                  'species_tax_id': index['ids'][ref_rows].astype(object),
+                                  'pident': pident,
+                                  'length': float(len(seq))}))
+    if hits:
+        hits = pd.concat(hits, ignore_index=True)
+    else:
+        hits = pd.DataFrame({'sequence': [], 'species_tax_id': [], 'pident': [], 'length': []})
+    return hits, unresolved
+
+def load_kmer_index(ref_blastdb: str) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Memory-mapped k-mer index stored alongside the BLAST database
+    (see bac2feature build-index), or None if missing or built from another database.
+    """
+    sources = blastdb_sources(ref_blastdb)
+    if sources is None:
+        return None
+    return load_section('kmer', index_dir=kmer_index_dir(ref_blastdb), **sources)
+
+def build_kmer_index(ref_blastdb: str, ref_fasta: Optional[str] = None) -> None:
+    """
+    Build the k-mer index of a BLAST database from its sequences
+    (exported by blastdbcmd unless ref_fasta with the same IDs is given).
+    """
+    sources = blastdb_sources(ref_blastdb)
+    if sources is None:
+        raise FileNotFoundError(f'BLAST database {ref_blastdb} is not found.')
+    if ref_fasta is not None:
+        arrays = kmer_index_arrays(read_fasta(ref_fasta))
+    else:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            ref_fasta = os.path.join(temp_dir, 'reference.fasta')
+            subprocess.run(['blastdbcmd', '-db', ref_blastdb, '-entry', 'all', '-out', ref_fasta],
+                           check=True)
+            arrays = kmer_index_arrays(read_fasta(ref_fasta))
+    write_ref_index(kmer_index_dir(ref_blastdb), {'kmer': (arrays, sources)})
+    return
+
+### func ###
+def kmer_index_dir(ref_blastdb: str) -> str:
+    return f'{ref_blastdb}_kmer'
+
+def blastdb_sources(ref_blastdb: str) -> Optional[Dict[str, str]]:
+    """A file of the BLAST database that changes whenever the database is rebuilt."""
+    for suffix in ('.njs', '.nal', '.nin'):
+        if os.path.exists(f'{ref_blastdb}{suffix}'):
+            return dict(blastdb=f'{ref_blastdb}{suffix}')
+    return None
+
+def kmer_index_arrays(records: Iterable[Tuple[str, str]]) -> Dict[str, np.ndarray]:
+    """
+    Concatenated 2-bit base codes (4 for other bases) of the reference sequences with
+    their offsets, and the sampled k-mers sorted with their positions.
+    """
+    ids, seqs, offsets = [], [], [0]
+    for seq_id, seq in records:
+        ids.append(seq_id)
+        seqs.append(encode(seq))
+        offsets.append(offsets[-1] + len(seqs[-1]))
+    seq = np.concatenate(seqs) if seqs else np.zeros(0, dtype=np.uint8)
+    offsets = np.array(offsets, dtype=np.int64)
+    starts = [np.arange(start, end - KMER_SIZE + 1, KMER_STEP, dtype=np.int64)
+              for start, end in zip(offsets[:-1], offsets[1:])]
+    starts = np.concatenate(starts) if starts else np.zeros(0, dtype=np.int64)
+    kmers, valid = kmer_codes(seq, starts)
+    order = np.argsort(kmers[valid], kind='stable')
+    return dict(ids=np.array(ids, dtype=str), offsets=offsets, seq=seq,
+                kmers=kmers[valid][order], positions=starts[valid][order])
+
+def encode(seq: str) -> np.ndarray:
+    return BASE_CODES[np.frombuffer(seq.encode(), dtype=np.uint8)]
+
+def kmer_codes(codes: np.ndarray, starts: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """K-mers starting at starts as integers, and whether they contain only A, C, G and T."""
+    kmers = np.zeros(len(starts), dtype=np.uint32)
+    valid = np.ones(len(starts), dtype=bool)
+    for j in range(KMER_SIZE):
+        base = codes[starts + j]
+        valid &= base < 4
+        kmers = (kmers << np.uint32(2)) | (base & 3).astype(np.uint32)
+    return kmers, valid
+
+def query_hits(
+    query: np.ndarray, index: Dict[str, np.ndarray], min_identity: float) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    References with a full-length ungapped hit of at least min_identity percent identity,
+    best first, and the percent identity of the hits.
+    """
+    length = len(query)
+    no_hits = np.zeros(0, dtype=np.int64), np.zeros(0)
+    if length < KMER_SIZE + KMER_STEP - 1 or (query > 3).any():
+        return no_hits
+    # Seeds: reference positions of the query's k-mers, as diagonals (reference start of the hit)
+    query_starts = np.arange(length - KMER_SIZE + 1, dtype=np.int64)
+    kmers, _ = kmer_codes(query, query_starts)
+    lo = np.searchsorted(index['kmers'], kmers, side='left')
+    hi = np.searchsorted(index['kmers'], kmers, side='right')
+    counts = hi - lo
+    if counts.sum() == 0:
+        return no_hits
+    seed = np.repeat(lo - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    diagonals = index['positions'][seed] - np.repeat(query_starts, counts)
+
+    # A hit with m mismatches keeps at least this many sampled seeds on its diagonal
+    max_mismatches = int(np.floor(length * (1 - min_identity / 100) + 1e-9))
+    min_seeds = max(1, (length - KMER_SIZE + 1) // KMER_STEP - max_mismatches * (KMER_SIZE // KMER_STEP + 1))
+    diagonals, n_seeds = np.unique(diagonals, return_counts=True)
+    diagonals = diagonals[n_seeds >= min_seeds]
+    # The whole query has to lie within one reference
+    refs = np.searchsorted(index['offsets'], diagonals, side='right') - 1
+    inside = (diagonals >= 0) & (diagonals + length <= index['offsets'][np.clip(refs + 1, 0, len(index['offsets']) - 1)])
+    diagonals, refs = diagonals[inside], refs[inside]
+    if len(diagonals) == 0:
+        return no_hits
+
+    # Ungapped alignments, accepted if BLAST would report them over the full query
+    mismatch = index['seq'][diagonals[:, None] + np.arange(length)] != query
+    scores = np.where(mismatch, MISMATCH_SCORE, MATCH_SCORE).cumsum(axis=1)
+    total = scores[:, -1]
+    full_length = (scores.min(axis=1) > 0) & ((scores[:, :-1] < total[:, None]).all(axis=1))
+    n_match = length - mismatch.sum(axis=1)
+    accepted = full_length & (100 * n_match >= min_identity * length)
+    refs, total, n_match = refs[accepted], total[accepted], n_match[accepted]
+
+    # Best hit per reference, best first and in reference order on ties
+    order = np.lexsort((refs, -total))
+    refs, n_match = refs[order], n_match[order]
+    first = np.sort(np.unique(refs, return_index=True)[1])[:MAX_HITS]
+    return refs[first], np.round(100 * n_match[first] / length, 3)
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+
+# Taxonomic classification with a q2-feature-classifier naive Bayes classifier
+# without importing/exporting QIIME 2 artifacts.
+#
+# This file has no Bac2Feature imports so that it can be run by the Python of
+# the QIIME 2 environment (conda run) as well as imported in-process when
+# q2-feature-classifier is available.
+
+### library ###
+import argparse
+import os
+import tarfile
+import tempfile
+import zipfile
+
+# Classifiers loaded in this process by artifact path
+LOADED_CLASSIFIERS = {}
+
+### main func ###
+def classify(
+    input_fasta: str, out_taxonomy: str, ref_nb_classifier: str, threads: int,
+    tmp_dir=None, confidence=0.7) -> None:
+    """
+    Classify sequences and write taxonomy in the format of 'qiime tools export'
+    (Feature ID, Taxon, Confidence).
+    """
+    result = classify_table(input_fasta=input_fasta, ref_nb_classifier=ref_nb_classifier,
+                            threads=threads, tmp_dir=tmp_dir, confidence=confidence)
+    result.to_csv(out_taxonomy, sep='\t', index=False)
+    return
+
+### func ###
+def classify_table(
+    input_fasta: str, ref_nb_classifier: str, threads: int, tmp_dir=None, confidence=0.7):
+    """Classify sequences into a table of Feature ID, Taxon and Confidence."""
+    from q2_types.feature_data import DNAFASTAFormat
+    from q2_feature_classifier.classifier import classify_sklearn
+
+    pipeline = load_classifier(ref_nb_classifier, tmp_dir)
+    # Reads are split into batches and classified by parallel workers
+    result = classify_sklearn(reads=DNAFASTAFormat(input_fasta, mode='r'),
+                              classifier=pipeline,
+                              n_jobs=int(threads),
+                              confidence=confidence)
+    return result.rename_axis('Feature ID').reset_index()
+
+def load_classifier(ref_nb_classifier: str, tmp_dir=None):
+    """
+    Load the scikit-learn pipeline stored in a TaxonomicClassifier artifact (.qza).
+    The pipeline is kept in memory for later calls in the same process
+    (whatever their tmp_dir, which is only used to extract the artifact).
+    """
+    if ref_nb_classifier not in LOADED_CLASSIFIERS:
+        LOADED_CLASSIFIERS[ref_nb_classifier] = read_classifier(ref_nb_classifier, tmp_dir)
+    return LOADED_CLASSIFIERS[ref_nb_classifier]
+
+def read_classifier(ref_nb_classifier: str, tmp_dir=None):
+    import joblib
+
+    with tempfile.TemporaryDirectory(dir=tmp_dir) as temp_dir:
+        with zipfile.ZipFile(ref_nb_classifier) as qza:
+            member = next(name for name in qza.namelist()
+                          if name.endswith('/data/sklearn_pipeline.tar'))
+            tar_path = qza.extract(member, path=temp_dir)
+        with tarfile.open(tar_path) as tar:
+            tar.extractall(temp_dir)
+        return joblib.load(os.path.join(temp_dir, 'sklearn_pipeline.pkl'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Taxonomic classification by a naive Bayes classifier.')
+    parser.add_argument('-i', dest='input_fasta', required=True)
+    parser.add_argument('-o', dest='out_taxonomy', required=True)
+    parser.add_argument('-c', dest='ref_nb_classifier', required=True)
+    parser.add_argument('-t', dest='threads', default=1)
+    parser.add_argument('-d', dest='tmp_dir', default=None)
+    args = parser.parse_args()
+    classify(input_fasta=args.input_fasta, out_taxonomy=args.out_taxonomy,
+             ref_nb_classifier=args.ref_nb_classifier, threads=args.threads,
+             tmp_dir=args.tmp_dir)
+    return
+
+if __name__ == '__main__':
+    main()
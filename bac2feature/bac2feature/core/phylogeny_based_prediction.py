@@ -1,11 +1,18 @@
 ### library ###
-from os.path import dirname, join
-import subprocess
+from functools import lru_cache
+import os
+from os.path import basename, dirname, join
 
+import numpy as np
 import pandas as pd
-from picrust2.place_seqs import place_seqs_pipeline
-
 import bac2feature.core.default as default
+from bac2feature.core.checkpoint import Checkpoint
+from bac2feature.core.hsp import run_hsp, run_hsp_from_reference
+from bac2feature.core import profiling
+from bac2feature.core.placement import place_seqs
+from bac2feature.core.profiling import stage
+from bac2feature.core.ref_index import load_section
+from bac2feature.core.table import categorical_traits, typed_predictions, write_predictions
 
 ### main func ###
 def predict_by_phylogeny(
@@ -13,47 +20,127 @@ def predict_by_phylogeny(
     ref_dir_placement=default.ref_dir_placement,
     ref_trait=default.ref_trait, check_nsti=False, threads=1,
     filter_by_nsti=True, threshold_phylodistance=default.threshold_phylodistance,
-    threshold_column='cor_0.5') -> None:
+    threshold_column='cor_0.5', hsp_backend='python',
+    placement_shards=1, placement_queue=None) -> None:
     """
     Predict microbial traits from fasta file by phylogenetic placement and ASR.
+    hsp_backend selects the native HSP engine ('python') or castor_hsp.R ('R').
+    With the native engine, reference state precomputed by bac2feature build-index is used if available.
+    Placement is split into placement_shards shards, optionally run through the job
+    queue in placement_queue.
+    """
+    predictions = phylogeny_predictions(input_fasta=input_fasta,
+                                        intermediate_dir=intermediate_dir,
+                                        ref_dir_placement=ref_dir_placement,
+                                        ref_trait=ref_trait,
+                                        check_nsti=check_nsti,
+                                        threads=threads,
+                                        filter_by_nsti=filter_by_nsti,
+                                        threshold_phylodistance=threshold_phylodistance,
+                                        threshold_column=threshold_column,
+                                        hsp_backend=hsp_backend,
+                                        placement_shards=placement_shards,
+                                        placement_queue=placement_queue)
+    write_predictions(predictions, out_trait)
+    return
+
+def phylogeny_predictions(
+    input_fasta:str, intermediate_dir:str,
+    ref_dir_placement=default.ref_dir_placement,
+    ref_trait=default.ref_trait, check_nsti=False, threads=1,
+    filter_by_nsti=True, threshold_phylodistance=default.threshold_phylodistance,
+    threshold_column='cor_0.5', hsp_backend='python',
+    placement_shards=1, placement_queue=None,
+    resume=False, force_from=None) -> pd.DataFrame:
+    """
+    Predict microbial traits from fasta file by phylogenetic placement and ASR as a typed table.
+    NSTI filtering and column selection are applied to the table in memory.
+    With resume, the placed tree and HSP results of a previous run in intermediate_dir
+    are reused if their checkpoints match (stages from force_from on are recomputed).
     """
     out_tree = join(intermediate_dir, 'placed_seqs.tre')
-    # Phylogenetic placement by PICRUSt2's pipeline
-    place_seqs_pipeline(study_fasta=input_fasta,
-                        ref_dir=ref_dir_placement,
-                        placement_tool="epa-ng",
-                        out_tree=out_tree,
-                        threads=threads,
-                        out_dir=intermediate_dir,
-                        min_align=0,
-                        chunk_size=5000,
-                        verbose=False
-                        )
-    # Call HSP function in R package castor (always calculate NSTI)
-    call_castor_hsp(tree_path=out_tree,
-                    ref_trait_path=ref_trait,
-                    out_trait_path=out_trait,
-                    check_nsti=True  # Always calculate NSTI
-                    )
+    # Phylogenetic placement by PICRUSt2's pipeline (in shards if requested)
+    with stage('phylogeny.placement'):
+        # Sharding does not change placements
+        checkpoint = Checkpoint(intermediate_dir, 'placement', outputs=[out_tree],
+                                inputs={'fasta': input_fasta}, references={'placement': ref_dir_placement},
+                                force_from=force_from, enabled=resume)
+        if not checkpoint.done():
+            place_seqs(input_fasta=input_fasta,
+                       out_tree=out_tree,
+                       intermediate_dir=intermediate_dir,
+                       ref_dir_placement=ref_dir_placement,
+                       threads=threads,
+                       placement_shards=placement_shards,
+                       placement_queue=placement_queue
+                       )
+            checkpoint.save()
+    # Hidden state prediction (always calculate NSTI)
+    with stage('phylogeny.hsp'):
+        hsp_result_path = join(intermediate_dir, 'hsp_predictions.pkl')
+        checkpoint = Checkpoint(intermediate_dir, 'hsp', outputs=[hsp_result_path],
+                                inputs={'tree': out_tree}, references={'trait': ref_trait},
+                                params={'hsp_backend': hsp_backend}, force_from=force_from, enabled=resume)
+        if checkpoint.done():
+            predictions = pd.read_pickle(hsp_result_path)
+        else:
+            predictions = hsp_predictions(out_tree=out_tree, intermediate_dir=intermediate_dir,
+                                          ref_dir_placement=ref_dir_placement, ref_trait=ref_trait,
+                                          hsp_backend=hsp_backend)
+            if resume:
+                predictions.to_pickle(hsp_result_path)
+                checkpoint.save()
 
     # Filter predictions based on NSTI threshold if enabled
-    if filter_by_nsti:
-        filter_predictions_by_nsti(
-            prediction_path=out_trait,
-            threshold_path=threshold_phylodistance,
-            threshold_column=threshold_column
-        )
+    with stage('phylogeny.nsti_filter'):
+        if filter_by_nsti:
+            predictions = filter_predictions_by_nsti(
+                predictions=predictions,
+                threshold_path=threshold_phylodistance,
+                threshold_column=threshold_column
+            )
 
     # Remove NSTI columns if check_nsti=False
     if not check_nsti:
-        predictions = pd.read_csv(out_trait, sep='\t', dtype=str)
         nsti_columns = [col for col in predictions.columns if col.endswith('_nsti')]
         predictions = predictions.drop(columns=nsti_columns)
-        predictions.to_csv(out_trait, sep='\t', index=False)
 
-    return
+    return predictions
 
 ### func ###
+def hsp_predictions(
+    out_tree: str, intermediate_dir: str, ref_dir_placement: str, ref_trait: str,
+    hsp_backend: str) -> pd.DataFrame:
+    """Typed HSP predictions with NSTI of the sequences placed in out_tree."""
+    if hsp_backend == 'R':
+        # Call HSP function in R package castor
+        hsp_result_path = join(intermediate_dir, 'castor_hsp.tsv')
+        call_castor_hsp(tree_path=out_tree,
+                        ref_trait_path=ref_trait,
+                        out_trait_path=hsp_result_path,
+                        check_nsti=True  # Always calculate NSTI
+                        )
+        predictions = pd.read_csv(hsp_result_path, sep='\t', dtype=str)
+    else:
+        # Only the placed sequences are computed when reference state is precomputed
+        # (memory-mapped from the reference index)
+        predictions = None
+        reference = load_section('hsp', tree=join(ref_dir_placement, basename(default.tree)),
+                                 ref_trait=ref_trait)
+        if reference is not None:
+            predictions = run_hsp_from_reference(tree_path=out_tree,
+                                                 hsp_reference=reference,
+                                                 ref_trait_path=ref_trait,
+                                                 check_nsti=True  # Always calculate NSTI
+                                                 )
+        # Otherwise all traits in one pass of the native engine
+        if predictions is None:
+            predictions = run_hsp(tree_path=out_tree,
+                                  ref_trait_path=ref_trait,
+                                  check_nsti=True  # Always calculate NSTI
+                                  )
+    return typed_predictions(predictions, categorical_traits(ref_trait))
+
 def call_castor_hsp(
     tree_path, ref_trait_path, out_trait_path, check_nsti) -> None:
     """
@@ -66,26 +153,27 @@ def call_castor_hsp(
            out_trait_path,
            str(int(check_nsti))
            ]
-    subprocess.run(cmd)
+    profiling.run(cmd, name='castor_hsp.R')
     return
 
 def filter_predictions_by_nsti(
-    prediction_path: str, threshold_path: str, threshold_column: str) -> None:
+    predictions: pd.DataFrame, threshold_path: str, threshold_column: str) -> pd.DataFrame:
     """
     Filter trait predictions based on NSTI threshold.
-    Set prediction values to NaN when NSTI exceeds the threshold.
+    Set prediction values to missing when NSTI exceeds the threshold.
     Drop trait and NSTI columns when threshold is 0.
 
     Args:
-        prediction_path: Path to prediction results file (will be overwritten)
+        predictions: Typed prediction results, with NSTI columns
         threshold_path: Path to NSTI threshold file
         threshold_column: Column name in threshold file to use ('cor_0.5' or 'cor_0')
+    Returns:
+        Filtered predictions
     """
-    # Load prediction results as strings to preserve categorical traits as integers
-    predictions = pd.read_csv(prediction_path, sep='\t', dtype=str)
+    predictions = predictions.copy()
 
     # Load NSTI thresholds
-    thresholds = pd.read_csv(threshold_path, sep='\t', index_col='trait')
+    thresholds = load_thresholds(threshold_path)
 
     # Track columns to drop (traits with threshold = 0)
     columns_to_drop = []
@@ -108,12 +196,37 @@ def filter_predictions_by_nsti(
 
                 # Set trait values to NaN where NSTI exceeds threshold
                 mask = nsti_numeric > threshold_value
-                predictions.loc[mask, trait_col] = ''
+                predictions.loc[mask, trait_col] = np.nan
 
     # Drop columns where threshold is 0
     if columns_to_drop:
         predictions = predictions.drop(columns=columns_to_drop)
 
-    # Save filtered predictions
-    predictions.to_csv(prediction_path, sep='\t', index=False)
-    return
+    return predictions
+
+def load_thresholds(threshold_path: str) -> pd.DataFrame:
+    """
+    NSTI thresholds per trait (numeric columns of the threshold file), from the
+    reference index when it was built from this file. Kept in memory until the file changes.
+    """
+    return _load_thresholds(threshold_path, os.stat(threshold_path).st_mtime_ns)
+
+@lru_cache(maxsize=2)
+def _load_thresholds(threshold_path: str, mtime_ns: int) -> pd.DataFrame:
+    index = load_section('threshold', threshold=threshold_path)
+    if index is None:
+        return read_thresholds(threshold_path)
+    return pd.DataFrame(np.asarray(index['values']), index=pd.Index(index['traits'].astype(object), name='trait'),
+                        columns=[str(col) for col in index['columns']])
+
+def read_thresholds(threshold_path: str) -> pd.DataFrame:
+    thresholds = pd.read_csv(threshold_path, sep='\t', index_col='trait')
+    thresholds.index = thresholds.index.astype(str)
+    return thresholds.select_dtypes('number').astype(np.float64)
+
+def threshold_index_arrays(threshold_path: str) -> dict:
+    """Arrays of the 'threshold' section of the reference index (see build-index)."""
+    thresholds = read_thresholds(threshold_path)
+    return dict(traits=thresholds.index.to_numpy(dtype=str),
+                columns=np.array(list(thresholds.columns), dtype=str),
+                values=thresholds.to_numpy(dtype=np.float64))
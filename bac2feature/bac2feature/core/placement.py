@@ -0,0 +1,296 @@
+### library ###
+from concurrent.futures import ProcessPoolExecutor
+import json
+import os
+from os.path import exists, join
+import shutil
+import socket
+import threading
+import time
+from typing import List, Optional
+import uuid
+
+from bac2feature.core import profiling
+from bac2feature.core.utils import read_fasta
+
+# Job queue on a shared filesystem: a claimed job is touched every HEARTBEAT_INTERVAL
+# seconds and returned to the queue if not touched for STALE_AFTER seconds.
+# Running files are named <job>@<worker> so that a worker only removes its own claim
+HEARTBEAT_INTERVAL = 30
+STALE_AFTER = 600
+POLL_INTERVAL = 5
+
+### main func ###
+def place_seqs(
+    input_fasta: str, out_tree: str, intermediate_dir: str, ref_dir_placement: str, threads=1,
+    placement_shards=1, placement_queue: Optional[str] = None) -> None:
+    """
+    Place sequences on the reference tree with PICRUSt2 (hmmalign and epa-ng).
+    With placement_shards > 1, the sequences are split into shards placed by worker processes,
+    or by workers of a job queue in the shared directory placement_queue
+    ('bac2feature placement_worker'), and the placements are merged before grafting.
+    """
+    if placement_shards <= 1 and placement_queue is None:
+        place_shard(study_fasta=input_fasta, out_dir=intermediate_dir,
+                    ref_dir_placement=ref_dir_placement, threads=threads, out_tree=out_tree)
+        return
+
+    if placement_queue is None:
+        shard_dir = join(intermediate_dir, 'placement_shards')
+        shards = split_fasta(input_fasta, shard_dir, placement_shards)
+        jplace_files = place_shards_locally(shards, ref_dir_placement, threads)
+    else:
+        # Shards are written to the shared directory so that any node can place them
+        run_id = f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}'
+        shard_dir = join(placement_queue, 'runs', run_id)
+        shards = split_fasta(input_fasta, shard_dir, max(1, placement_shards))
+        jplace_files = place_shards_by_queue(shards, ref_dir_placement, threads,
+                                             queue_dir=placement_queue, run_id=run_id)
+    if not jplace_files:
+        # No sequences to shard: placed as without sharding
+        if placement_queue is not None:
+            shutil.rmtree(shard_dir)
+        place_shard(study_fasta=input_fasta, out_dir=intermediate_dir,
+                    ref_dir_placement=ref_dir_placement, threads=threads, out_tree=out_tree)
+        return
+
+    from picrust2.place_seqs import gappa_jplace_to_newick
+
+    merged_jplace = join(intermediate_dir, 'merged_placements.jplace')
+    merge_jplace(jplace_files, merged_jplace)
+    if placement_queue is not None:
+        shutil.rmtree(shard_dir)
+    gappa_jplace_to_newick(jplace_file=merged_jplace, outfile=out_tree)
+    return
+
+def work_queue(queue_dir: str, threads=1, wait=0.0, run_id: Optional[str] = None) -> int:
+    """
+    Place shards of the job queue in queue_dir until no job is left
+    (after waiting up to wait seconds for new jobs). Only jobs of run_id if given.
+    Returns the number of jobs placed.
+    """
+    worker = worker_id()
+    n_jobs = 0
+    idle_since = time.time()
+    while True:
+        job_name = claim_job(queue_dir, run_id, worker)
+        if job_name is not None:
+            run_job(queue_dir, job_name, threads, worker)
+            n_jobs += 1
+            idle_since = time.time()
+        elif time.time() - idle_since >= wait:
+            return n_jobs
+        else:
+            time.sleep(POLL_INTERVAL)
+
+### func ###
+def place_shard(
+    study_fasta: str, out_dir: str, ref_dir_placement: str, threads=1,
+    out_tree: Optional[str] = None) -> str:
+    """Place one shard by PICRUSt2's pipeline. Returns the path of the epa-ng jplace file."""
+    # picrust2 is slow to import and only needed when sequences are placed
+    from picrust2.place_seqs import place_seqs_pipeline
+
+    os.makedirs(out_dir, exist_ok=True)
+    place_seqs_pipeline(study_fasta=study_fasta,
+                        ref_dir=ref_dir_placement,
+                        placement_tool="epa-ng",
+                        out_tree=out_tree or join(out_dir, 'placed_seqs.tre'),
+                        threads=threads,
+                        out_dir=out_dir,
+                        min_align=0,
+                        chunk_size=5000,
+                        verbose=False
+                        )
+    return join(out_dir, 'epa_out', 'epa_result.jplace')
+
+def split_fasta(input_fasta: str, shard_dir: str, n_shards: int) -> List[str]:
+    """
+    Split sequences into n_shards FASTA files in turn (shards differ by at most one sequence).
+    Returns the paths of non-empty shards.
+    """
+    os.makedirs(shard_dir, exist_ok=True)
+    paths = [join(shard_dir, f'shard_{i:04d}', 'input.fasta') for i in range(n_shards)]
+    handles, n_seqs = {}, 0
+    try:
+        for seq_id, seq in read_fasta(input_fasta):
+            i = n_seqs % n_shards
+            if i not in handles:
+                os.makedirs(os.path.dirname(paths[i]), exist_ok=True)
+                handles[i] = open(paths[i], 'w')
+            handles[i].write(f'>{seq_id}\n{seq}\n')
+            n_seqs += 1
+    finally:
+        for handle in handles.values():
+            handle.close()
+    return [paths[i] for i in sorted(handles)]
+
+def place_shards_locally(shards: List[str], ref_dir_placement: str, threads: int) -> List[str]:
+    """Place shards in a process pool sharing the thread budget (no placements without shards)."""
+    if not shards:
+        return []
+    shard_threads = max(1, int(threads) // len(shards))
+    with ProcessPoolExecutor(max_workers=len(shards)) as pool:
+        futures = []
+        for shard in shards:
+            shard_options = dict(study_fasta=shard, out_dir=os.path.dirname(shard),
+                                 ref_dir_placement=ref_dir_placement, threads=shard_threads)
+            if profiling.is_recording():
+                futures.append(pool.submit(profiling.record_call, place_shard, **shard_options))
+            else:
+                futures.append(pool.submit(place_shard, **shard_options))
+        jplace_files = []
+        for future in futures:
+            result = future.result()
+            if profiling.is_recording():
+                result, records, origin = result
+                profiling.merge_records(records, origin)
+            jplace_files.append(result)
+    return jplace_files
+
+def place_shards_by_queue(
+    shards: List[str], ref_dir_placement: str, threads: int, queue_dir: str, run_id: str) -> List[str]:
+    """
+    Submit shards to the job queue, place shards of this run here as well, and wait until
+    all shards are placed. Jobs of workers that stopped sending heartbeats are resubmitted.
+    """
+    for subdir in ('pending', 'running', 'done'):
+        os.makedirs(join(queue_dir, subdir), exist_ok=True)
+    job_names = []
+    for i, shard in enumerate(shards):
+        job_name = f'{run_id}_shard_{i:04d}'
+        write_json(join(queue_dir, 'pending', f'{job_name}.json'),
+                   dict(study_fasta=os.path.abspath(shard),
+                        out_dir=os.path.abspath(os.path.dirname(shard)),
+                        ref_dir_placement=os.path.abspath(ref_dir_placement)))
+        job_names.append(job_name)
+    print(f'{len(job_names)} placement jobs are submitted to {queue_dir}.')
+
+    while True:
+        # This process works on its own jobs while they are pending
+        work_queue(queue_dir, threads=threads, run_id=run_id)
+        results = [read_job_result(queue_dir, job_name) for job_name in job_names]
+        if all(result is not None for result in results):
+            break
+        requeue_stale_jobs(queue_dir, run_id)
+        time.sleep(POLL_INTERVAL)
+
+    jplace_files = []
+    for job_name, result in zip(job_names, results):
+        if result['status'] != 'ok':
+            raise RuntimeError(f'Placement of {job_name} failed on {result["host"]}: {result["message"]}')
+        jplace_files.append(result['jplace'])
+        os.remove(join(queue_dir, 'done', f'{job_name}.json'))
+    return jplace_files
+
+def worker_id() -> str:
+    return f'{socket.gethostname()}_{os.getpid()}_{threading.get_ident()}'
+
+def running_path(queue_dir: str, job_name: str, worker: str) -> str:
+    return join(queue_dir, 'running', f'{job_name}@{worker}.json')
+
+def claim_job(queue_dir: str, run_id: Optional[str] = None, worker: Optional[str] = None) -> Optional[str]:
+    """
+    Claim a pending job for worker by moving it to running (atomic on a shared filesystem).
+    Returns the job name.
+    """
+    worker = worker or worker_id()
+    try:
+        pending = sorted(os.listdir(join(queue_dir, 'pending')))
+    except FileNotFoundError:
+        return None
+    for file_name in pending:
+        # Skip files being written and jobs of other runs
+        if not file_name.endswith('.json') or (run_id is not None and not file_name.startswith(f'{run_id}_')):
+            continue
+        job_name = file_name[:-len('.json')]
+        try:
+            os.rename(join(queue_dir, 'pending', file_name), running_path(queue_dir, job_name, worker))
+        except FileNotFoundError:
+            # Claimed by another worker
+            continue
+        return job_name
+    return None
+
+def run_job(queue_dir: str, job_name: str, threads: int, worker: Optional[str] = None) -> None:
+    """
+    Place the shard of a job claimed by worker and record the result in done.
+    If the job was resubmitted meanwhile, the claim of the new worker is left as it is.
+    """
+    running = running_path(queue_dir, job_name, worker or worker_id())
+    with open(running) as f:
+        job = json.load(f)
+    stopped = threading.Event()
+    heartbeat = threading.Thread(target=touch_until, args=(running, stopped), daemon=True)
+    heartbeat.start()
+    result = dict(host=socket.gethostname())
+    try:
+        jplace = place_shard(study_fasta=job['study_fasta'], out_dir=job['out_dir'],
+                             ref_dir_placement=job['ref_dir_placement'], threads=threads)
+        result.update(status='ok', jplace=jplace)
+    except Exception as e:
+        result.update(status='error', message=str(e))
+    finally:
+        stopped.set()
+        heartbeat.join()
+    write_json(join(queue_dir, 'done', f'{job_name}.json'), result)
+    try:
+        os.remove(running)
+    except FileNotFoundError:
+        # Resubmitted as stale
+        pass
+    return
+
+def touch_until(path: str, stopped: threading.Event) -> None:
+    while not stopped.wait(HEARTBEAT_INTERVAL):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+
+def requeue_stale_jobs(queue_dir: str, run_id: str) -> None:
+    """Return running jobs of run_id without a recent heartbeat to pending."""
+    now = time.time()
+    for file_name in os.listdir(join(queue_dir, 'running')):
+        if not (file_name.endswith('.json') and file_name.startswith(f'{run_id}_')):
+            continue
+        running = join(queue_dir, 'running', file_name)
+        job_name = file_name[:-len('.json')].rsplit('@', 1)[0]
+        try:
+            if now - os.stat(running).st_mtime > STALE_AFTER:
+                os.rename(running, join(queue_dir, 'pending', f'{job_name}.json'))
+                print(f'Placement job {job_name} is resubmitted.')
+        except FileNotFoundError:
+            continue
+    return
+
+def read_job_result(queue_dir: str, job_name: str) -> Optional[dict]:
+    done = join(queue_dir, 'done', f'{job_name}.json')
+    if not exists(done):
+        return None
+    with open(done) as f:
+        return json.load(f)
+
+def write_json(path: str, data: dict) -> None:
+    """Write JSON atomically so that readers on other nodes never see a partial file."""
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp_path, path)
+    return
+
+def merge_jplace(jplace_files: List[str], out_jplace: str) -> None:
+    """Merge placements of shards on the same reference tree into one jplace file."""
+    merged = None
+    for jplace_file in jplace_files:
+        with open(jplace_file) as f:
+            jplace = json.load(f)
+        if merged is None:
+            merged = jplace
+            continue
+        if jplace['tree'] != merged['tree'] or jplace['fields'] != merged['fields']:
+            raise ValueError(f'{jplace_file} is placed on a different reference tree.')
+        merged['placements'].extend(jplace['placements'])
+    with open(out_jplace, 'w') as f:
+        json.dump(merged, f)
+    return
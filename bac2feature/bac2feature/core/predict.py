@@ -0,0 +1,105 @@
+### library ###
+import os
+from typing import TYPE_CHECKING, List, Optional, Tuple
+
+# Backends of the methods are imported by predict_by_method, so that importing this
+# module stays cheap for the command line
+import bac2feature.core.default as default
+from bac2feature.core.utils import write_fasta
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+PREDICTION_METHOD = ['homology', 'taxonomy', 'phylogeny']
+HSP_BACKEND = ['python', 'R']
+TAXONOMY_BACKEND = ['sklearn', 'qiime']
+
+### func ###
+def cache_context(
+    estimation_method: str, check_nsti: bool, filter_by_nsti: bool, hsp_backend: str,
+    taxonomy_backend: str, ref_trait: str, ref_blastdb: str, ref_nb_classifier: str, ref_trait_taxonomy: str,
+    qiime_env: str, ref_dir_placement: str,
+    placement_shards: int = 1, placement_queue: Optional[str] = None,
+    kmer_prefilter: Optional[float] = None, resume: bool = False, force_from: Optional[str] = None) -> dict:
+    """
+    References and options that determine the predictions of each method.
+    Sharding and checkpoints do not change predictions, so they are not part of the context.
+    Homology-based prediction caches the hits of each sequence rather than its row.
+    """
+    if estimation_method == 'homology':
+        references = [ref_trait, ref_blastdb]
+        options = {'cached': 'hits'}
+        if kmer_prefilter is not None:
+            options['kmer_prefilter'] = kmer_prefilter
+    elif estimation_method == 'taxonomy':
+        references = [ref_nb_classifier, ref_trait_taxonomy]
+        options = {}
+    else:
+        references = [ref_trait, ref_dir_placement, default.threshold_phylodistance]
+        options = {'check_nsti': check_nsti, 'filter_by_nsti': filter_by_nsti, 'hsp_backend': hsp_backend}
+    return dict(method=estimation_method, references=references, options=options)
+
+def predict_by_method(
+    input_fasta: str, work_dir: str, estimation_method: str, threads: int,
+    check_nsti: bool, filter_by_nsti: bool, hsp_backend: str, taxonomy_backend: str,
+    ref_trait: str, ref_blastdb: str, ref_nb_classifier: str, ref_trait_taxonomy: str,
+    qiime_env: str, ref_dir_placement: str,
+    placement_shards: int = 1, placement_queue: Optional[str] = None,
+    kmer_prefilter: Optional[float] = None, resume: bool = False, force_from: Optional[str] = None,
+    records: Optional[List[Tuple[str, str]]] = None) -> 'pd.DataFrame':
+    """
+    Predict traits by the selected method as a typed table.
+    records are the sequences to predict when input_fasta cannot be used as is (compressed,
+    standard input or dereplicated): they are streamed to BLASTn, and written once to an
+    uncompressed file for the tools that read files.
+    With resume, checkpointed stages of a previous run in work_dir are reused.
+    """
+    # Only the backend of the selected method is imported
+    if estimation_method == 'homology':
+        from bac2feature.core.homology_based_prediction import homology_predictions
+        return homology_predictions(
+            input_fasta=input_fasta,
+            intermediate_dir=work_dir,
+            ref_blastdb=ref_blastdb,
+            ref_trait=ref_trait,
+            perc_identity=None,
+            check_nsti=check_nsti,
+            threads=threads,
+            query_records=records,
+            kmer_prefilter=kmer_prefilter,
+            resume=resume,
+            force_from=force_from
+        )
+    if records is not None:
+        input_fasta = os.path.join(work_dir, 'query.fasta')
+        write_fasta(records, input_fasta)
+    if estimation_method == 'taxonomy':
+        from bac2feature.core.taxonomy_based_prediction import taxonomy_predictions
+        return taxonomy_predictions(
+            input_fasta=input_fasta,
+            intermediate_dir=work_dir,
+            ref_nb_classifier=ref_nb_classifier,
+            ref_trait_taxonomy=ref_trait_taxonomy,
+            qiime_env=qiime_env,
+            threads=threads,
+            taxonomy_backend=taxonomy_backend,
+            resume=resume,
+            force_from=force_from
+        )
+    elif estimation_method == 'phylogeny':
+        from bac2feature.core.phylogeny_based_prediction import phylogeny_predictions
+        return phylogeny_predictions(
+            input_fasta=input_fasta,
+            intermediate_dir=work_dir,
+            ref_dir_placement=ref_dir_placement,
+            ref_trait=ref_trait,
+            check_nsti=check_nsti,
+            filter_by_nsti=filter_by_nsti,
+            threads=threads,
+            hsp_backend=hsp_backend,
+            placement_shards=placement_shards,
+            placement_queue=placement_queue,
+            resume=resume,
+            force_from=force_from
+        )
+    raise ValueError(f'Unknown method: {estimation_method}')
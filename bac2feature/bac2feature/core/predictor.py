@@ -0,0 +1,114 @@
+### library ###
+import os
+from typing import Iterable, Iterator, Optional, Tuple, Union
+
+import pandas as pd
+
+import bac2feature.core.default as default
+from bac2feature.core.predict import PREDICTION_METHOD, predict_by_method
+from bac2feature.core.table import fan_out_predictions, prediction_arrays
+from bac2feature.core.utils import dereplicate, get_intermediate_dir
+
+### class ###
+class Predictor:
+    """
+    Predict traits of sequences from Python, without input or output files.
+
+    References of the method are loaded when the predictor is created and kept in
+    memory for later calls. Queries are streamed to BLASTn, and the taxonomy of the
+    in-process classifier and HSP results are passed in memory; only the tools that
+    read files (the classifier and phylogenetic placement) get a FASTA file in
+    work_dir (a temporary directory by default).
+
+    Usage example:
+    predictor = Predictor(method='homology', threads=4)
+    predictions = predictor.predict([('ASV1', 'ACGT...'), ('ASV2', 'ACGT...')])
+    """
+    def __init__(self, method: str = 'phylogeny', threads: int = 1, check_nsti: bool = False,
+                 filter_by_nsti: bool = True, hsp_backend: str = 'python', taxonomy_backend: str = 'sklearn',
+                 kmer_prefilter: Optional[float] = None,
+                 ref_trait=default.ref_trait, ref_blastdb=default.ref_blastdb,
+                 ref_nb_classifier=default.ref_nb_classifier, ref_trait_taxonomy=default.ref_trait_taxonomy,
+                 qiime_env=default.qiime_env, ref_dir_placement=default.ref_dir_phylogeny,
+                 work_dir: Optional[str] = None):
+        if method not in PREDICTION_METHOD:
+            raise ValueError(f'Unknown method: {method}')
+        self.method = method
+        self.threads = threads
+        self.work_dir = work_dir
+        self.options = dict(
+            check_nsti=check_nsti, filter_by_nsti=filter_by_nsti, hsp_backend=hsp_backend,
+            taxonomy_backend=taxonomy_backend, ref_trait=ref_trait, ref_blastdb=ref_blastdb,
+            ref_nb_classifier=ref_nb_classifier, ref_trait_taxonomy=ref_trait_taxonomy,
+            qiime_env=qiime_env, ref_dir_placement=ref_dir_placement,
+            kmer_prefilter=kmer_prefilter)
+        load_references(method, **self.options)
+
+    def predict(self, sequences: Union[Iterable[Tuple[str, str]], pd.DataFrame, pd.Series],
+                as_arrays: bool = False):
+        """
+        Predict traits of (ID, sequence) pairs, or of a DataFrame of IDs and sequences
+        (its first two columns, or the index and its only column).
+        Returns a typed table as written by the command line (input order, identical
+        sequences predicted once, sequences without prediction left out), or with as_arrays,
+        the sequence IDs, column names and a float64 matrix of values (NaN if missing).
+        """
+        sequence_ids, representatives = [], []
+        records = list(dereplicate(iter_records(sequences), sequence_ids, representatives))
+        if records:
+            with get_intermediate_dir(self.work_dir) as work_dir:
+                predictions = predict_by_method(input_fasta=None, work_dir=work_dir,
+                                                estimation_method=self.method, threads=self.threads,
+                                                records=records, **self.options)
+            predictions = fan_out_predictions(predictions, sequence_ids, representatives)
+        else:
+            predictions = pd.DataFrame({'sequence': pd.Series(dtype=object)})
+        if as_arrays:
+            return prediction_arrays(predictions)
+        return predictions
+
+### func ###
+def iter_records(sequences: Union[Iterable[Tuple[str, str]], pd.DataFrame, pd.Series]) -> Iterator[Tuple[str, str]]:
+    """(ID, sequence) pairs of pairs, a DataFrame or a Series of sequences indexed by ID."""
+    if isinstance(sequences, pd.Series):
+        return zip(sequences.index.astype(str), sequences.astype(str))
+    if isinstance(sequences, pd.DataFrame):
+        if sequences.shape[1] == 1:
+            return iter_records(sequences.iloc[:, 0])
+        return zip(sequences.iloc[:, 0].astype(str), sequences.iloc[:, 1].astype(str))
+    return ((str(seq_id), str(seq)) for seq_id, seq in sequences)
+
+def load_references(
+    method: str, ref_trait: str, ref_blastdb: str, ref_nb_classifier: str, ref_trait_taxonomy: str,
+    ref_dir_placement: str = default.ref_dir_placement, taxonomy_backend: str = 'sklearn',
+    kmer_prefilter: Optional[float] = None, **options) -> None:
+    """
+    Load the references of a method in memory (kept for later predictions in this process).
+    References that are not installed are skipped.
+    """
+    from bac2feature.core.table import categorical_traits
+
+    if method in ('homology', 'phylogeny') and os.path.exists(ref_trait):
+        categorical_traits(ref_trait)
+    if method == 'homology':
+        from bac2feature.core.homology_based_prediction import load_trait_matrix
+        if os.path.exists(ref_trait):
+            load_trait_matrix(ref_trait)
+        if kmer_prefilter is not None:
+            from bac2feature.core.kmer_index import load_kmer_index
+            load_kmer_index(ref_blastdb)
+    elif method == 'taxonomy':
+        from bac2feature.core.taxonomy_based_prediction import has_q2_feature_classifier, load_emp_table
+        if os.path.exists(ref_trait_taxonomy):
+            load_emp_table(ref_trait_taxonomy)
+        if taxonomy_backend == 'sklearn' and has_q2_feature_classifier() and os.path.exists(ref_nb_classifier):
+            from bac2feature.core.nb_classify import load_classifier
+            load_classifier(ref_nb_classifier)
+    elif method == 'phylogeny':
+        from bac2feature.core.phylogeny_based_prediction import load_thresholds
+        from bac2feature.core.ref_index import load_section
+        if os.path.exists(default.threshold_phylodistance):
+            load_thresholds(default.threshold_phylodistance)
+        load_section('hsp', tree=os.path.join(ref_dir_placement, os.path.basename(default.tree)),
+                     ref_trait=ref_trait)
+    return
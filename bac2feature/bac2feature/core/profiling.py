@@ -0,0 +1,208 @@
+### library ###
+from contextlib import contextmanager
+import json
+import os
+import resource
+import subprocess
+import threading
+import time
+from typing import Callable, List, Optional
+
+# Resource usage of the calling thread where available (Linux), otherwise of the process
+RUSAGE_THREAD = getattr(resource, 'RUSAGE_THREAD', resource.RUSAGE_SELF)
+
+### class ###
+class StageRecorder:
+    """
+    Records wall time, CPU time and peak memory of named stages and subprocesses.
+
+    CPU time of a stage is that of its own thread (stages may run in several threads
+    at once) plus that of subprocesses finished during the stage. Memory of the process
+    and of the process tree including subprocesses is sampled every sample_interval
+    seconds. Subprocesses run by run() report their CPU time at exit and the sampled
+    peak memory of their own process tree.
+    """
+    def __init__(self, sample_interval: float = 0.1):
+        self.records = []
+        self.samples = []
+        self.lock = threading.Lock()
+        self.origin = time.time()
+        self.sample_interval = sample_interval
+        self.stopped = threading.Event()
+        self.sampler = threading.Thread(target=self._sample_memory, daemon=True)
+        self.sampler.start()
+
+    def stop(self) -> None:
+        self.stopped.set()
+        self.sampler.join()
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.time()
+        thread_usage = resource.getrusage(RUSAGE_THREAD)
+        child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        try:
+            yield
+        finally:
+            end = time.time()
+            thread_end = resource.getrusage(RUSAGE_THREAD)
+            child_end = resource.getrusage(resource.RUSAGE_CHILDREN)
+            self._add(dict(
+                name=name, type='stage', start=start - self.origin, wall=end - start,
+                cpu=(thread_end.ru_utime - thread_usage.ru_utime
+                     + thread_end.ru_stime - thread_usage.ru_stime),
+                child_cpu=(child_end.ru_utime - child_usage.ru_utime
+                           + child_end.ru_stime - child_usage.ru_stime),
+                **self._peak_rss(start, end)))
+
+    def run(self, cmd: List[str], name: Optional[str] = None, check: bool = False,
+            **kwargs) -> subprocess.CompletedProcess:
+        """Run a command like subprocess.run (without capturing output) and record it."""
+        name = name or os.path.basename(cmd[0])
+        start = time.time()
+        process = subprocess.Popen(cmd, **kwargs)
+        # ru_maxrss of a child also counts the memory of this process at fork,
+        # so the peak is sampled from the process tree of the child instead
+        peak_rss = 0.0
+        while True:
+            # wait4 reports the usage of the child including its own finished children
+            pid, status, usage = os.wait4(process.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            peak_rss = max(peak_rss, process_tree_rss_mb(process.pid))
+            time.sleep(self.sample_interval / 2)
+        end = time.time()
+        process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        self._add(dict(
+            name=name, type='subprocess', start=start - self.origin, wall=end - start,
+            cpu=usage.ru_utime + usage.ru_stime, peak_rss_mb=peak_rss or usage.ru_maxrss / 1024,
+            command=' '.join(map(str, cmd)), returncode=process.returncode))
+        if check and process.returncode != 0:
+            raise subprocess.CalledProcessError(process.returncode, cmd)
+        return subprocess.CompletedProcess(cmd, process.returncode)
+
+    def merge(self, records: List[dict], origin: float) -> None:
+        """Add records of another process (e.g. a chunk worker) started at origin."""
+        for record in records:
+            self._add(dict(record, start=record['start'] + origin - self.origin))
+
+    def _add(self, record: dict) -> None:
+        record.setdefault('pid', os.getpid())
+        record.setdefault('thread', threading.get_native_id())
+        with self.lock:
+            self.records.append(record)
+
+    def _sample_memory(self) -> None:
+        pid = os.getpid()
+        while True:
+            sample = (time.time() - self.origin, current_rss_mb(), process_tree_rss_mb(pid))
+            with self.lock:
+                self.samples.append(sample)
+            if self.stopped.wait(self.sample_interval):
+                return
+
+    def _peak_rss(self, start: float, end: float) -> dict:
+        start, end = start - self.origin, end - self.origin
+        with self.lock:
+            window = [sample for sample in self.samples if start <= sample[0] <= end]
+        return dict(peak_rss_mb=max([rss for _, rss, _ in window] + [current_rss_mb()]),
+                    peak_tree_rss_mb=max([tree for _, _, tree in window] + [0.0]) or None)
+
+### func ###
+_recorder: Optional[StageRecorder] = None
+
+def start_recording() -> StageRecorder:
+    """Start recording stages of this process."""
+    global _recorder
+    _recorder = StageRecorder()
+    return _recorder
+
+def stop_recording() -> List[dict]:
+    """Stop recording and return the recorded stages and subprocesses in order of start."""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is None:
+        return []
+    recorder.stop()
+    return sorted(recorder.records, key=lambda record: record['start'])
+
+def is_recording() -> bool:
+    return _recorder is not None
+
+@contextmanager
+def stage(name: str):
+    """Record the enclosed block as a stage if recording is active."""
+    if _recorder is None:
+        yield
+    else:
+        with _recorder.stage(name):
+            yield
+
+def run(cmd: List[str], name: Optional[str] = None, **kwargs) -> subprocess.CompletedProcess:
+    """subprocess.run that records the command if recording is active."""
+    if _recorder is None:
+        return subprocess.run(cmd, **kwargs)
+    return _recorder.run(cmd, name=name, **kwargs)
+
+def record_call(func: Callable, **kwargs):
+    """
+    Call func with recording in a worker process.
+    Returns the result of func, the records and the origin of their start times.
+    """
+    recorder = start_recording()
+    try:
+        result = func(**kwargs)
+    finally:
+        records = stop_recording()
+    return result, records, recorder.origin
+
+def merge_records(records: List[dict], origin: float) -> None:
+    """Add records returned by record_call to the active recording."""
+    if _recorder is not None:
+        _recorder.merge(records, origin)
+
+def current_rss_mb() -> float:
+    """Resident set size of this process."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    except OSError:
+        # Peak instead of current RSS where /proc is not available
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def process_tree_rss_mb(pid: int) -> float:
+    """Total resident set size of a process and its descendants (0 if not available)."""
+    total, pids = 0.0, [pid]
+    page_mb = os.sysconf('SC_PAGE_SIZE') / 1024 / 1024
+    while pids:
+        pid = pids.pop()
+        try:
+            with open(f'/proc/{pid}/statm') as f:
+                total += int(f.read().split()[1]) * page_mb
+            for task in os.listdir(f'/proc/{pid}/task'):
+                with open(f'/proc/{pid}/task/{task}/children') as f:
+                    pids.extend(int(child) for child in f.read().split())
+        except (OSError, ValueError):
+            # The process has exited or /proc is not available
+            continue
+    return total
+
+def write_trace(records: List[dict], out_path: str, trace_format: str = 'json') -> None:
+    """
+    Write recorded stages as a JSON trace, or in the Chrome trace event format
+    (chrome://tracing, Perfetto) with trace_format='chrome'.
+    """
+    if trace_format == 'chrome':
+        events = []
+        for record in records:
+            args = {k: v for k, v in record.items()
+                    if k not in ('name', 'type', 'start', 'wall', 'pid', 'thread')}
+            events.append({'name': record['name'], 'cat': record['type'], 'ph': 'X',
+                           'ts': record['start'] * 1e6, 'dur': record['wall'] * 1e6,
+                           'pid': record['pid'], 'tid': record['thread'], 'args': args})
+        trace = {'traceEvents': events, 'displayTimeUnit': 'ms'}
+    else:
+        trace = {'records': records}
+    with open(out_path, 'w') as f:
+        json.dump(trace, f, indent=1)
+    return
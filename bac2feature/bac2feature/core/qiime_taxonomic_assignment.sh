@@ -1,29 +1,37 @@
 #!/usr/bin/bash
 
-while getopts i:o:c:t: option
+while getopts i:o:c:t:d: option
 do
   case $option in
     i ) in_fasta_path=$OPTARG;;
     o ) out_taxonomy_path=$OPTARG;;
     c ) ref_classifier_path=$OPTARG;;
     t ) threads=$OPTARG;;
+    d ) work_dir=$OPTARG;;
     \?) echo "This is unexpected option." 1>&2
         exit 1
   esac
 done
 
-intermediate_seq_qza_path="intermediate_seq.qza"
-intermediate_tax_qza_path="intermediate_tax.qza"
+# Keep intermediate files out of the current directory so that concurrent runs do not collide
+if [ -z "$work_dir" ]; then
+  work_dir=$(dirname "$out_taxonomy_path")
+fi
+work_dir=$(mktemp -d "$work_dir/qiime_XXXXXX")
+export TMPDIR=$work_dir
+
+intermediate_seq_qza_path="$work_dir/intermediate_seq.qza"
+intermediate_tax_qza_path="$work_dir/intermediate_tax.qza"
 
 # Import
-qiime tools import --type 'FeatureData[Sequence]' --input-path $in_fasta_path --output-path $intermediate_seq_qza_path > /dev/null
+qiime tools import --type 'FeatureData[Sequence]' --input-path "$in_fasta_path" --output-path "$intermediate_seq_qza_path" > /dev/null
 
 # Taxonomic assignment
-qiime feature-classifier classify-sklearn --i-classifier $ref_classifier_path --i-reads $intermediate_seq_qza_path --o-classification $intermediate_tax_qza_path --p-n-jobs $threads > /dev/null
+qiime feature-classifier classify-sklearn --i-classifier "$ref_classifier_path" --i-reads "$intermediate_seq_qza_path" --o-classification "$intermediate_tax_qza_path" --p-n-jobs $threads > /dev/null
 
 # Export
-qiime tools export --input-path $intermediate_tax_qza_path --output-path . > /dev/null
+qiime tools export --input-path "$intermediate_tax_qza_path" --output-path "$work_dir" > /dev/null
 
 # Rename
-mv ./taxonomy.tsv $out_taxonomy_path
-yes | rm $intermediate_seq_qza_path $intermediate_tax_qza_path
+mv "$work_dir/taxonomy.tsv" "$out_taxonomy_path"
+rm -rf "$work_dir"
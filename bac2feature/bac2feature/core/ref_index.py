@@ -0,0 +1,110 @@
+### library ###
+from functools import lru_cache
+import json
+import os
+from os.path import exists, join
+from typing import Dict, Optional
+
+import numpy as np
+
+import bac2feature.core.default as default
+from bac2feature.core.utils import file_sha1
+
+# Layout of the reference index: one directory of .npy files per section and
+# manifest.json recording the source files of each section (path, size, mtime and SHA-1)
+REF_INDEX_VERSION = 1
+MANIFEST = 'manifest.json'
+
+### main func ###
+def write_ref_index(out_dir: str, sections: Dict[str, tuple]) -> None:
+    """
+    Write sections of the reference index. sections maps a section name to
+    (arrays, sources): arrays are saved as .npy files that can be memory-mapped
+    (no object arrays) and sources are the files the arrays were compiled from.
+    The manifest is written last, so a partial index is never used.
+    Other sections of an existing index are kept.
+    """
+    manifest = {'version': REF_INDEX_VERSION, 'sections': {}}
+    manifest_path = join(out_dir, MANIFEST)
+    if exists(manifest_path):
+        with open(manifest_path) as f:
+            previous = json.load(f)
+        if previous.get('version') == REF_INDEX_VERSION:
+            manifest = previous
+    os.makedirs(out_dir, exist_ok=True)
+    for name, (arrays, sources) in sections.items():
+        section_dir = join(out_dir, name)
+        os.makedirs(section_dir, exist_ok=True)
+        for key, array in arrays.items():
+            array = np.asarray(array)
+            if array.dtype == object:
+                raise TypeError(f'{name}/{key} is an object array and cannot be memory-mapped.')
+            # Replaced rather than overwritten, so that processes mapping an older index keep it
+            array_path = join(section_dir, f'{key}.npy')
+            with open(f'{array_path}.tmp', 'wb') as f:
+                np.save(f, array, allow_pickle=False)
+            os.replace(f'{array_path}.tmp', array_path)
+        manifest['sections'][name] = {
+            'arrays': sorted(arrays),
+            'sources': {key: source_entry(path) for key, path in sources.items()}}
+    with open(f'{manifest_path}.tmp', 'w') as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(f'{manifest_path}.tmp', manifest_path)
+    return
+
+def load_section(
+    section: str, index_dir: Optional[str] = None, **sources: str) -> Optional[Dict[str, np.ndarray]]:
+    """
+    Memory-mapped arrays of a section of the reference index in index_dir
+    (default.ref_index by default), or None if there is no index or it was built
+    from different source files (compared by content).
+    """
+    index_dir = default.ref_index if index_dir is None else index_dir
+    manifest_path = join(index_dir, MANIFEST)
+    if not exists(manifest_path):
+        return None
+    manifest = read_manifest(manifest_path, os.stat(manifest_path).st_mtime_ns)
+    entry = manifest['sections'].get(section)
+    if manifest['version'] != REF_INDEX_VERSION or entry is None or set(entry['sources']) != set(sources):
+        return None
+    for key, path in sources.items():
+        if not same_content(path, entry['sources'][key]):
+            return None
+    return load_arrays(join(index_dir, section), tuple(entry['arrays']),
+                       os.stat(manifest_path).st_mtime_ns)
+
+### func ###
+def source_entry(path: str) -> dict:
+    stat = os.stat(path)
+    return {'path': os.path.abspath(path), 'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+            'sha1': file_sha1(path)}
+
+@lru_cache(maxsize=4)
+def read_manifest(manifest_path: str, mtime_ns: int) -> dict:
+    with open(manifest_path) as f:
+        return json.load(f)
+
+@lru_cache(maxsize=16)
+def load_arrays(section_dir: str, keys: tuple, mtime_ns: int) -> Dict[str, np.ndarray]:
+    # Pages of memory-mapped arrays are shared by processes using the same index
+    return {key: np.load(join(section_dir, f'{key}.npy'), mmap_mode='r', allow_pickle=False)
+            for key in keys}
+
+def same_content(path: str, source: dict) -> bool:
+    """
+    Whether a file has the size and SHA-1 recorded for a source of the index.
+    The source file itself with its recorded size and mtime is trusted without hashing.
+    """
+    if path is None or not exists(path):
+        return False
+    stat = os.stat(path)
+    if stat.st_size != source['size']:
+        return False
+    if os.path.abspath(path) == source['path'] and stat.st_mtime_ns == source.get('mtime_ns'):
+        return True
+    return cached_sha1(path, stat.st_size, stat.st_mtime_ns) == source['sha1']
+
+@lru_cache(maxsize=16)
+def cached_sha1(path: str, size: int, mtime_ns: int) -> str:
+    """SHA-1 of a file, memoized in this process while its size and mtime are unchanged."""
+    return file_sha1(path)
@@ -0,0 +1,191 @@
+### library ###
+from functools import lru_cache
+import gzip
+import os
+from typing import Iterable, List, Optional
+
+import numpy as np
+import pandas as pd
+
+import bac2feature.core.default as default
+from bac2feature.core.hsp import read_ref_trait, split_trait_types
+from bac2feature.core.ref_index import load_section
+
+OUTPUT_FORMAT = default.output_formats
+# Per-trait NSTI and percent identity columns are kept in double precision
+MEASURE_SUFFIXES = ('_nsti', '_pident')
+
+### class ###
+class PredictionWriter:
+    """
+    Write typed prediction tables one after another into one output file
+    (tsv, tsv.gz, parquet or arrow). Columnar formats require pyarrow.
+    'pickle' keeps the types for intermediate files and is written on close.
+    """
+    def __init__(self, out_path: str, out_format: str = 'tsv'):
+        if out_format not in OUTPUT_FORMAT + ['pickle']:
+            raise ValueError(f'Unknown output format: {out_format}')
+        self.out_path = out_path
+        self.out_format = out_format
+        self.handle = None
+        self.writer = None
+        self.schema = None
+        self.frames = []
+
+    def write(self, predictions: pd.DataFrame) -> None:
+        if self.out_format == 'pickle':
+            self.frames.append(predictions)
+            return
+        if self.out_format in ('tsv', 'tsv.gz'):
+            with_header = self.handle is None
+            if self.handle is None:
+                self.handle = (gzip.open(self.out_path, 'wt') if self.out_format == 'tsv.gz'
+                               else open(self.out_path, 'w'))
+            format_predictions(predictions).to_csv(self.handle, sep='\t', index=False, header=with_header)
+            return
+
+        pa = import_pyarrow(self.out_format)
+        predictions = columnar_predictions(predictions)
+        if self.writer is None:
+            self.schema = pa.Schema.from_pandas(predictions, preserve_index=False)
+            if self.out_format == 'parquet':
+                import pyarrow.parquet as pq
+                self.writer = pq.ParquetWriter(self.out_path, self.schema)
+            else:
+                self.writer = pa.ipc.new_file(self.out_path, self.schema)
+        self.writer.write_table(pa.Table.from_pandas(predictions, schema=self.schema, preserve_index=False))
+
+    def close(self) -> None:
+        if self.frames:
+            pd.concat(self.frames, ignore_index=True).to_pickle(self.out_path)
+        if self.handle is not None:
+            self.handle.close()
+        if self.writer is not None:
+            self.writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+### func ###
+def typed_predictions(predictions: pd.DataFrame, categorical: Iterable[str]) -> pd.DataFrame:
+    """
+    Convert prediction columns to typed columns: categorical traits to Int8 and
+    other traits, NSTI and percent identity to float64.
+    Values may be numbers or strings (NA and empty strings are missing).
+    """
+    categorical = set(categorical)
+    typed = {'sequence': predictions['sequence'].astype(str).to_numpy(dtype=object)}
+    for col in predictions.columns[1:]:
+        values = pd.to_numeric(predictions[col], errors='coerce')
+        if col in categorical:
+            typed[col] = values.astype('Int8').array
+        else:
+            typed[col] = values.to_numpy(dtype=np.float64)
+    return pd.DataFrame(typed, columns=list(predictions.columns))
+
+def columnar_predictions(predictions: pd.DataFrame) -> pd.DataFrame:
+    """Typed predictions with continuous traits in float32 for parquet and arrow output."""
+    out = predictions.copy(deep=False)
+    for col in predictions.columns[1:]:
+        if predictions[col].dtype == np.float64 and not col.endswith(MEASURE_SUFFIXES):
+            out[col] = predictions[col].to_numpy(dtype=np.float32)
+    return out
+
+def format_predictions(predictions: pd.DataFrame) -> pd.DataFrame:
+    """
+    Typed predictions as strings for tsv output. Missing values are empty,
+    continuous traits are written as plain decimals with the shortest representation
+    of their double value (no exponent), NSTI and percent identity with 15 significant
+    digits. The first column holds IDs.
+    """
+    id_col = predictions.columns[0]
+    out = {id_col: predictions[id_col].to_numpy(dtype=object)}
+    for col in predictions.columns[1:]:
+        values = predictions[col]
+        missing = values.isna().to_numpy()
+        if isinstance(values.dtype, pd.api.extensions.ExtensionDtype) or values.dtype.kind in 'iu':
+            text = values.to_numpy(dtype=np.float64, na_value=0).astype(np.int64).astype(str)
+        elif col.endswith(MEASURE_SUFFIXES):
+            text = np.char.mod('%.15g', values.to_numpy(dtype=np.float64))
+        else:
+            text = decimal_strings(values.to_numpy(dtype=np.float64))
+        out[col] = np.where(missing, '', text)
+    return pd.DataFrame(out, columns=list(predictions.columns))
+
+def decimal_strings(values: np.ndarray) -> np.ndarray:
+    """Shortest round-trip representation of doubles as plain decimals ('5' rather than '5.0')."""
+    text = values.astype(str).astype(object)
+    exponent = np.flatnonzero(np.char.find(text.astype(str), 'e') >= 0)
+    for i in exponent:
+        text[i] = np.format_float_positional(values[i], trim='-')
+    return pd.Series(text).str.replace(r'\.0$', '', regex=True).to_numpy()
+
+def write_predictions(predictions: pd.DataFrame, out_path: str, out_format: str = 'tsv') -> None:
+    """Write typed predictions once in the given format."""
+    with PredictionWriter(out_path, out_format) as writer:
+        writer.write(predictions)
+    return
+
+def read_predictions(
+    path: str, categorical: Optional[Iterable[str]] = None, in_format: str = 'tsv') -> pd.DataFrame:
+    """
+    Read typed predictions from an intermediate pickle or an output file in in_format.
+    Types of tsv files are restored with the given categorical traits.
+    """
+    if path.endswith('.pkl'):
+        return pd.read_pickle(path)
+    if in_format in ('parquet', 'arrow'):
+        pa = import_pyarrow(in_format)
+        if in_format == 'parquet':
+            import pyarrow.parquet as pq
+            return pq.read_table(path).to_pandas()
+        with pa.OSFile(path, 'rb') as f:
+            return pa.ipc.open_file(f).read_all().to_pandas()
+    compression = 'gzip' if in_format == 'tsv.gz' else None
+    predictions = pd.read_csv(path, sep='\t', dtype=str, compression=compression)
+    return typed_predictions(predictions, categorical or [])
+
+def fan_out_predictions(
+    predictions: pd.DataFrame, sequence_ids: List[str], representatives: List[str]) -> pd.DataFrame:
+    """
+    Copy the predictions of representative sequences to every sequence ID in order
+    (representatives[i] is the representative of sequence_ids[i]).
+    Sequences whose representative has no prediction are left out.
+    """
+    position = pd.Index(predictions['sequence']).get_indexer(representatives)
+    found = position >= 0
+    out = predictions.iloc[position[found]].reset_index(drop=True)
+    out['sequence'] = np.asarray(sequence_ids, dtype=object)[found]
+    return out
+
+def prediction_arrays(predictions: pd.DataFrame):
+    """
+    Sequence IDs, column names and values of typed predictions as a float64 matrix
+    (NaN if missing).
+    """
+    columns = list(predictions.columns[1:])
+    values = predictions[columns].to_numpy(dtype=np.float64, na_value=np.nan)
+    return predictions['sequence'].to_numpy(dtype=object), columns, values
+
+def categorical_traits(ref_trait: str) -> List[str]:
+    """Categorical traits of the reference trait table (integer columns, as in read.delim)."""
+    return _categorical_traits(ref_trait, os.stat(ref_trait).st_mtime_ns)
+
+@lru_cache(maxsize=4)
+def _categorical_traits(ref_trait: str, mtime_ns: int) -> List[str]:
+    index = load_section('trait', ref_trait=ref_trait)
+    if index is not None:
+        return [str(col) for col in index['categorical']]
+    return split_trait_types(read_ref_trait(ref_trait))[1]
+
+def import_pyarrow(out_format: str):
+    try:
+        import pyarrow as pa
+        import pyarrow.ipc  # noqa: F401
+    except ImportError:
+        raise ImportError(f'pyarrow is required for predictions in {out_format} format '
+                          '(pip install pyarrow).')
+    return pa
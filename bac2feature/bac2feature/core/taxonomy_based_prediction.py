@@ -1,38 +1,145 @@
 ### library ###
 import decimal
+from functools import lru_cache
+import importlib.util
 import json
+import os
 from os.path import join
-import subprocess
 
+import numpy as np
 import pandas as pd
 
 import bac2feature.core.default as default
+from bac2feature.core import nb_classify
+from bac2feature.core.checkpoint import Checkpoint
+from bac2feature.core import profiling
+from bac2feature.core.profiling import stage
+from bac2feature.core.ref_index import load_section
+from bac2feature.core.table import typed_predictions, write_predictions
+
+CLADES = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
+PREFIXES = ["k__", "p__", "c__", "o__", "f__", "g__", "s__"]
+NUMERICAL_TRAITS = ['cell_diameter', 'cell_length', 'doubling_h', 'growth_tmp', 'optimum_tmp', 'optimum_ph', 'genome_size', 'gc_content', 'coding_genes', 'rRNA16S_genes', 'tRNA_genes']
+CATEGORICAL_TRAITS = ['gram_stain',
+    'sporulation', 'motility', 'range_salinity', 'facultative_respiration',
+    'anaerobic_respiration', 'aerobic_respiration', 'mesophilic_range_tmp',
+    'thermophilic_range_tmp', 'psychrophilic_range_tmp',
+    'bacillus_cell_shape', 'coccus_cell_shape', 'filament_cell_shape',
+    'coccobacillus_cell_shape', 'vibrio_cell_shape', 'spiral_cell_shape']
 
 ### main func ###
 def predict_by_taxonomy(
     input_fasta:str, out_trait:str, intermediate_dir: str, qiime_env:str,
     ref_nb_classifier=default.ref_nb_classifier,
-    ref_trait_taxonomy=default.ref_trait_taxonomy, threads=1) -> None:
+    ref_trait_taxonomy=default.ref_trait_taxonomy, threads=1,
+    taxonomy_backend='sklearn') -> None:
     """
     Predict microbial traits from fasta file by taxonomic assignment.
     """
-    # Taxonomic assigment by q2-naive-bayes in QIIME2
+    predictions = taxonomy_predictions(input_fasta=input_fasta,
+                                       intermediate_dir=intermediate_dir,
+                                       qiime_env=qiime_env,
+                                       ref_nb_classifier=ref_nb_classifier,
+                                       ref_trait_taxonomy=ref_trait_taxonomy,
+                                       threads=threads,
+                                       taxonomy_backend=taxonomy_backend)
+    write_predictions(predictions, out_trait)
+    return
+
+def taxonomy_predictions(
+    input_fasta:str, intermediate_dir: str, qiime_env:str,
+    ref_nb_classifier=default.ref_nb_classifier,
+    ref_trait_taxonomy=default.ref_trait_taxonomy, threads=1,
+    taxonomy_backend='sklearn', resume=False, force_from=None) -> pd.DataFrame:
+    """
+    Predict microbial traits from fasta file by taxonomic assignment as a typed table.
+    The taxonomy is passed in memory when the classifier runs in this process.
+    With resume, the taxonomy of a previous run in intermediate_dir is reused if its
+    checkpoint matches (unless force_from is 'classify').
+    """
     nb_result_path = join(intermediate_dir, 'taxonomy.tsv')
-    call_qiime_taxonomic_assignment(input_fasta=input_fasta,
-                                    out_taxonomy=nb_result_path,
-                                    ref_nb_classifier=ref_nb_classifier,
-                                    qiime_env=qiime_env,
-                                    threads=threads)
+    checkpoint = Checkpoint(intermediate_dir, 'classify', outputs=[nb_result_path],
+                            inputs={'fasta': input_fasta}, references={'classifier': ref_nb_classifier},
+                            params={'taxonomy_backend': taxonomy_backend}, force_from=force_from, enabled=resume)
+    with stage('taxonomy.classify'):
+        if checkpoint.done():
+            taxonomy = pd.read_csv(nb_result_path, sep="\t")
+        elif taxonomy_backend == 'sklearn' and has_q2_feature_classifier():
+            taxonomy = nb_classify.classify_table(input_fasta=input_fasta,
+                                                  ref_nb_classifier=ref_nb_classifier,
+                                                  threads=threads,
+                                                  tmp_dir=intermediate_dir)
+            # Written only to be reused by a later run
+            if resume:
+                taxonomy.to_csv(nb_result_path, sep='\t', index=False)
+                checkpoint.save()
+        else:
+            # Taxonomic assigment by q2-naive-bayes in QIIME2
+            if taxonomy_backend == 'sklearn':
+                call_nb_classifier(input_fasta=input_fasta,
+                                   out_taxonomy=nb_result_path,
+                                   ref_nb_classifier=ref_nb_classifier,
+                                   qiime_env=qiime_env,
+                                   threads=threads,
+                                   intermediate_dir=intermediate_dir)
+            else:
+                call_qiime_taxonomic_assignment(input_fasta=input_fasta,
+                                                out_taxonomy=nb_result_path,
+                                                ref_nb_classifier=ref_nb_classifier,
+                                                qiime_env=qiime_env,
+                                                threads=threads,
+                                                intermediate_dir=intermediate_dir)
+            taxonomy = pd.read_csv(nb_result_path, sep="\t")
+            checkpoint.save()
     # Predict traits from taxonomy
-    predict_by_emp_dist(taxonomy_path=nb_result_path,
-                        out_trait=out_trait,
-                        ref_trait_taxonomy=ref_trait_taxonomy)
-    return
+    with stage('taxonomy.emp_dist'):
+        predictions = taxonomy_table_predictions(naive_bayes_result=taxonomy,
+                                                 ref_trait_taxonomy=ref_trait_taxonomy)
+    return predictions
 
 ### func ###
+def call_nb_classifier(
+    input_fasta: str, out_taxonomy: str,
+    ref_nb_classifier: str, qiime_env:str, threads:int, intermediate_dir: str) -> None:
+    """
+    Classify sequences with the naive Bayes classifier loaded directly from the .qza file.
+    Runs in this process when q2-feature-classifier is importable (the classifier is then
+    loaded once per process), otherwise once in the QIIME2 environment by conda run.
+    """
+    if has_q2_feature_classifier():
+        nb_classify.classify(input_fasta=input_fasta,
+                             out_taxonomy=out_taxonomy,
+                             ref_nb_classifier=ref_nb_classifier,
+                             threads=threads,
+                             tmp_dir=intermediate_dir)
+        return
+    cmd = ['conda',
+           'run',
+           '--name',
+           qiime_env,
+           'python',
+           nb_classify.__file__,
+           '-i',
+           input_fasta,
+           '-o',
+           out_taxonomy,
+           '-c',
+           ref_nb_classifier,
+           '-t',
+           str(threads),
+           '-d',
+           intermediate_dir
+           ]
+    profiling.run(cmd, name='nb_classify')
+    return
+
+@lru_cache(maxsize=1)
+def has_q2_feature_classifier() -> bool:
+    return importlib.util.find_spec('q2_feature_classifier') is not None
+
 def call_qiime_taxonomic_assignment(
     input_fasta: str, out_taxonomy: str,
-    ref_nb_classifier: str, qiime_env:str, threads:int) -> None:
+    ref_nb_classifier: str, qiime_env:str, threads:int, intermediate_dir: str) -> None:
     script_path = join(default.b2f_core_dir, 'qiime_taxonomic_assignment.sh')
     cmd = ['conda',
            'run',
@@ -46,52 +153,124 @@ def call_qiime_taxonomic_assignment(
            '-c',
            ref_nb_classifier,
            '-t',
-           str(threads)
+           str(threads),
+           '-d',
+           intermediate_dir
            ]
-    subprocess.run(cmd)
+    profiling.run(cmd, name='qiime_taxonomic_assignment')
     return
 
 def predict_by_emp_dist(
     taxonomy_path: str, out_trait: str, ref_trait_taxonomy: str) -> None:
-    # Empirical trait distribution
-    emp_file = open(ref_trait_taxonomy, 'r')
-    emp_dist = json.load(emp_file)
-    emp_file.close()
-
-    # Preprocess naibe bayes result
-    clades = ["superkingdom", "phylum", "class", "order", "family", "genus", "species"]
-    prefix = ["k__", "p__", "c__", "o__", "f__", "g__", "s__"]
+    predictions = emp_dist_predictions(taxonomy_path=taxonomy_path,
+                                       ref_trait_taxonomy=ref_trait_taxonomy)
+    write_predictions(predictions, out_trait)
+    return
+
+def emp_dist_predictions(
+    taxonomy_path: str, ref_trait_taxonomy: str) -> pd.DataFrame:
+    # Naive bayes result
     naive_bayes_result = pd.read_csv(taxonomy_path, sep="\t")
-    x = naive_bayes_result["Taxon"].str.split("; ", expand=True)
-    x = x.set_axis(clades, axis="columns")
-    x = x.fillna("")
-    for c, p in zip(clades, prefix):
-        x[c] = x[c].str.replace(p, "")
-    naive_bayes_result = pd.concat([naive_bayes_result, x], axis=1)
-    naive_bayes_result["tax_dict"] = naive_bayes_result[clades].apply(
-                                         lambda df: df.to_dict(), axis=1
-                                     )
-    # Prediction
-    nt = ['cell_diameter', 'cell_length', 'doubling_h', 'growth_tmp', 'optimum_tmp', 'optimum_ph', 'genome_size', 'gc_content', 'coding_genes', 'rRNA16S_genes', 'tRNA_genes']
-    ct = ['gram_stain',
-        'sporulation', 'motility', 'range_salinity', 'facultative_respiration',
-        'anaerobic_respiration', 'aerobic_respiration', 'mesophilic_range_tmp',
-        'thermophilic_range_tmp', 'psychrophilic_range_tmp',
-        'bacillus_cell_shape', 'coccus_cell_shape', 'filament_cell_shape',
-        'coccobacillus_cell_shape', 'vibrio_cell_shape', 'spiral_cell_shape']
-    for t in nt:
-        naive_bayes_result[t] = naive_bayes_result["tax_dict"].apply(
-                                    lambda x: predict_from_emp(x, emp_dist, t)
-                                )
-    for t in ct:
-        naive_bayes_result[t] = naive_bayes_result["tax_dict"].apply(
-                                    lambda x: decimal.Decimal(str(predict_from_emp(x, emp_dist, t))).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_HALF_DOWN)
-                                )
-    # Save
-    naive_bayes_result.rename(columns={'Feature ID': 'sequence'}, inplace=True)
-    naive_bayes_result[["sequence"]+nt+ct].to_csv(out_trait, sep="\t", index=False)
+    return taxonomy_table_predictions(naive_bayes_result, ref_trait_taxonomy)
 
-    return
+def taxonomy_table_predictions(
+    naive_bayes_result: pd.DataFrame, ref_trait_taxonomy: str) -> pd.DataFrame:
+    """Typed predictions from a taxonomy table (Feature ID, Taxon) of the classifier."""
+    # Empirical trait distribution compiled into a lineage table
+    emp_table = load_emp_table(ref_trait_taxonomy)
+
+    # Prediction for each unique lineage, filled in for all sequences sharing it
+    codes, lineages = pd.factorize(naive_bayes_result["Taxon"].fillna(""))
+    lineage_traits = np.array([predict_lineage(lineage, emp_table) for lineage in lineages], dtype=np.float64)
+    lineage_traits = lineage_traits.reshape(len(lineages), len(NUMERICAL_TRAITS) + len(CATEGORICAL_TRAITS))
+    out = pd.DataFrame(lineage_traits[codes], columns=NUMERICAL_TRAITS + CATEGORICAL_TRAITS)
+    out.insert(0, "sequence", naive_bayes_result["Feature ID"].astype(str).to_numpy())
+
+    return typed_predictions(out, CATEGORICAL_TRAITS)
+
+def load_emp_table(ref_trait_taxonomy: str) -> dict:
+    """
+    Empirical trait distributions compiled into one trait vector per taxon name and rank
+    (a row lookup and a matrix per rank), with a memo of predictions per lineage.
+    Memory-mapped from the reference index when it was built from this file.
+    Kept in memory until the file changes.
+    """
+    return _load_emp_table(ref_trait_taxonomy, os.stat(ref_trait_taxonomy).st_mtime_ns)
+
+@lru_cache(maxsize=2)
+def _load_emp_table(ref_trait_taxonomy: str, mtime_ns: int) -> dict:
+    arrays = load_section("taxonomy", ref_trait_taxonomy=ref_trait_taxonomy)
+    if arrays is None:
+        arrays = emp_table_arrays(ref_trait_taxonomy)
+    ranks = {}
+    for clade in CLADES:
+        rows = {str(name): i for i, name in enumerate(arrays[f"{clade}_names"])}
+        ranks[clade] = (rows, arrays[f"{clade}_values"])
+    return {"ranks": ranks, "lineages": {}}
+
+def emp_table_arrays(ref_trait_taxonomy: str) -> dict:
+    """
+    Taxon names and trait values (NaN where the empirical distribution is unknown)
+    per rank, i.e. the 'taxonomy' section of the reference index (see build-index).
+    """
+    emp_dist = load_emp_dist(ref_trait_taxonomy)
+    traits = NUMERICAL_TRAITS + CATEGORICAL_TRAITS
+    arrays = {}
+    for clade in CLADES:
+        names = set()
+        for t in traits:
+            names.update(emp_dist[t][clade])
+        names = sorted(names)
+        values = np.full((len(names), len(traits)), np.nan)
+        for i, name in enumerate(names):
+            for j, t in enumerate(traits):
+                value = emp_dist[t][clade].get(name)
+                if value is not None and value != "NA":
+                    values[i, j] = value
+        arrays[f"{clade}_names"] = np.array(names, dtype=str)
+        arrays[f"{clade}_values"] = values
+    return arrays
+
+def predict_lineage(lineage: str, emp_table: dict) -> np.ndarray:
+    """
+    Predict all traits of a lineage ("k__...; p__...; ...") from the closest taxonomic group
+    with an empirical distribution, as predict_from_emp does for each trait.
+    Results are memoized per lineage string.
+    """
+    memo = emp_table["lineages"]
+    if lineage in memo:
+        return memo[lineage]
+
+    names = lineage.split("; ") if lineage else []
+    names = [name.replace(p, "") for name, p in zip(names, PREFIXES)]
+    names += [""] * (len(CLADES) - len(names))
+
+    # From species to higher taxonomic groups in order
+    res = np.full(len(NUMERICAL_TRAITS) + len(CATEGORICAL_TRAITS), np.nan)
+    for clade, name in reversed(list(zip(CLADES, names))):
+        rows, values = emp_table["ranks"][clade]
+        row = rows.get(name)
+        if row is not None:
+            missing = np.isnan(res)
+            res[missing] = values[row][missing]
+    if np.isnan(res).any():
+        print("There is no record about input taxonomy.")
+
+    # Round categorical traits (half down); missing predictions stay NaN
+    n_num = len(NUMERICAL_TRAITS)
+    res[n_num:] = [v if np.isnan(v) else float(decimal.Decimal(repr(float(v))).quantize(decimal.Decimal('1'), rounding=decimal.ROUND_HALF_DOWN))
+                   for v in res[n_num:]]
+    memo[lineage] = res
+    return res
+
+def load_emp_dist(ref_trait_taxonomy: str) -> dict:
+    """Load empirical trait distributions, kept in memory until the file changes."""
+    return _load_emp_dist(ref_trait_taxonomy, os.stat(ref_trait_taxonomy).st_mtime_ns)
+
+@lru_cache(maxsize=2)
+def _load_emp_dist(ref_trait_taxonomy: str, mtime_ns: int) -> dict:
+    with open(ref_trait_taxonomy, 'r') as emp_file:
+        return json.load(emp_file)
 
 # Predict traits from taxonomy and empirical distribution
 def predict_from_emp(tax_dict: dict, emp_dist: dict, t: str):
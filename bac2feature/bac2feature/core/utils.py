@@ -1,11 +1,16 @@
 ### Utils func ###
+import bz2
 from contextlib import contextmanager
+import gzip
+import hashlib
+import io
 import os
+import sys
 import tempfile
-from typing import Optional
-
-import pandas as pd
+from typing import Iterable, Iterator, List, Optional, TextIO, Tuple
 
+# Leading bytes of compressed FASTA files
+COMPRESSION_MAGIC = {'gzip': b'\x1f\x8b', 'bzip2': b'BZh', 'zstd': b'\x28\xb5\x2f\xfd'}
 
 @contextmanager
 def get_intermediate_dir(intermediate_dir: Optional[str]):
@@ -22,26 +27,145 @@ def get_intermediate_dir(intermediate_dir: Optional[str]):
             os.makedirs(intermediate_dir)
         yield intermediate_dir
 
-def reorder_by_fasta(output_path: str, input_fasta: str) -> None:
+def iter_fasta_chunks(input_fasta: str, chunk_size: int) -> Iterator[List[str]]:
     """
-    Reorder prediction results to match the order of sequences in the input FASTA file.
+    Read a FASTA file lazily and yield its lines in chunks of chunk_size sequences.
     """
-    # Get sequence order from FASTA
-    fasta_order = []
-    with open(input_fasta, 'r') as f:
+    chunk, n_seqs = [], 0
+    with open_fasta(input_fasta) as f:
         for line in f:
             if line.startswith('>'):
-                # Extract entire sequence ID
-                seq_id = line[1:].strip()
-                fasta_order.append(seq_id)
+                if n_seqs == chunk_size:
+                    yield chunk
+                    chunk, n_seqs = [], 0
+                n_seqs += 1
+            chunk.append(line)
+    if n_seqs > 0:
+        yield chunk
+
+def read_fasta(input_fasta: str) -> Iterator[Tuple[str, str]]:
+    """
+    Read a FASTA file lazily as (sequence ID, sequence) pairs.
+    """
+    with open_fasta(input_fasta) as f:
+        yield from parse_fasta(f)
+
+@contextmanager
+def open_fasta(input_fasta: str) -> Iterator[TextIO]:
+    """
+    Open a FASTA file as text, decompressing gzip, bzip2 or zstd input on the fly
+    (detected from the leading bytes). '-' reads standard input.
+    """
+    raw = sys.stdin.buffer if input_fasta == '-' else open(input_fasta, 'rb')
+    compression = fasta_compression(raw)
+    if compression == 'gzip':
+        f = gzip.open(raw, 'rt')
+    elif compression == 'bzip2':
+        f = bz2.open(raw, 'rt')
+    elif compression == 'zstd':
+        f = import_zstandard().open(raw, 'rt', closefd=False)
+    else:
+        f = io.TextIOWrapper(raw)
+    try:
+        yield f
+    finally:
+        if raw is sys.stdin.buffer:
+            # Keep standard input open
+            if compression is None:
+                f.detach()
+        else:
+            f.close()
+            raw.close()
+
+def fasta_compression(raw: io.BufferedReader) -> Optional[str]:
+    """Compression of a binary stream from its leading bytes, without consuming them."""
+    head = raw.peek(4)[:4]
+    for compression, magic in COMPRESSION_MAGIC.items():
+        if head.startswith(magic):
+            return compression
+    return None
+
+def is_plain_fasta(input_fasta: str) -> bool:
+    """Whether external tools can read the input as is (an uncompressed file)."""
+    if input_fasta == '-':
+        return False
+    with open(input_fasta, 'rb') as raw:
+        return fasta_compression(raw) is None
+
+def import_zstandard():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError('zstandard is required to read zstd-compressed FASTA files '
+                          '(pip install zstandard).')
+    return zstandard
 
-    # Load prediction results as strings to preserve data types
-    predictions = pd.read_csv(output_path, sep='\t', dtype=str)
+def fasta_id(header: str) -> str:
+    """Sequence ID of a header line: the first word, as used by BLAST and epa-ng."""
+    words = header[1:].split(maxsplit=1)
+    return words[0] if words else ''
 
-    # Reorder based on FASTA order
-    predictions['sequence'] = pd.Categorical(predictions['sequence'], categories=fasta_order, ordered=True)
-    predictions = predictions.sort_values('sequence')
+def parse_fasta(lines: Iterable[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Parse FASTA lines as (sequence ID, sequence) pairs.
+    """
+    seq_id, seq_lines = None, []
+    for line in lines:
+        if line.startswith('>'):
+            if seq_id is not None:
+                yield seq_id, ''.join(seq_lines)
+            seq_id, seq_lines = fasta_id(line), []
+        else:
+            seq_lines.append(line.strip())
+    if seq_id is not None:
+        yield seq_id, ''.join(seq_lines)
+
+def dereplicate(
+    records: Iterable[Tuple[str, str]], sequence_ids: List[str],
+    representatives: List[str]) -> Iterator[Tuple[str, str]]:
+    """
+    Yield the first record of each distinct sequence (case-insensitive, as in the
+    prediction cache). The ID of every record is appended to sequence_ids, and the ID
+    of its representative (the first record with the same sequence) to representatives.
+    Sequences are remembered by hash, so only the IDs are kept in memory.
+    """
+    first_ids = {}
+    for seq_id, seq in records:
+        key = hashlib.sha1(seq.upper().encode()).digest()
+        is_first = key not in first_ids
+        if is_first:
+            first_ids[key] = seq_id
+        sequence_ids.append(seq_id)
+        representatives.append(first_ids[key])
+        if is_first:
+            yield seq_id, seq
+
+def write_fasta(records: Iterable[Tuple[str, str]], output_fasta: str) -> None:
+    """
+    Write (sequence ID, sequence) pairs to a FASTA file.
+    """
+    with open(output_fasta, 'w') as f:
+        for seq_id, seq in records:
+            f.write(f'>{seq_id}\n{seq}\n')
+    return
 
-    # Save reordered results
-    predictions.to_csv(output_path, sep='\t', index=False)
+def pipe_fasta(records: Iterable[Tuple[str, str]], fd: int) -> None:
+    """
+    Write (sequence ID, sequence) pairs to the write end of a pipe and close it.
+    Stops quietly if the reader exits early.
+    """
+    try:
+        with open(fd, 'w') as f:
+            for seq_id, seq in records:
+                f.write(f'>{seq_id}\n{seq}\n')
+    except BrokenPipeError:
+        pass
     return
+
+def file_sha1(file_path: str) -> str:
+    """SHA-1 of the content of a file, read in blocks."""
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            sha1.update(block)
+    return sha1.hexdigest()
@@ -14,7 +14,9 @@ setup(
     packages=find_packages(),
     entry_points={
         'console_scripts': [
-            'bac2feature = bac2feature.cmd.bac2feature:main'
+            'bac2feature = bac2feature.cmd.bac2feature:main',
+            'bac2feature_build_hsp = bac2feature.cmd.build_hsp_reference:main',
+            'bac2feature_benchmark = bac2feature.cmd.benchmark:main'
         ]},
     include_package_data=True,
     install_requires=[],
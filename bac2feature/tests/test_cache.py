@@ -0,0 +1,133 @@
+"""
+Tests of the persistent prediction cache (bac2feature.core.cache): hits and misses,
+least recently used eviction, and homology-based predictions merged from cached hits.
+"""
+import json
+
+import pandas as pd
+import pytest
+
+import bac2feature.core.cache as cache_module
+import bac2feature.core.homology_based_prediction as homology
+from bac2feature.cmd.bac2feature import homology_predictions_with_cache
+from bac2feature.core.cache import PredictionCache
+
+COLUMNS = ['genome_size', 'gram_stain']
+
+# BLAST hits (species_tax_id, pident, length) of each sequence. The length cutoff of
+# the 'L' sequences alone (119) is longer than that of all sequences (79).
+HITS = {
+    'LACGT': [('999', 99.0, 400.0), ('100', 99.0, 100.0), ('101', 98.0, 90.0)],
+    'LGGTT': [('102', 99.0, 300.0), ('101', 99.0, 300.0)],
+    'SCATC': [('100', 99.0, 40.0), ('101', 99.0, 30.0)],
+    'STTGA': [('102', 96.0, 500.0), ('101', 99.0, 80.0)],
+    'SAGAG': [],
+}
+
+### fixture ###
+@pytest.fixture
+def cache(tmp_path):
+    cache = PredictionCache(str(tmp_path / 'cache.sqlite'))
+    yield cache
+    cache.close()
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Time of the cache advancing by one second at every call."""
+    now = iter(range(1000000, 2000000))
+    monkeypatch.setattr(cache_module.time, 'time', lambda: float(next(now)))
+
+def row_size(row) -> int:
+    return len(json.dumps(COLUMNS)) + len(json.dumps(row)) + 40
+
+def blast_hits(records) -> pd.DataFrame:
+    return pd.DataFrame([[seq_id, *hit] for seq_id, seq in records for hit in HITS[seq]],
+                        columns=['sequence', 'species_tax_id', 'pident', 'length'])
+
+def cached_sequences(cache: PredictionCache, context: str, sequences) -> set:
+    """Cached sequences, looked up without marking them as used."""
+    keys = {key for key, in cache.conn.execute('SELECT key FROM predictions')}
+    return {seq for seq in sequences if cache.key(context, seq) in keys}
+
+### test ###
+def test_hits_and_misses(cache, tmp_path):
+    reference = tmp_path / 'trait.tsv'
+    reference.write_text('species_tax_id\tgenome_size\n1\t2.0\n')
+    context = cache.context('taxonomy', [str(reference)], {'threshold': 0.5})
+    cache.put_many(context, COLUMNS, {'ACGT': ['2107517.139', '1'], 'GGCC': None})
+
+    found = cache.get_many(context, ['ACGT', 'GGCC', 'TTTT', 'ACGT'])
+    assert found == {'ACGT': (COLUMNS, ['2107517.139', '1']), 'GGCC': (COLUMNS, None)}
+    assert (cache.hits, cache.misses) == (2, 1)
+    # Sequences are compared case-insensitively
+    assert cache.get_many(context, ['acgt']) == {'acgt': (COLUMNS, ['2107517.139', '1'])}
+
+    # Other options or reference contents are other contexts
+    assert cache.get_many(cache.context('taxonomy', [str(reference)], {'threshold': 0.6}), ['ACGT']) == {}
+    reference.write_text('species_tax_id\tgenome_size\n1\t3.0\n')
+    assert cache.get_many(cache.context('taxonomy', [str(reference)], {'threshold': 0.5}), ['ACGT']) == {}
+    assert (cache.hits, cache.misses) == (3, 3)
+
+    cache.record_stats()
+    assert cache.stats() == {'hits': 3, 'misses': 3, 'rows': 2,
+                             'size': row_size(['2107517.139', '1']) + len(json.dumps(COLUMNS)) + 40}
+
+def test_lru_eviction(tmp_path, clock):
+    row = ['1.5', '0']
+    sequences = ['AAAA', 'CCCC', 'GGGG', 'TTTT']
+    # Three rows fit, and a fourth evicts down to 90% of the limit, i.e. one row
+    cache = PredictionCache(str(tmp_path / 'cache.sqlite'), max_size_mb=3.5 * row_size(row) / 1024 / 1024)
+    for seq in ('AAAA', 'CCCC', 'GGGG'):
+        cache.put_many('context', COLUMNS, {seq: row})
+    cache.get_many('context', ['AAAA'])
+    cache.put_many('context', COLUMNS, {'TTTT': row})
+    assert cached_sequences(cache, 'context', sequences) == {'AAAA', 'GGGG', 'TTTT'}
+
+    cache.get_many('context', ['GGGG'])
+    cache.put_many('context', COLUMNS, {'CCCC': row})
+    assert cached_sequences(cache, 'context', sequences) == {'CCCC', 'GGGG', 'TTTT'}
+    assert cache.stats()['size'] == 3 * row_size(row)
+    cache.close()
+
+def test_homology_cached_rerun(tmp_path, monkeypatch):
+    """Predictions merged from cached and new hits equal those of a run without cache."""
+    ref_trait = tmp_path / 'trait.tsv'
+    ref_trait.write_text('species_tax_id\tgenome_size\tgram_stain\n'
+                         '100\t2107517.139\t1\n101\t\t0\n102\t3552438.5\t\n')
+    records = [(f'seq_{i}', seq) for i, seq in enumerate(HITS)] + [('seq_duplicate', 'STTGA')]
+    searched = []
+
+    def fake_homology_hits(query_records, ref_trait, **options):
+        searched.append([seq_id for seq_id, _ in query_records])
+        trait_ids, _, _, trait_known = homology.read_trait_matrix(ref_trait)
+        reducer = homology.BlastHitReducer(trait_ids, trait_known, perc_identity=97.0)
+        reducer.add(blast_hits(query_records))
+        return reducer.reduced()
+    monkeypatch.setattr(homology, 'homology_hits', fake_homology_hits)
+
+    trait_ids, _, _, trait_known = homology.read_trait_matrix(str(ref_trait))
+    reducer = homology.BlastHitReducer(trait_ids, trait_known, perc_identity=97.0)
+    reducer.add(blast_hits(records))
+    expected = homology.hits_to_predictions(reducer.finish(), str(ref_trait), check_nsti=True)
+
+    def predict(records):
+        cache = PredictionCache(str(tmp_path / 'cache.sqlite'))
+        predictions = homology_predictions_with_cache(
+            cache, 'context', records=records, work_dir=str(tmp_path), threads=1,
+            ref_blastdb='ref', ref_trait=str(ref_trait), check_nsti=True)
+        hits_and_misses = cache.hits, cache.misses
+        cache.close()
+        return predictions, hits_and_misses
+
+    # Sequences with long alignments are cached by a first run
+    predict(records[:2])
+    predictions, hits_and_misses = predict(records)
+    assert hits_and_misses == (2, 3)
+    assert searched[-1] == ['seq_2', 'seq_3', 'seq_4', 'seq_duplicate']
+    pd.testing.assert_frame_equal(predictions, expected)
+    assert predictions['genome_size'].tolist()[:2] == [2107517.139, 3552438.5]
+
+    predictions, hits_and_misses = predict(records)
+    assert hits_and_misses == (5, 0)
+    assert len(searched) == 2
+    pd.testing.assert_frame_equal(predictions, expected)
@@ -0,0 +1,130 @@
+"""
+Tests of stage checkpoints (bac2feature.core.checkpoint) in the phylogeny-based pipeline,
+with placement and HSP replaced by stand-ins that record their calls: changed inputs and
+references invalidate their stage and the stages after it, and force_from reruns stages.
+"""
+import os
+
+import pandas as pd
+import pytest
+
+import bac2feature.core.phylogeny_based_prediction as phylogeny
+from bac2feature.core.checkpoint import Checkpoint, is_forced
+
+### fixture ###
+@pytest.fixture
+def pipeline(tmp_path, monkeypatch):
+    """Run the phylogeny pipeline with resume and return the stages that were computed."""
+    input_fasta = tmp_path / 'input.fasta'
+    input_fasta.write_text('>q1\nACGT\n')
+    ref_dir = tmp_path / 'placement'
+    ref_dir.mkdir()
+    (ref_dir / 'ref.tre').write_text('(r1:1,r2:1);')
+    ref_trait = tmp_path / 'trait.tsv'
+    ref_trait.write_text('species_tax_id\tgenome_size\nr1\t2.5\n')
+    intermediate_dir = tmp_path / 'intermediate'
+    intermediate_dir.mkdir()
+    computed = []
+
+    def fake_place_seqs(input_fasta, out_tree, ref_dir_placement, **options):
+        computed.append('placement')
+        # The placed tree changes with the input and the reference tree
+        with open(out_tree, 'w') as out, open(os.path.join(ref_dir_placement, 'ref.tre')) as ref, \
+                open(input_fasta) as fasta:
+            out.write(ref.read() + fasta.read())
+
+    def fake_hsp_predictions(out_tree, ref_trait, **options):
+        computed.append('hsp')
+        size = os.path.getsize(out_tree) + os.path.getsize(ref_trait)
+        return pd.DataFrame({'sequence': ['q1'], 'genome_size': [float(size)], 'genome_size_nsti': [0.5]})
+
+    monkeypatch.setattr(phylogeny, 'place_seqs', fake_place_seqs)
+    monkeypatch.setattr(phylogeny, 'hsp_predictions', fake_hsp_predictions)
+
+    def run(force_from=None):
+        computed.clear()
+        predictions = phylogeny.phylogeny_predictions(
+            input_fasta=str(input_fasta), intermediate_dir=str(intermediate_dir), ref_dir_placement=str(ref_dir),
+            ref_trait=str(ref_trait), check_nsti=True, filter_by_nsti=False, resume=True, force_from=force_from)
+        return list(computed), predictions
+    run.input_fasta, run.ref_dir, run.ref_trait = input_fasta, ref_dir, ref_trait
+    return run
+
+### test ###
+def test_reuse(pipeline):
+    assert pipeline()[0] == ['placement', 'hsp']
+    computed, predictions = pipeline()
+    assert computed == []
+    pd.testing.assert_frame_equal(predictions, pipeline()[1])
+
+    # Rewritten with the same contents (a newer mtime) is still reused
+    pipeline.input_fasta.write_text('>q1\nACGT\n')
+    assert pipeline()[0] == []
+
+@pytest.mark.parametrize('changed, expected', [
+    ('input_fasta', ['placement', 'hsp']),
+    ('ref_dir', ['placement', 'hsp']),
+    ('ref_trait', ['hsp']),
+])
+def test_changed_file(pipeline, changed, expected):
+    """A changed file invalidates the stage reading it and the later stages."""
+    _, before = pipeline()
+    path = {'input_fasta': pipeline.input_fasta, 'ref_dir': pipeline.ref_dir / 'ref.tre',
+            'ref_trait': pipeline.ref_trait}[changed]
+    path.write_text(path.read_text() + '\n')
+    computed, after = pipeline()
+    assert computed == expected
+    assert after.loc[0, 'genome_size'] == before.loc[0, 'genome_size'] + 1
+    assert pipeline()[0] == []
+
+def test_same_size_change(pipeline):
+    """Contents are hashed again when the mtime changed, even if the size did not."""
+    pipeline()
+    mtime_ns = os.stat(pipeline.input_fasta).st_mtime_ns
+    pipeline.input_fasta.write_text('>q1\nACGA\n')
+    os.utime(pipeline.input_fasta, ns=(mtime_ns + 10**9, mtime_ns + 10**9))
+    assert pipeline()[0] == ['placement', 'hsp']
+
+def test_interrupted_stage(pipeline, tmp_path):
+    """A stage whose output was removed or truncated is recomputed, together with later stages."""
+    pipeline()
+    os.remove(tmp_path / 'intermediate' / 'placed_seqs.tre')
+    assert pipeline()[0] == ['placement']
+    (tmp_path / 'intermediate' / 'hsp_predictions.pkl').write_bytes(b'')
+    assert pipeline()[0] == ['hsp']
+
+@pytest.mark.parametrize('force_from, expected', [
+    ('placement', ['placement', 'hsp']),
+    ('hsp', ['hsp']),
+    ('blastn', []),
+])
+def test_force_from(pipeline, force_from, expected):
+    pipeline()
+    assert pipeline(force_from=force_from)[0] == expected
+    assert pipeline()[0] == []
+
+def test_records_and_params(tmp_path):
+    """Stages keyed by query records and parameters."""
+    output = tmp_path / 'hits.pkl'
+    def checkpoint(records, params):
+        return Checkpoint(str(tmp_path), 'blastn', outputs=[str(output)], records=records, params=params)
+    first = checkpoint([('q1', 'ACGT')], {'perc_identity': 97})
+    assert not first.done()
+    output.write_bytes(b'hits')
+    first.save()
+    assert checkpoint([('q1', 'ACGT')], {'perc_identity': 97}).done()
+    assert not checkpoint([('q1', 'ACGA')], {'perc_identity': 97}).done()
+    # The stale manifest was removed
+    assert not checkpoint([('q1', 'ACGT')], {'perc_identity': 97}).done()
+
+    second = checkpoint([('q1', 'ACGT')], {'perc_identity': 97})
+    second.done()
+    second.save()
+    assert not checkpoint([('q1', 'ACGT')], {'perc_identity': 90}).done()
+    assert not Checkpoint(str(tmp_path), 'blastn', outputs=[str(output)], records=[('q1', 'ACGT')],
+                          params={'perc_identity': 97}, enabled=False).done()
+
+def test_is_forced():
+    assert is_forced('hsp', 'placement') and is_forced('placement', 'placement')
+    assert not is_forced('placement', 'hsp')
+    assert not is_forced('blastn', 'hsp') and not is_forced('hsp', None)
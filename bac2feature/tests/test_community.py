@@ -0,0 +1,88 @@
+"""
+Tests of community-weighted mean traits (bac2feature.core.community): the sparse
+products over feature tables in each supported format against a dense reference.
+"""
+import json
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bac2feature.core.community import community_traits
+
+FEATURES = ['f1', 'f2', 'f3', 'f4', 'f5']
+SAMPLES = ['s1', 's2', 's3', 's4', 's5']
+# Features x samples; s3 has no reads and s5 only reads of features without predictions
+COUNTS = np.array([[10, 0, 0, 1, 0],
+                   [5, 2, 0, 0, 0],
+                   [0, 7, 0, 3, 0],
+                   [1, 0, 0, 0, 4],
+                   [2, 1, 0, 0, 6]], dtype=np.float64)
+
+### fixture ###
+@pytest.fixture
+def predictions():
+    """Typed predictions; f4 was not predicted, f5 is missing from the predictions and f6 from the table."""
+    return pd.DataFrame({'sequence': ['f1', 'f2', 'f3', 'f4', 'f6'],
+                         'genome_size': [2107517.139, np.nan, 4000000.0, np.nan, 1.0],
+                         'gram_stain': pd.array([1, 0, 0, pd.NA, 1], dtype='Int8'),
+                         'genome_size_nsti': [0.1, np.nan, 0.3, np.nan, 0.0]})
+
+def dense_community_traits(predictions: pd.DataFrame) -> pd.DataFrame:
+    """Abundance-weighted means over the features with a predicted value, sample by sample."""
+    predictions = predictions.set_index('sequence')
+    out = pd.DataFrame({'sample': SAMPLES})
+    for col in predictions.columns:
+        values = predictions[col].astype('float64').reindex(FEATURES).to_numpy()
+        means = []
+        for j in range(len(SAMPLES)):
+            weights = np.where(np.isnan(values), 0.0, COUNTS[:, j])
+            means.append(np.nansum(weights * values) / weights.sum() if weights.sum() > 0 else np.nan)
+        out[col] = means
+    return out
+
+def write_tsv(path):
+    table = pd.DataFrame(COUNTS, index=pd.Index(FEATURES, name='#OTU ID'), columns=SAMPLES)
+    table['taxonomy'] = 'k__Bacteria'
+    with open(path, 'w') as f:
+        f.write('# Constructed from biom file\n')
+        table.to_csv(f, sep='\t')
+
+def write_biom_json(path, matrix_type):
+    rows, cols = np.nonzero(COUNTS)
+    data = (COUNTS.tolist() if matrix_type == 'dense'
+            else [[int(i), int(j), COUNTS[i, j]] for i, j in zip(rows, cols)])
+    with open(path, 'w') as f:
+        json.dump({'rows': [{'id': i} for i in FEATURES], 'columns': [{'id': i} for i in SAMPLES],
+                   'matrix_type': matrix_type, 'shape': list(COUNTS.shape), 'data': data}, f)
+
+def write_biom_hdf5(path):
+    h5py = pytest.importorskip('h5py')
+    from scipy import sparse
+    csc = sparse.csc_matrix(COUNTS)
+    with h5py.File(path, 'w') as biom:
+        biom['observation/ids'] = np.array(FEATURES, dtype=object).astype('S')
+        biom['sample/ids'] = np.array(SAMPLES, dtype=object).astype('S')
+        biom['sample/matrix/data'] = csc.data
+        biom['sample/matrix/indices'] = csc.indices
+        biom['sample/matrix/indptr'] = csc.indptr
+
+### test ###
+@pytest.mark.parametrize('table_format', ['tsv', 'biom_dense', 'biom_sparse', 'biom_hdf5'])
+@pytest.mark.parametrize('block_size', [2, 1000])
+def test_community_traits(tmp_path, predictions, table_format, block_size):
+    path = str(tmp_path / 'feature_table')
+    if table_format == 'tsv':
+        write_tsv(path)
+    elif table_format == 'biom_hdf5':
+        write_biom_hdf5(path)
+    else:
+        write_biom_json(path, table_format[len('biom_'):])
+
+    traits = pd.concat(community_traits(predictions, path, block_size=block_size), ignore_index=True)
+    expected = dense_community_traits(predictions)
+    pd.testing.assert_frame_equal(traits, expected, check_dtype=False, rtol=1e-12)
+    # No reads, or no reads of predicted features, gives missing values
+    assert traits.iloc[[2, 4], 1:].isna().all().all()
+    # f4 has no prediction, so its reads do not dilute the fraction of gram-positive reads
+    assert traits.loc[0, 'gram_stain'] == pytest.approx(10 / 15)
@@ -0,0 +1,108 @@
+"""
+Tests of the streaming reduction of BLAST hits (bac2feature.core.homology_based_prediction)
+against a plain pandas reference on random hit tables: filter by percent identity, drop hits
+shorter than half the mean alignment length, and take the first hit with a known value
+of each trait.
+"""
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bac2feature.core.homology_based_prediction import (BlastHitReducer, length_cutoff, read_trait_matrix,
+                                                        reduce_blast_output, summarize_traits, to_species_codes)
+
+SEEDS = range(6)
+CHUNK_SIZES = [1, 2, 5, 13, 100000]
+N_SPECIES = 12
+N_TRAITS = 3
+
+### fixture ###
+@pytest.fixture(params=SEEDS)
+def blast_hits(request, tmp_path):
+    """Random hits of queries in BLAST order, and the trait table of the hit species."""
+    rng = np.random.default_rng(request.param)
+    species = np.arange(100, 100 + N_SPECIES)
+    trait = pd.DataFrame({'species_tax_id': species})
+    for j in range(N_TRAITS):
+        trait[f'trait_{j}'] = np.where(rng.random(N_SPECIES) < 0.5, species * 10 + j, np.nan)
+    trait.loc[:1, 'trait_0'] = [1000.0, 1010.0]
+    trait_path = tmp_path / 'trait.tsv'
+    trait.to_csv(trait_path, sep='\t', index=False)
+
+    # Species 999 has no trait data; queries have up to 20 hits (some none)
+    blocks = []
+    for i in range(8):
+        n_hits = rng.integers(0, 21)
+        blocks.append(pd.DataFrame({
+            'sequence': f'query_{i}',
+            'species_tax_id': rng.choice(np.r_[species, 999], size=n_hits).astype(str),
+            'pident': rng.uniform(80.0, 100.0, size=n_hits).round(3),
+            'length': rng.integers(50, 500, size=n_hits).astype(float)}))
+    # Queries with hits of species without trait data only, or only among the long hits
+    blocks.insert(3, pd.DataFrame({'sequence': 'query_unknown', 'species_tax_id': '999',
+                                   'pident': [99.0, 95.0], 'length': [480.0, 470.0]}))
+    blocks.insert(5, pd.DataFrame({'sequence': 'query_short_known', 'species_tax_id': ['999', '100', '101'],
+                                   'pident': [99.0, 99.0, 99.0], 'length': [490.0, 20.0, 10.0]}))
+    hits = pd.concat(blocks, ignore_index=True)
+    return hits, str(trait_path)
+
+def reference_hits(hits: pd.DataFrame, perc_identity) -> pd.DataFrame:
+    passing = hits if perc_identity is None else hits[hits['pident'] >= perc_identity]
+    if len(passing) == 0:
+        return passing
+    return passing[passing['length'] >= passing['length'].mean() * 0.5]
+
+def reference_traits(hits: pd.DataFrame, trait_path: str) -> pd.DataFrame:
+    """Value and percent identity of the first hit with a known value of each trait."""
+    trait = pd.read_csv(trait_path, sep='\t').set_index('species_tax_id')
+    hits = hits.assign(species_tax_id=hits['species_tax_id'].astype(int))
+    out = pd.DataFrame({'sequence': pd.unique(hits['sequence'])}).set_index('sequence')
+    for col in trait.columns:
+        known = hits[hits['species_tax_id'].map(trait[col]).notnull()]
+        first = known.groupby('sequence', sort=False).first()
+        out[col] = first['species_tax_id'].map(trait[col])
+        out[f'{col}_pident'] = first['pident']
+    return out.reset_index()
+
+def predicted_traits(hits: pd.DataFrame, trait_path: str) -> pd.DataFrame:
+    trait_ids, trait_cols, trait_values, trait_known = read_trait_matrix(trait_path)
+    species_index = trait_ids.get_indexer(to_species_codes(hits['species_tax_id']))
+    return summarize_traits(hits['sequence'].to_numpy(), species_index, hits['pident'].to_numpy(dtype=np.float64),
+                            trait_cols, trait_values, trait_known)
+
+def reduce_in_chunks(hits: pd.DataFrame, trait_path: str, perc_identity, chunk_size: int) -> BlastHitReducer:
+    trait_ids, _, _, trait_known = read_trait_matrix(trait_path)
+    reducer = BlastHitReducer(trait_ids, trait_known, perc_identity)
+    reduce_blast_output(io.StringIO(hits.to_csv(sep='\t', index=False, header=False)), reducer, chunk_size)
+    return reducer
+
+### test ###
+@pytest.mark.parametrize('perc_identity', [None, 90.0])
+@pytest.mark.parametrize('chunk_size', CHUNK_SIZES)
+def test_reducer(blast_hits, perc_identity, chunk_size):
+    hits, trait_path = blast_hits
+    reducer = reduce_in_chunks(hits, trait_path, perc_identity, chunk_size)
+    kept, query_stats = reducer.reduced()
+
+    passing = hits if perc_identity is None else hits[hits['pident'] >= perc_identity]
+    expected_stats = passing.groupby('sequence', sort=False).agg(length_sum=('length', 'sum'),
+                                                                 n_hits=('length', 'size')).reset_index()
+    pd.testing.assert_frame_equal(query_stats, expected_stats, check_dtype=False)
+
+    expected = reference_traits(reference_hits(hits, perc_identity), trait_path)
+    predicted = predicted_traits(length_cutoff(kept, query_stats), trait_path)
+    pd.testing.assert_frame_equal(predicted, expected, check_dtype=False)
+
+def test_merge_before_cutoff(blast_hits):
+    """Queries reduced apart and merged before the length cutoff give the predictions of one run."""
+    hits, trait_path = blast_hits
+    apart = hits['sequence'].isin(['query_1', 'query_4', 'query_5'])
+    parts = [reduce_in_chunks(part, trait_path, 90.0, 3).reduced() for part in (hits[apart], hits[~apart])]
+    merged = length_cutoff(pd.concat([kept for kept, _ in parts], ignore_index=True),
+                           pd.concat([stats for _, stats in parts], ignore_index=True))
+    whole = reduce_in_chunks(hits, trait_path, 90.0, 3).finish()
+    expected = predicted_traits(whole, trait_path).sort_values('sequence').reset_index(drop=True)
+    predicted = predicted_traits(merged, trait_path).sort_values('sequence').reset_index(drop=True)
+    pd.testing.assert_frame_equal(predicted, expected)
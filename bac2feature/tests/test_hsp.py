@@ -0,0 +1,251 @@
+"""
+Fixture tests of the native HSP engine (bac2feature.core.hsp) against brute-force
+definitions on small random trees:
+squared-change parsimony as the least-squares solution over the tree,
+maximum parsimony likelihoods as fractions of enumerated most parsimonious scenarios,
+and NSTI as the distance to the nearest known tip.
+Predictions from the precomputed reference state are compared with run_hsp on trees
+with placed queries.
+"""
+import itertools
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from bac2feature.core.hsp import (hsp_max_parsimony, hsp_nearest_neighbor, hsp_reference_arrays,
+                                  hsp_squared_change_parsimony, parse_newick, run_hsp, run_hsp_from_reference)
+
+SEEDS = range(8)
+N_TIPS = 9
+N_STATES = 3
+
+### fixture ###
+def random_newick(rng: np.random.Generator, n_tips: int) -> str:
+    """Random rooted binary tree with tips t0..t{n_tips-1}."""
+    clades = [f't{i}' for i in range(n_tips)]
+    while len(clades) > 1:
+        i, j = sorted(rng.choice(len(clades), size=2, replace=False))
+        right, left = clades.pop(j), clades.pop(i)
+        length_left, length_right = rng.uniform(0.05, 1.0, size=2)
+        clades.append(f'({left}:{length_left:.4f},{right}:{length_right:.4f})')
+    return clades[0] + ';'
+
+def random_known(rng: np.random.Generator, n_tips: int, n_traits: int) -> np.ndarray:
+    """Tips with known states of each trait (at least two per trait)."""
+    known = rng.random((n_tips, n_traits)) < 0.6
+    for j in range(n_traits):
+        known[rng.choice(n_tips, size=2, replace=False), j] = True
+    return known
+
+def placed_newick(tree, placements: dict) -> str:
+    """
+    Newick of tree with query tips inserted on the edges above nodes.
+    placements maps a node to (distal, pendant, label) tuples, distal measured from the node.
+    """
+    def clade(node):
+        children = np.flatnonzero(tree.parent == node)
+        text = tree.tip_labels[node] if node < tree.n_tips else '(' + ','.join(clade(c) for c in children) + ')'
+        below = 0.0
+        for distal, pendant, label in sorted(placements.get(node, [])):
+            text = f'({text}:{distal - below:.6f},{label}:{pendant:.6f})'
+            below = distal
+        if node == tree.root:
+            return text
+        return f'{text}:{tree.edge_length[node] - below:.6f}'
+    return clade(tree.root) + ';'
+
+@pytest.fixture(params=SEEDS)
+def toy(request):
+    rng = np.random.default_rng(request.param)
+    newick = random_newick(rng, N_TIPS)
+    return parse_newick(newick), newick, rng
+
+### brute force ###
+def ancestors(tree, node: int) -> list:
+    path = []
+    while tree.parent[node] >= 0:
+        node = tree.parent[node]
+        path.append(node)
+    return path
+
+def root_distance(tree) -> np.ndarray:
+    distance = np.zeros(tree.n_nodes)
+    for node in range(tree.n_nodes):
+        distance[node] = sum(tree.edge_length[n] for n in [node] + ancestors(tree, node)[:-1])
+    return distance
+
+def retained_nodes(tree, known: np.ndarray) -> set:
+    """Root and internal nodes with two or more children having known tips below."""
+    has_known = {node for tip in np.flatnonzero(known) for node in [tip] + ancestors(tree, tip)}
+    retained = {tree.root}
+    for node in range(tree.n_tips, tree.n_nodes):
+        children = np.flatnonzero(tree.parent == node)
+        if sum(child in has_known for child in children) >= 2:
+            retained.add(node)
+    return retained
+
+def fill_from_ancestors(tree, values: dict, shape) -> np.ndarray:
+    """Values of all nodes, taking those of the nearest ancestor with a value."""
+    out = np.empty((tree.n_nodes,) + shape)
+    for node in range(tree.n_nodes):
+        source = next(n for n in [node] + ancestors(tree, node) if n in values)
+        out[node] = values[source]
+    return out
+
+def brute_squared_change(tree, states: np.ndarray, known: np.ndarray) -> np.ndarray:
+    """Minimizer of sum (x_parent - x_child)^2 / edge_length with known tips fixed."""
+    weight = np.zeros((tree.n_nodes, tree.n_nodes))
+    for node in range(tree.n_nodes):
+        if tree.parent[node] >= 0:
+            weight[node, tree.parent[node]] = weight[tree.parent[node], node] = 1.0 / tree.edge_length[node]
+    laplacian = np.diag(weight.sum(axis=1)) - weight
+    fixed = np.flatnonzero(known)
+    free = np.setdiff1d(np.arange(tree.n_nodes), fixed)
+    x = np.zeros(tree.n_nodes)
+    x[fixed] = states[fixed]
+    x[free] = np.linalg.solve(laplacian[np.ix_(free, free)], -laplacian[np.ix_(free, fixed)] @ x[fixed])
+    values = {node: x[node] for node in set(fixed) | retained_nodes(tree, known)}
+    return fill_from_ancestors(tree, values, ())
+
+def brute_max_parsimony(tree, states: np.ndarray, known: np.ndarray, n_states: int) -> np.ndarray:
+    """Fractions of most parsimonious scenarios with each state, over the tree of known tips."""
+    kept = set(np.flatnonzero(known)) | retained_nodes(tree, known)
+    edges = [(node, next(n for n in ancestors(tree, node) if n in kept)) for node in kept if node != tree.root]
+    internal = sorted(kept - set(np.flatnonzero(known)))
+    counts = {node: np.zeros(n_states) for node in internal}
+    best = np.inf
+    for assignment in itertools.product(range(n_states), repeat=len(internal)):
+        state = dict(zip(internal, assignment))
+        state.update({tip: states[tip] for tip in np.flatnonzero(known)})
+        cost = sum(state[a] != state[b] for a, b in edges)
+        if cost < best:
+            best = cost
+            counts = {node: np.zeros(n_states) for node in internal}
+        if cost == best:
+            for node in internal:
+                counts[node][state[node]] += 1
+    values = {node: count / count.sum() for node, count in counts.items()}
+    values.update({tip: np.eye(n_states)[states[tip]] for tip in np.flatnonzero(known)})
+    return fill_from_ancestors(tree, values, (n_states,))
+
+def brute_nearest_known(tree, known: np.ndarray) -> np.ndarray:
+    """Path length from every node to the nearest known tip."""
+    distance = root_distance(tree)
+    nearest = np.full(tree.n_nodes, np.inf)
+    for node in range(tree.n_nodes):
+        path = set([node] + ancestors(tree, node))
+        for tip in np.flatnonzero(known):
+            lca = next(n for n in [tip] + ancestors(tree, tip) if n in path)
+            nearest[node] = min(nearest[node], distance[node] + distance[tip] - 2 * distance[lca])
+    return nearest
+
+### test ###
+def test_squared_change_parsimony(toy):
+    tree, _, rng = toy
+    known = random_known(rng, tree.n_tips, 2)
+    states = np.where(known, rng.normal(5.0, 2.0, size=known.shape), np.nan)
+    predicted = hsp_squared_change_parsimony(tree, states, weighted=True)
+    for j in range(states.shape[1]):
+        expected = brute_squared_change(tree, np.nan_to_num(states[:, j]), known[:, j])
+        np.testing.assert_allclose(predicted[:, j], expected, rtol=0, atol=1e-13)
+
+def test_max_parsimony(toy):
+    tree, _, rng = toy
+    known = random_known(rng, tree.n_tips, 2)
+    states = np.where(known, rng.integers(0, N_STATES, size=known.shape), -1)
+    states[0, :] = N_STATES - 1  # every state can occur
+    known[0, :] = True
+    predicted = hsp_max_parsimony(tree, states)
+    for j in range(states.shape[1]):
+        expected = brute_max_parsimony(tree, states[:, j], known[:, j], N_STATES)
+        np.testing.assert_allclose(predicted[:, j], expected, rtol=0, atol=1e-13)
+
+def test_nearest_neighbor(toy):
+    tree, _, rng = toy
+    known = random_known(rng, tree.n_tips, 1)[:, 0]
+    np.testing.assert_allclose(hsp_nearest_neighbor(tree, known), brute_nearest_known(tree, known),
+                               rtol=0, atol=1e-13)
+
+def test_run_hsp(toy, tmp_path):
+    """Predictions and NSTI of the tips missing from the trait table."""
+    tree, newick, rng = toy
+    queries = rng.choice(tree.n_tips, size=2, replace=False)
+    known = np.ones(tree.n_tips, dtype=bool)
+    known[queries] = False
+    known_genome = known & (rng.random(tree.n_tips) < 0.8)
+    known_genome[np.flatnonzero(known)[:2]] = True
+    genome_size = rng.uniform(1.0, 9.0, size=tree.n_tips).round(3)
+    gram_stain = rng.integers(0, 2, size=tree.n_tips)
+    gram_stain[np.flatnonzero(known)[:2]] = [0, 1]
+
+    tree_path = tmp_path / 'tree.tre'
+    tree_path.write_text(newick)
+    trait_path = tmp_path / 'trait.tsv'
+    trait = pd.DataFrame({'species_tax_id': np.array(tree.tip_labels)[known],
+                          'genome_size': np.where(known_genome, genome_size.astype(str), '')[known],
+                          'gram_stain': gram_stain[known]})
+    trait.to_csv(trait_path, sep='\t', index=False)
+
+    out = run_hsp(str(tree_path), str(trait_path), check_nsti=True).set_index('sequence')
+    genome = brute_squared_change(tree, np.where(known_genome, genome_size, 0.0), known_genome)
+    gram = brute_max_parsimony(tree, gram_stain, known, 2)
+    for tip in queries:
+        label = tree.tip_labels[tip]
+        assert out.loc[label, 'genome_size'] == '%g' % genome[tip]
+        if abs(gram[tip, 1] - gram[tip, 0]) > 1e-9:
+            assert out.loc[label, 'gram_stain'] == str(int(np.argmax(gram[tip])))
+        assert float(out.loc[label, 'genome_size_nsti']) == pytest.approx(
+            brute_nearest_known(tree, known_genome)[tip], rel=1e-13)
+        assert float(out.loc[label, 'gram_stain_nsti']) == pytest.approx(
+            brute_nearest_known(tree, known)[tip], rel=1e-13)
+
+def test_run_hsp_from_reference(toy, tmp_path):
+    """Queries placed on random, shared and sibling edges are predicted as by run_hsp."""
+    tree, newick, rng = toy
+    # Some reference tips lack traits or a genome size
+    in_table = rng.random(tree.n_tips) < 0.8
+    in_table[:3] = True
+    known_genome = in_table & (rng.random(tree.n_tips) < 0.8)
+    known_genome[:2] = True
+    genome_size = rng.uniform(1.0, 9.0, size=tree.n_tips).round(3)
+    gram_stain = rng.integers(0, 2, size=tree.n_tips)
+    gram_stain[:2] = [0, 1]
+    trait_path = tmp_path / 'trait.tsv'
+    pd.DataFrame({'species_tax_id': np.array(tree.tip_labels)[in_table],
+                  'genome_size': np.where(known_genome, genome_size.astype(str), '')[in_table],
+                  'gram_stain': gram_stain[in_table]}).to_csv(trait_path, sep='\t', index=False)
+    tree_path = tmp_path / 'reference.tre'
+    tree_path.write_text(newick)
+    hsp_reference = hsp_reference_arrays(str(tree_path), str(trait_path))
+
+    placements = {}
+    def place(node, label):
+        distal = rng.uniform(0.05, 0.95) * tree.edge_length[node]
+        placements.setdefault(node, []).append((distal, rng.uniform(0.01, 0.5), label))
+    nodes = np.flatnonzero(tree.parent >= 0)
+    for i, node in enumerate(rng.choice(nodes, size=3)):
+        place(node, f'q{i}')
+    # Two queries on the same edge, and queries on both edges below an internal node
+    place(nodes[0], 'same_a')
+    place(nodes[0], 'same_b')
+    internal = rng.choice(np.arange(tree.n_tips, tree.n_nodes))
+    for i, child in enumerate(np.flatnonzero(tree.parent == internal)):
+        place(child, f'sibling_{i}')
+    placed_path = tmp_path / 'placed.tre'
+    placed_path.write_text(placed_newick(tree, placements))
+
+    expected = run_hsp(str(placed_path), str(trait_path), check_nsti=True)
+    predicted = run_hsp_from_reference(str(placed_path), hsp_reference, str(trait_path), check_nsti=True)
+    assert predicted is not None
+    expected = expected.sort_values('sequence').reset_index(drop=True)
+    predicted = predicted.sort_values('sequence').reset_index(drop=True)
+    assert list(predicted.columns) == list(expected.columns)
+    assert predicted['sequence'].str.startswith(('q', 'same_', 'sibling_')).sum() == 5 + len(
+        np.flatnonzero(tree.parent == internal))
+    for col in expected.columns:
+        if col.endswith('_nsti'):
+            np.testing.assert_allclose(predicted[col].astype(float), expected[col].astype(float),
+                                       rtol=1e-12, atol=1e-12)
+        else:
+            assert predicted[col].tolist() == expected[col].tolist()
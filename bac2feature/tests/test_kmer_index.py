@@ -0,0 +1,62 @@
+"""
+Tests of the k-mer prefilter of the homology search (bac2feature.core.kmer_index):
+near-identical queries are resolved with the hits BLAST would report, and the others
+are left to BLASTn.
+"""
+import numpy as np
+import pytest
+
+from bac2feature.core.kmer_index import KMER_SIZE, KMER_STEP, kmer_index_arrays, kmer_prefilter
+
+MIN_IDENTITY = 97.0
+
+### fixture ###
+@pytest.fixture
+def references():
+    rng = np.random.default_rng(0)
+    seqs = [''.join(rng.choice(list('ACGT'), size=300)) for _ in range(4)]
+    # The second species shares the sequence of the first one
+    return [('100', seqs[0]), ('101', seqs[0]), ('102', seqs[1]), ('103', seqs[2]), ('104', seqs[3])]
+
+def substitute(seq: str, positions, bases=None) -> str:
+    """seq with the bases at positions replaced by bases (by the next base in ACGT if not given)."""
+    seq = list(seq)
+    for i, position in enumerate(positions):
+        seq[position] = bases[i] if bases else 'ACGT'[('ACGT'.index(seq[position]) + 1) % 4]
+    return ''.join(seq)
+
+### test ###
+def test_resolved(references):
+    index = kmer_index_arrays(references)
+    ref = dict(references)
+    records = [('exact', ref['102'][50:200]),
+               ('one_mismatch', substitute(ref['103'][100:250], [70])),
+               ('shared', ref['100'][:120].lower()),
+               ('whole', ref['104'])]
+    hits, unresolved = kmer_prefilter(records, index, MIN_IDENTITY)
+    assert unresolved == []
+    assert hits['sequence'].tolist() == ['exact', 'one_mismatch', 'shared', 'shared', 'whole']
+    assert hits['species_tax_id'].tolist() == ['102', '103', '100', '101', '104']
+    assert hits['pident'].tolist() == [100.0, round(100 * 149 / 150, 3), 100.0, 100.0, 100.0]
+    assert hits['length'].tolist() == [150.0, 150.0, 120.0, 120.0, 300.0]
+
+def test_unresolved(references):
+    index = kmer_index_arrays(references)
+    ref = dict(references)
+    query = ref['103'][100:250]
+    records = [('low_identity', substitute(query, range(5, 150, 25))),
+               ('short', ref['102'][10:10 + KMER_SIZE + KMER_STEP - 2]),
+               ('ambiguous', substitute(query, [70], 'N')),
+               ('mismatch_at_end', substitute(query, [149])),
+               ('beyond_reference', ref['104'][200:] + 'ACGTACGTAC'),
+               ('unrelated', 'ACGT' * 40)]
+    hits, unresolved = kmer_prefilter(records, index, MIN_IDENTITY)
+    assert len(hits) == 0
+    assert [seq_id for seq_id, _ in unresolved] == [seq_id for seq_id, _ in records]
+
+def test_min_identity(references):
+    """A query with one mismatch in 150 bases is resolved at 99% identity but not at 99.5%."""
+    index = kmer_index_arrays(references)
+    records = [('one_mismatch', substitute(dict(references)['103'][100:250], [70]))]
+    assert len(kmer_prefilter(records, index, 99.0)[0]) == 1
+    assert kmer_prefilter(records, index, 99.5)[1] == records
@@ -0,0 +1,71 @@
+"""
+Tests of sharded placement (bac2feature.core.placement) without PICRUSt2:
+shards are placed by a stand-in of place_shard.
+"""
+import json
+import os
+import time
+
+from bac2feature.core import placement
+
+
+def test_no_shards(tmp_path):
+    """An empty FASTA has no shards and no placements."""
+    empty_fasta = tmp_path / 'empty.fasta'
+    empty_fasta.write_text('')
+    shards = placement.split_fasta(str(empty_fasta), str(tmp_path / 'shards'), 4)
+    assert shards == []
+    assert placement.place_shards_locally(shards, str(tmp_path), threads=4) == []
+
+def fake_place_shard(study_fasta, out_dir, ref_dir_placement, threads=1, out_tree=None):
+    jplace = os.path.join(out_dir, 'epa_result.jplace')
+    with open(jplace, 'w') as f:
+        json.dump({'tree': 'ref', 'fields': [], 'placements': [study_fasta]}, f)
+    return jplace
+
+def test_requeue_stale_job(tmp_path, monkeypatch):
+    """A stale job is resubmitted, and its first worker does not remove the new worker's claim."""
+    queue_dir = str(tmp_path / 'queue')
+    for subdir in ('pending', 'running', 'done'):
+        os.makedirs(os.path.join(queue_dir, subdir))
+    shard = tmp_path / 'shard_0000' / 'input.fasta'
+    shard.parent.mkdir()
+    shard.write_text('>a\nACGT\n')
+    placement.write_json(os.path.join(queue_dir, 'pending', 'run1_shard_0000.json'),
+                         dict(study_fasta=str(shard), out_dir=str(shard.parent), ref_dir_placement='ref'))
+
+    def stalled_place_shard(**options):
+        # Worker a stops sending heartbeats and the job is claimed by worker b
+        placement.requeue_stale_jobs(queue_dir, 'run1')
+        assert os.listdir(os.path.join(queue_dir, 'running')) == ['run1_shard_0000@a.json']
+        stale = time.time() - placement.STALE_AFTER - 1
+        os.utime(placement.running_path(queue_dir, 'run1_shard_0000', 'a'), (stale, stale))
+        placement.requeue_stale_jobs(queue_dir, 'run1')
+        assert os.listdir(os.path.join(queue_dir, 'pending')) == ['run1_shard_0000.json']
+        assert placement.claim_job(queue_dir, 'run1', worker='b') == 'run1_shard_0000'
+        return fake_place_shard(**options)
+
+    assert placement.claim_job(queue_dir, 'run1', worker='a') == 'run1_shard_0000'
+    assert placement.claim_job(queue_dir, 'run1', worker='b') is None
+    monkeypatch.setattr(placement, 'place_shard', stalled_place_shard)
+    placement.run_job(queue_dir, 'run1_shard_0000', threads=1, worker='a')
+    # The stale worker finished late and left the new claim in place
+    assert os.listdir(os.path.join(queue_dir, 'running')) == ['run1_shard_0000@b.json']
+
+    monkeypatch.setattr(placement, 'place_shard', fake_place_shard)
+    placement.run_job(queue_dir, 'run1_shard_0000', threads=1, worker='b')
+    assert os.listdir(os.path.join(queue_dir, 'running')) == []
+    result = placement.read_job_result(queue_dir, 'run1_shard_0000')
+    assert result['status'] == 'ok' and result['jplace'] == str(shard.parent / 'epa_result.jplace')
+
+def test_place_shards_by_queue(tmp_path, monkeypatch):
+    """Shards submitted to the queue are placed by this process and their results collected."""
+    monkeypatch.setattr(placement, 'place_shard', fake_place_shard)
+    fasta = tmp_path / 'input.fasta'
+    fasta.write_text(''.join(f'>s{i}\nACGT\n' for i in range(5)))
+    shards = placement.split_fasta(str(fasta), str(tmp_path / 'runs' / 'run1'), 3)
+    jplace_files = placement.place_shards_by_queue(shards, 'ref', threads=1,
+                                                   queue_dir=str(tmp_path), run_id='run1')
+    assert jplace_files == [os.path.join(os.path.dirname(shard), 'epa_result.jplace') for shard in shards]
+    for subdir in ('pending', 'running', 'done'):
+        assert os.listdir(tmp_path / subdir) == []
@@ -0,0 +1,65 @@
+"""
+Tests of the reference index (bac2feature.core.ref_index): sections are loaded only
+for their source files, which are hashed again only when their size or mtime changed.
+"""
+import os
+
+import numpy as np
+import pytest
+
+import bac2feature.core.ref_index as ref_index
+
+### fixture ###
+@pytest.fixture
+def index(tmp_path, monkeypatch):
+    """Index with a section of a source file, and the files hashed since it was written."""
+    source = tmp_path / 'trait.tsv'
+    source.write_text('species_tax_id\tgenome_size\n1\t2.5\n')
+    index_dir = str(tmp_path / 'index')
+    ref_index.write_ref_index(index_dir, {'trait': ({'values': np.arange(3.0)}, {'ref_trait': str(source)})})
+
+    hashed = []
+    def file_sha1(path):
+        hashed.append(os.path.basename(path))
+        return original_sha1(path)
+    original_sha1 = ref_index.file_sha1
+    monkeypatch.setattr(ref_index, 'file_sha1', file_sha1)
+    ref_index.cached_sha1.cache_clear()
+    return index_dir, source, hashed
+
+### test ###
+def test_unchanged_source(index):
+    index_dir, source, hashed = index
+    arrays = ref_index.load_section('trait', index_dir=index_dir, ref_trait=str(source))
+    np.testing.assert_array_equal(arrays['values'], np.arange(3.0))
+    assert hashed == []
+
+def test_touched_source(index):
+    """A source with a new mtime is hashed once (per process) and still matches."""
+    index_dir, source, hashed = index
+    stat = os.stat(source)
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    for _ in range(2):
+        assert ref_index.load_section('trait', index_dir=index_dir, ref_trait=str(source)) is not None
+    assert hashed == ['trait.tsv']
+
+def test_changed_source(index):
+    index_dir, source, hashed = index
+    # Same size, new contents and mtime
+    stat = os.stat(source)
+    source.write_text('species_tax_id\tgenome_size\n1\t3.5\n')
+    os.utime(source, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+    assert ref_index.load_section('trait', index_dir=index_dir, ref_trait=str(source)) is None
+    source.write_text('species_tax_id\tgenome_size\n1\t2.50\n')
+    assert ref_index.load_section('trait', index_dir=index_dir, ref_trait=str(source)) is None
+    assert ref_index.load_section('kmer', index_dir=index_dir, ref_trait=str(source)) is None
+
+def test_copied_source(index, tmp_path):
+    """A copy of the source elsewhere is compared by content."""
+    index_dir, source, hashed = index
+    copy = tmp_path / 'copy.tsv'
+    copy.write_bytes(source.read_bytes())
+    stat = os.stat(source)
+    os.utime(copy, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+    assert ref_index.load_section('trait', index_dir=index_dir, ref_trait=str(copy)) is not None
+    assert hashed == ['copy.tsv']
@@ -0,0 +1,34 @@
+"""
+Start-up test of the command line: importing bac2feature.cmd.bac2feature in a fresh
+interpreter must not load the prediction backends and their heavy dependencies.
+"""
+import os
+import subprocess
+import sys
+
+import pytest
+
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+HEAVY_MODULES = ['pandas', 'numpy', 'scipy', 'picrust2']
+
+def imported_modules(code: str) -> set:
+    """Top-level packages imported by code, from -X importtime of a fresh interpreter."""
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, [PROJECT_DIR, os.environ.get('PYTHONPATH')])))
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             capture_output=True, text=True, env=env, check=True)
+    modules = set()
+    for line in process.stderr.splitlines():
+        if line.startswith('import time:') and 'self [us]' not in line:
+            modules.add(line.split('|')[-1].strip().split('.')[0])
+    return modules
+
+@pytest.mark.parametrize('code', [
+    'import bac2feature.cmd.bac2feature',
+    'import sys; sys.argv = ["bac2feature", "-h"]\n'
+    'from bac2feature.cmd.bac2feature import main\n'
+    'try:\n    main()\nexcept SystemExit:\n    pass',
+])
+def test_no_heavy_imports(code):
+    modules = imported_modules(code)
+    assert 'bac2feature' in modules
+    assert [module for module in HEAVY_MODULES if module in modules] == []
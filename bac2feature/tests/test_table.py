@@ -0,0 +1,32 @@
+"""
+Tests of typed prediction tables (bac2feature.core.table): continuous traits
+are written to tsv as plain decimals that read back to the same double value.
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from bac2feature.core.table import read_predictions, typed_predictions, write_predictions
+
+GENOME_SIZE = ['2107517.139', '1804961.6', '3552438', '0.0000001', '12000000000000000']
+
+@pytest.mark.parametrize('out_format', ['tsv', 'tsv.gz'])
+def test_tsv_round_trip(tmp_path, out_format):
+    raw = pd.DataFrame({'sequence': [f's{i}' for i in range(len(GENOME_SIZE) + 1)],
+                        'genome_size': GENOME_SIZE + [''],
+                        'genome_size_pident': ['99.123456789012'] * len(GENOME_SIZE) + [''],
+                        'gram_stain': ['1', '0', '', '1', '0', '1']})
+    predictions = typed_predictions(raw, ['gram_stain'])
+    out_path = str(tmp_path / f'predictions.{out_format}')
+    write_predictions(predictions, out_path, out_format)
+
+    text = pd.read_csv(out_path, sep='\t', dtype=str, keep_default_na=False,
+                       compression='gzip' if out_format == 'tsv.gz' else None)
+    assert text['genome_size'].tolist() == GENOME_SIZE + ['']
+    assert text['gram_stain'].tolist() == raw['gram_stain'].tolist()
+    assert not text['genome_size'].str.contains('e').any()
+
+    read = read_predictions(out_path, ['gram_stain'], out_format)
+    pd.testing.assert_frame_equal(read, predictions)
+    assert read['genome_size'].dtype == np.float64
+    assert read.loc[0, 'genome_size'] == 2107517.139